@@ -1,77 +1,219 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import joblib
 import pandas as pd
 import requests
 import sklearn
 import numpy as np
 import json
+import functools
+
+import predictor
+import prediction_cache
+import model_store
+import micro_batcher
+import metrics
+import geocode_index
+import db  # Mounted from `project/`, see `compose.yaml`
+from geocode_cache import GeocodeCache  # Mounted from `project/`
+
+try:
+    import config  # Mounted from `project/`, see `compose.yaml`
+except ImportError:
+    config = None
 
 app = Flask(__name__)
 app.debug = True
 
-errorString = None
+# Load the model and preprocessor, reloaded when a new version is
+# published to the model volume (see `model_store.py`)
+store = model_store.ModelStore()
 
-try:
-    # Load the model and preprocessor
-    model = joblib.load("./model/model.joblib")
-    encoder = joblib.load("./model/preprocessor.joblib")
-except:
-    errorString = "Model or encoder files not found."
 
+@app.before_request
+def watch_model():
+    # Starts the reload & metrics threads once per uwsgi worker
+    store.watch()
+    geocoder.watch()
+    registry.start()
 
-# Define column structure & DataFrame for prediction...
-df_cols = pd.DataFrame(
-    columns=[
-        "BOROUGH CODE",
-        "GROSS SQUARE FEET",
-        "LAND SQUARE FEET",
-        "GROUPED CATEGORY",
-        "LATITUDE",
-        "LONGITUDE",
-        "SALE PRICE",
-    ]
+
+# Prometheus metrics of every worker, served at /metrics (see `metrics.py`).
+# The uwsgi master imports the app once, before forking the workers, so the
+# previous run's files are cleared here and not by the workers.
+registry = metrics.Metrics()
+registry.clear()
+request_count = registry.counter(
+    "predict_requests_total",
+    "Prediction requests, by endpoint & model version.",
+    ["endpoint", "model_version"],
+)
+error_count = registry.counter(
+    "predict_errors_total",
+    "Failed predictions (/predict answers them with status 200), by endpoint, "
+    "error type & model version. A batch counts each failed listing.",
+    ["endpoint", "error_type", "model_version"],
 )
+request_seconds = registry.histogram(
+    "predict_request_seconds",
+    "Seconds per prediction request, by endpoint.",
+    ["endpoint"],
+)
+stage_seconds = registry.histogram(
+    "predict_stage_seconds",
+    "Seconds per stage of a prediction, a micro-batch or batch chunk counts once.",
+    ["stage"],
+)
+
+
+def count_request(endpoint, loaded, stages, errors=()):
+    """
+    Counts a finished request and its errors, and observes its latency.
+
+    :param loaded: 'model_store.LoadedModel' the request used, or None
+    :param stages: 'metrics.Stages' started with the request
+    :param errors: Exceptions, or error dicts (see 'predictor.error_response')
+    """
+    version = loaded.version if loaded is not None else "none"
+    updates = [
+        (request_count, (endpoint, version), 1),
+        (request_seconds, (endpoint,), stages.elapsed()),
+    ]
+    for err in errors:
+        error_type = err["error_type"] if isinstance(err, dict) else type(err).__name__
+        updates.append((error_count, (endpoint, error_type, version), 1))
+    stages.flush(*updates)
+
+
+# Prices of recently scored listings, per worker (see `prediction_cache.py`)
+cache = prediction_cache.PredictionCache()
+
+# Coordinates of addresses for /predict/address (see `geocode_index.py`):
+# the geocodes table in memory, then the processor's geocode cache, then
+# the geocoding API. Without a config there is no index and no API.
+if config is not None:
+    geocoder = geocode_index.GeocodeResolver(
+        geocode_index.sql_index_loader(
+            db.mysql_url(
+                config.DB_USERNAME,
+                config.DB_PASSWORD,
+                config.DB_HOSTNAME,
+                config.DB_NAME,
+            )
+        ),
+        cache=GeocodeCache(),
+        fetch=functools.partial(
+            geocode_index.fetch_geocode, api_key=config.GOOGLE_API_KEY
+        ),
+    )
+else:
+    geocoder = geocode_index.GeocodeResolver(cache=GeocodeCache())
+
+# Define column structure & DataFrame for prediction...
+df_cols = pd.DataFrame(columns=predictor.FEATURE_COLUMNS)
+
+
+# Predict concurrent /predict requests of a worker as one batch, see
+# `micro_batcher.py` (False predicts every request on its own)
+MICRO_BATCHING = True
+
+
+def predict_listings(items):
+    """
+    Encodes, predicts & inverse-scales the prices of (LoadedModel, listing)
+    pairs, with one call per model version.
+
+    :return: List of prices
+    """
+    prices = [None] * len(items)
+    versions = {}
+    for i, (loaded, _) in enumerate(items):
+        versions.setdefault(loaded.version, []).append(i)
+
+    for indexes in versions.values():
+        loaded = items[indexes[0]][0]
+        listings = [items[i][1] for i in indexes]
+        stages = metrics.Stages(stage_seconds)
+        if loaded.compiled is not None:
+            batch = predictor.predict_compiled(
+                loaded.model, loaded.compiled, listings, stages
+            )
+        else:
+            batch = predictor.predict_prices(
+                loaded.model, loaded.encoder, listings, stages
+            )
+        stages.flush()
+        for i, price in zip(indexes, batch):
+            prices[i] = price
+    return prices
+
+
+batcher = micro_batcher.MicroBatcher(predict_listings)
+
+
+def predict_listing(loaded, data, stages=None):
+    """
+    Encodes, predicts & inverse-scales the price of a coerced listing.
+
+    :param loaded: 'model_store.LoadedModel' to predict with
+    :param stages: Optional 'metrics.Stages' of the request
+    """
+    if MICRO_BATCHING:
+        # The batch's own stages are timed by 'predict_listings'
+        price = batcher.submit((loaded, data))
+        predictor.lap(stages, "batch_wait")
+        return price
+    if loaded.compiled is not None:
+        return predictor.predict_one(loaded.model, loaded.compiled, data, stages)
+    return predictor.predict_prices(loaded.model, loaded.encoder, [data], stages)[0]
 
 
 @app.route("/")
 def hello_world():
-    if errorString is not None:
-        return errorString
+    if store.error is not None:
+        return store.error
 
     return "Import copacetic!"
 
 
+def predict_price(data, loaded, stages=None):
+    """
+    Predicts the price of a listing from a request, or reuses its cached price.
+
+    :param loaded: 'store.current', read once so the whole request uses one
+                   model version, even during a reload
+    :raises RuntimeError: If there is no model to predict with
+    """
+    # Convert to appropriate data types
+    data = predictor.coerce(data)
+    predictor.lap(stages, "coerce")
+
+    if loaded is None:
+        raise RuntimeError(store.error)
+
+    # Predict the price, or reuse the cached price of the same listing
+    return cache.predict(
+        data, loaded.version, lambda data: predict_listing(loaded, data, stages)
+    )
+
+
 @app.route("/predict", methods=["GET", "POST"])
 def predict():
     if request.method == "POST":
+        stages = metrics.Stages(stage_seconds)
+        loaded = store.current
         try:
             # Get the data from the POST request
             data = request.get_json(force=True)
+            stages.lap("parse")
 
-            # Convert to appropriate data types
-            for key in data:
-                if key in ["BOROUGH CODE", "GROSS SQUARE FEET", "LAND SQUARE FEET"]:
-                    data[key] = int(data[key])
-                elif key in ["LATITUDE", "LONGITUDE"]:
-                    data[key] = float(data[key])
-
-            # Define the actual DataFrame & put data into it
-            dummy_api_df = pd.DataFrame([data], columns=df_cols.columns)
-
-            # Transform the data using the encoder
-            encoded_features = encoder.transform(dummy_api_df)
-
-            # Delete irrelevant features & extract prediction
-            encoded_features = np.delete(encoded_features, 4, axis=1) # Deletes target var (price)
-            prediction = model.predict(encoded_features) # Makes prediction
-            prediction_price = encoder.transformers_[0][1].inverse_transform(
-                [0, 0, 0, 0, prediction[0]]
-            )[4] # Extracts price prediction only
+            prediction_price = predict_price(data, loaded, stages)
+            count_request("predict", loaded, stages)
 
             # Return the prediction
             return jsonify({"prediction_price": int(prediction_price)})
 
         except Exception as err:
+            count_request("predict", loaded, stages, [err])
             error_message = {
                 "error_message": str(err),
                 "error_type": err.__class__.__name__,
@@ -82,5 +224,133 @@ def predict():
         return "This is the prediction page!"
 
 
+@app.route("/predict/address", methods=["POST"])
+def predict_address():
+    # Address in, price out: the coordinates are looked up, not sent
+    stages = metrics.Stages(stage_seconds)
+    loaded = store.current
+    try:
+        borough, address, data = geocode_index.address_listing(
+            request.get_json(force=True)
+        )
+        stages.lap("parse")
+        location = geocoder.resolve(borough, address)
+        stages.lap("geocode")
+        if location is None:
+            err = LookupError(f"Address '{address}, {borough}' couldn't be geocoded")
+            count_request("address", loaded, stages, [err])
+            return jsonify(predictor.error_response(err)), 404
+
+        data["LATITUDE"], data["LONGITUDE"] = location
+        prediction_price = predict_price(data, loaded, stages)
+    except geocode_index.UpstreamError as err:  # Geocoding API down or failing
+        count_request("address", loaded, stages, [err])
+        return jsonify(predictor.error_response(err)), err.status
+    except RuntimeError as err:  # No model
+        count_request("address", loaded, stages, [err])
+        return jsonify(predictor.error_response(err)), 503
+    except Exception as err:
+        count_request("address", loaded, stages, [err])
+        return jsonify(predictor.error_response(err)), 400
+
+    count_request("address", loaded, stages)
+
+    return jsonify(
+        {
+            "prediction_price": int(prediction_price),
+            "LATITUDE": location[0],
+            "LONGITUDE": location[1],
+        }
+    )
+
+
+def parse_listings(body):
+    """
+    Parses a JSON array, or newline-delimited JSON, of listings.
+
+    :return: (listings, errors), a line that isn't valid JSON is None in
+             'listings' and its exception is in 'errors' under its index
+    """
+    if body.lstrip().startswith("["):
+        return json.loads(body), {}
+
+    listings, errors = [], {}
+    for i, line in enumerate(line for line in body.splitlines() if line.strip()):
+        try:
+            listings.append(json.loads(line))
+        except ValueError as err:
+            listings.append(None)
+            errors[i] = err
+    return listings, errors
+
+
+@app.route("/predict/batch", methods=["POST"])
+def predict_batch():
+    stages = metrics.Stages(stage_seconds)
+    loaded = store.current
+    try:
+        listings, errors = parse_listings(request.get_data(as_text=True))
+    except Exception as err:
+        count_request("batch", loaded, stages, [err])
+        return jsonify(predictor.error_response(err)), 400
+    stages.lap("parse")
+
+    if loaded is None:
+        error = {"error_message": store.error, "error_type": "ModelError"}
+        count_request("batch", loaded, stages, [error])
+        return jsonify(error), 503
+
+    # One encode & one predict call per chunk, errors are per listing
+    results = predictor.predict_batch(
+        loaded.model,
+        loaded.encoder,
+        listings,
+        cache=cache,
+        model_version=loaded.version,
+        stages=stages,
+        compiled=loaded.compiled,
+    )
+    for i, err in errors.items():
+        results[i] = predictor.error_response(err)
+    count_request(
+        "batch",
+        loaded,
+        stages,
+        [result for result in results if "error_type" in result],
+    )
+
+    return jsonify(
+        {
+            "predictions": results,
+            "errors": sum("error_type" in result for result in results),
+        }
+    )
+
+
+@app.route("/predict/cache")
+def cache_info():
+    # Per worker: hits, misses, evictions, size & capacity
+    return jsonify(cache.info())
+
+
+@app.route("/predict/address/stats")
+def geocoder_info():
+    # Per worker: index size & hits, geocode cache hits & API calls
+    index = geocoder.index
+    return jsonify(
+        dict(
+            geocoder.stats,
+            indexed=len(index) if index is not None else 0,
+            index_bytes=index.nbytes if index is not None else 0,
+        )
+    )
+
+
+@app.route("/metrics")
+def metrics_page():
+    # Every worker's metrics, in the Prometheus text format
+    return Response(registry.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,208 @@
+# --------------------------------------------------------
+# TEST: Prediction endpoints
+# --------------------------------------------------------
+import json
+
+import pytest
+
+import app as service
+import flat_forest
+import geocode_index
+from compiled_encoder import CompiledEncoder
+from geocode_cache import GeocodeCache
+from model_store import LoadedModel
+from prediction_cache import PredictionCache
+
+
+def serve(monkeypatch, **changes):
+    # Swaps the served model, like a reload
+    monkeypatch.setattr(
+        service.store, "current", service.store.current._replace(**changes)
+    )
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path, model, encoder):
+    loaded = LoadedModel(model, encoder, CompiledEncoder(encoder), "test")
+    monkeypatch.setattr(service.store, "current", loaded)
+    monkeypatch.setattr(service.store, "error", None)
+    monkeypatch.setattr(service.store, "reload_seconds", 0)
+    monkeypatch.setattr(service, "cache", PredictionCache())
+    monkeypatch.setattr(service.registry, "directory", str(tmp_path / "metrics"))
+    service.registry.clear()
+    return service.app.test_client()
+
+
+# The single-listing endpoint is unchanged
+def test_predict(client, listings):
+    response = client.post("/predict", json=listings[0])
+    assert isinstance(response.get_json()["prediction_price"], int)
+
+    response = client.post("/predict", json={"BOROUGH CODE": "x"})
+    assert json.loads(response.data)["error_type"] == "ValueError"
+
+
+# The flat forest serves the same prices as the sklearn model
+def test_predict_flat_forest(client, monkeypatch, model, listings):
+    expected = [
+        client.post("/predict", json=data).get_json()["prediction_price"]
+        for data in listings
+    ]
+    serve(monkeypatch, model=flat_forest.export_forest(model), version="flat")
+    for data, price in zip(listings, expected):
+        response = client.post("/predict", json=data)
+        assert abs(response.get_json()["prediction_price"] - price) <= 1
+
+
+# Repeated listings are served from the cache, a new model version misses
+def test_predict_cache(client, monkeypatch, listings):
+    for data in listings[:3] + listings[:3]:
+        client.post("/predict", json=data)
+    client.post("/predict/batch", json=listings[:5])
+    info = client.get("/predict/cache").get_json()
+    assert (info["hits"], info["misses"], info["size"]) == (6, 5, 5)
+
+    serve(monkeypatch, version="new")
+    client.post("/predict", json=listings[0])
+    assert client.get("/predict/cache").get_json()["misses"] == 6
+
+
+# JSON arrays and newline-delimited JSON give the same per-listing results
+def test_predict_batch(client, listings):
+    single = [
+        client.post("/predict", json=data).get_json()["prediction_price"]
+        for data in listings[:3]
+    ]
+
+    response = client.post("/predict/batch", json=listings[:3] + [{"LATITUDE": "x"}])
+    body = response.get_json()
+    assert response.status_code == 200
+    assert [r.get("prediction_price") for r in body["predictions"][:3]] == single
+    assert body["predictions"][3]["error_type"] == "ValueError"
+    assert body["errors"] == 1
+
+    ndjson = "\n".join(json.dumps(data) for data in listings[:3]) + "\n{oops\n"
+    response = client.post(
+        "/predict/batch", data=ndjson, content_type="application/x-ndjson"
+    )
+    body = response.get_json()
+    assert [r.get("prediction_price") for r in body["predictions"][:3]] == single
+    assert body["predictions"][3]["error_type"] == "JSONDecodeError"
+
+
+# A malformed JSON array fails as a whole
+def test_predict_batch_bad_body(client):
+    response = client.post("/predict/batch", data='[{"LATITUDE": 40.7}')
+    assert response.status_code == 400
+    assert response.get_json()["error_type"] == "JSONDecodeError"
+
+
+# An address is geocoded from the index, then priced like the same listing
+# sent with its coordinates; an unknown address is a 404
+def test_predict_address(client, monkeypatch, listings):
+    listing = dict(listings[0], **{"BOROUGH CODE": 2})
+    index = geocode_index.GeocodeIndex(
+        geocode_index.geo_keys(["BRONX"], ["1 MAIN STREET"]),
+        [listing["LATITUDE"]],
+        [listing["LONGITUDE"]],
+    )
+    geocoder = geocode_index.GeocodeResolver(lambda: index, refresh_seconds=0)
+    monkeypatch.setattr(service, "geocoder", geocoder)
+
+    expected = client.post("/predict", json=listing).get_json()["prediction_price"]
+    request = {
+        key: value
+        for key, value in listing.items()
+        if key not in ("LATITUDE", "LONGITUDE", "BOROUGH CODE")
+    }
+    response = client.post(
+        "/predict/address", json=dict(request, BOROUGH="Bronx", ADDRESS="1 Main St")
+    )
+    assert response.status_code == 200
+    assert response.get_json() == {
+        "prediction_price": expected,
+        "LATITUDE": listing["LATITUDE"],
+        "LONGITUDE": listing["LONGITUDE"],
+    }
+
+    response = client.post(
+        "/predict/address", json=dict(request, BOROUGH="BRONX", ADDRESS="2 MAIN ST")
+    )
+    assert response.status_code == 404
+    assert response.get_json()["error_type"] == "LookupError"
+
+    response = client.post("/predict/address", json=dict(request, BOROUGH="BRONX"))
+    assert response.status_code == 400
+    assert client.get("/predict/address/stats").get_json()["index_hits"] == 1
+
+
+# A failing geocoding API is a 502/503, and isn't cached as a missing address
+def test_predict_address_upstream_error(client, monkeypatch, tmp_path, listings):
+    answers = [geocode_index.UpstreamError("OVER_QUERY_LIMIT", 503), (40.8, -73.9)]
+
+    def fetch(borough, address):
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    geocoder = geocode_index.GeocodeResolver(
+        cache=GeocodeCache(str(tmp_path / "geocodes.sqlite")), fetch=fetch
+    )
+    monkeypatch.setattr(service, "geocoder", geocoder)
+    request = dict(listings[0], BOROUGH="BRONX", ADDRESS="1 MAIN ST")
+    del request["LATITUDE"], request["LONGITUDE"], request["BOROUGH CODE"]
+
+    response = client.post("/predict/address", json=request)
+    assert response.status_code == 503
+    assert response.get_json()["error_type"] == "UpstreamError"
+
+    response = client.post("/predict/address", json=request)
+    assert response.status_code == 200
+    assert response.get_json()["LATITUDE"] == 40.8
+
+
+# /metrics counts requests & errors (answered with status 200) by model
+# version, and times the stages of the predictions
+def test_metrics(client, monkeypatch, listings):
+    client.post("/predict", json=listings[0])
+    client.post("/predict", json={"BOROUGH CODE": "x"})
+    serve(monkeypatch, version="new")
+    client.post("/predict", json=listings[1])
+    client.post("/predict/batch", json=listings[2:5] + [{"LATITUDE": "x"}])
+
+    response = client.get("/metrics")
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+    lines = dict(
+        line.rsplit(" ", 1)
+        for line in response.get_data(as_text=True).splitlines()
+        if not line.startswith("#")
+    )
+    assert (
+        lines['predict_requests_total{endpoint="predict",model_version="test"}']
+        == "2.0"
+    )
+    assert (
+        lines['predict_requests_total{endpoint="predict",model_version="new"}'] == "1.0"
+    )
+    assert (
+        lines['predict_requests_total{endpoint="batch",model_version="new"}'] == "1.0"
+    )
+    assert (
+        lines[
+            'predict_errors_total{endpoint="predict",error_type="ValueError",'
+            'model_version="test"}'
+        ]
+        == "1.0"
+    )
+    assert (
+        lines[
+            'predict_errors_total{endpoint="batch",error_type="ValueError",'
+            'model_version="new"}'
+        ]
+        == "1.0"
+    )
+    for stage in ["parse", "coerce", "encode", "predict", "inverse"]:
+        assert float(lines[f'predict_stage_seconds_count{{stage="{stage}"}}']) >= 1
+    assert lines['predict_stage_seconds_count{stage="dataframe"}'] == "1.0"
+    assert lines['predict_request_seconds_count{endpoint="predict"}'] == "3.0"
@@ -0,0 +1,129 @@
+"""
+Pandas-free encoder for single-listing predictions.
+
+'CompiledEncoder' reads the fitted 'StandardScaler' means and scales and
+the 'OneHotEncoder' categories out of the ColumnTransformer once, at
+startup. A request dict then maps straight to a numpy feature vector, and
+the predicted price is inverse-scaled with two floats. The outputs are the
+same as 'encoder.transform' followed by deleting the target column.
+"""
+
+import numpy as np
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+class CompiledEncoder:
+    """
+    Flat lookup tables compiled from a fitted ColumnTransformer.
+
+    Supports 'StandardScaler' and 'OneHotEncoder' (without 'drop')
+    transformers with the remainder dropped, which is how
+    'project/pipeline.py' builds the encoder.
+    """
+
+    def __init__(self, encoder, target_column="SALE PRICE"):
+        """
+        :param encoder: Fitted ColumnTransformer
+        :param target_column: Column the model predicts, left out of the features
+        :raises ValueError: If the encoder uses a transformer that can't be compiled
+        """
+        # (column, output position, mean, scale) of every scaled column
+        self.scaled = []
+        # {column: {category: output position}} of every one-hot column
+        self.categories = {}
+        self.ignore_unknown = {}
+
+        position = 0
+        target_position = None
+        for name, transformer, columns in encoder.transformers_:
+            if name == "remainder":
+                if transformer != "drop":
+                    raise ValueError("Only a dropped remainder can be compiled")
+                continue
+            if isinstance(transformer, StandardScaler):
+                n = len(columns)
+                mean = transformer.mean_ if transformer.with_mean else np.zeros(n)
+                scale = transformer.scale_ if transformer.with_std else np.ones(n)
+                for i, column in enumerate(columns):
+                    if column == target_column:
+                        target_position = position
+                        self.target_mean = float(mean[i])
+                        self.target_scale = float(scale[i])
+                    else:
+                        self.scaled.append(
+                            (column, position, float(mean[i]), float(scale[i]))
+                        )
+                    position += 1
+            elif isinstance(transformer, OneHotEncoder) and transformer.drop is None:
+                for column, categories in zip(columns, transformer.categories_):
+                    self.categories[column] = {
+                        category: position + i
+                        for i, category in enumerate(categories.tolist())
+                    }
+                    self.ignore_unknown[column] = transformer.handle_unknown != "error"
+                    position += len(categories)
+            else:
+                raise ValueError(f"Transformer '{name}' can't be compiled")
+
+        if target_position is None:
+            raise ValueError(f"'{target_column}' isn't a scaled column")
+
+        # Output positions once the target column is deleted
+        def shift(p):
+            return p - (p > target_position)
+
+        self.scaled = [
+            (column, shift(p), mean, scale) for column, p, mean, scale in self.scaled
+        ]
+        self.categories = {
+            column: {category: shift(p) for category, p in positions.items()}
+            for column, positions in self.categories.items()
+        }
+        self.n_features = position - 1
+        self.template = np.zeros((1, self.n_features))
+
+    def transform_one(self, data):
+        """
+        Encodes one coerced listing, see 'predictor.coerce'.
+
+        :return: numpy array of shape (1, n_features), like
+                 'np.delete(encoder.transform(df), TARGET_INDEX, axis=1)'
+        :raises ValueError: On an unknown category, like 'OneHotEncoder'
+        """
+        features = self.template.copy()
+        self._fill(features[0], data)
+        return features
+
+    def transform_many(self, listings):
+        """
+        Encodes a list of coerced listings, see 'transform_one'.
+
+        :return: numpy array of shape (len(listings), n_features)
+        """
+        features = np.zeros((len(listings), self.n_features))
+        for row, data in zip(features, listings):
+            self._fill(row, data)
+        return features
+
+    def _fill(self, row, data):
+        for column, position, mean, scale in self.scaled:
+            value = data.get(column)
+            row[position] = np.nan if value is None else (float(value) - mean) / scale
+        for column, positions in self.categories.items():
+            value = data.get(column)
+            position = positions.get(value)
+            if position is not None:
+                row[position] = 1.0
+            elif not self.ignore_unknown[column]:
+                raise ValueError(
+                    f"Found unknown categories [{value!r}] in column '{column}' "
+                    f"during transform"
+                )
+
+    def inverse_price(self, prediction):
+        """
+        Returns the price of a scaled prediction.
+        """
+        return prediction * self.target_scale + self.target_mean
@@ -0,0 +1,72 @@
+# --------------------------------------------------------
+# TEST: Compiled single-listing encoder
+# --------------------------------------------------------
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import predictor
+from compiled_encoder import CompiledEncoder
+
+
+def sklearn_features(encoder, data):
+    features = encoder.transform(
+        pd.DataFrame([data], columns=predictor.FEATURE_COLUMNS)
+    )
+    return np.delete(features, predictor.TARGET_INDEX, axis=1)
+
+
+# Same features, predictions and prices as the ColumnTransformer path
+def test_compiled_encoder_parity(model, encoder, listings):
+    compiled = CompiledEncoder(encoder)
+
+    for data in map(predictor.coerce, listings):
+        np.testing.assert_allclose(
+            compiled.transform_one(data), sklearn_features(encoder, data), rtol=1e-12
+        )
+        assert int(predictor.predict_one(model, compiled, data)) == int(
+            predictor.predict_prices(model, encoder, [data])[0]
+        )
+
+
+# Missing values and unknown categories behave like the ColumnTransformer
+def test_compiled_encoder_edge_cases(encoder, listings):
+    compiled = CompiledEncoder(encoder)
+    data = predictor.coerce(listings[0])
+
+    missing = dict(data)
+    del missing["LATITUDE"]
+    np.testing.assert_array_equal(
+        np.isnan(compiled.transform_one(missing)),
+        np.isnan(sklearn_features(encoder, missing)),
+    )
+
+    unknown = dict(data, **{"GROUPED CATEGORY": "Castle"})
+    with pytest.raises(ValueError):
+        sklearn_features(encoder, unknown)
+    with pytest.raises(ValueError, match="unknown categories"):
+        compiled.transform_one(unknown)
+
+
+# Single-listing latency of the encode step
+def test_compiled_encoder_latency(encoder, listings):
+    compiled = CompiledEncoder(encoder)
+    data = predictor.coerce(listings[0])
+
+    timings = {}
+    for name, encode in (
+        ("sklearn", lambda: sklearn_features(encoder, data)),
+        ("compiled", lambda: compiled.transform_one(data)),
+    ):
+        start = time.perf_counter()
+        for _ in range(200):
+            encode()
+        timings[name] = (time.perf_counter() - start) / 200
+
+    print(
+        f"\nEncode one listing: sklearn {timings['sklearn'] * 1e6:.0f}us, "
+        f"compiled {timings['compiled'] * 1e6:.1f}us"
+    )
+    assert timings["compiled"] * 20 < timings["sklearn"]
@@ -0,0 +1,87 @@
+# --------------------------------------------------------
+# Shared fixtures: a small model & encoder, fitted the same
+# way as `project/pipeline.py` fits the served ones
+# --------------------------------------------------------
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+# Modules compose mounts from `project/` into the service
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "project"))
+
+import predictor
+
+CATEGORIES = ["Condo", "Co-op", "Duplex", "Single-family home"]
+
+
+def make_listings(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "BOROUGH CODE": rng.integers(1, 6, rows),
+            "GROSS SQUARE FEET": rng.integers(500, 5000, rows),
+            "LAND SQUARE FEET": rng.integers(500, 5000, rows),
+            "GROUPED CATEGORY": rng.choice(CATEGORIES, rows),
+            "LATITUDE": rng.uniform(40.5, 40.9, rows),
+            "LONGITUDE": rng.uniform(-74.2, -73.7, rows),
+            "SALE PRICE": rng.uniform(1e5, 5e6, rows),
+        }
+    )
+
+
+@pytest.fixture(scope="session")
+def encoder():
+    preprocessor = ColumnTransformer(
+        transformers=[
+            (
+                "scale",
+                StandardScaler(),
+                [
+                    "GROSS SQUARE FEET",
+                    "LAND SQUARE FEET",
+                    "LATITUDE",
+                    "LONGITUDE",
+                    "SALE PRICE",
+                ],
+            ),
+            ("ohe", OneHotEncoder(), ["BOROUGH CODE", "GROUPED CATEGORY"]),
+        ],
+        sparse_threshold=0,
+    )
+    return preprocessor.fit(make_listings(500))
+
+
+@pytest.fixture(scope="session")
+def model(encoder):
+    encoded = encoder.transform(make_listings(500))
+    model = RandomForestRegressor(n_estimators=20, max_depth=6, random_state=42)
+    return model.fit(
+        np.delete(encoded, predictor.TARGET_INDEX, axis=1),
+        encoded[:, predictor.TARGET_INDEX],
+    )
+
+
+@pytest.fixture(scope="session")
+def serving_model(encoder):
+    # The served model's shape, 200 trees of depth 10
+    encoded = encoder.transform(make_listings(20000, seed=2))
+    model = RandomForestRegressor(
+        n_estimators=200, max_depth=10, random_state=0, n_jobs=-1
+    )
+    model.fit(
+        np.delete(encoded, predictor.TARGET_INDEX, axis=1),
+        encoded[:, predictor.TARGET_INDEX],
+    )
+    return model.set_params(n_jobs=None)
+
+
+@pytest.fixture
+def listings():
+    # Request bodies: no price, JSON types
+    return make_listings(50, seed=1).drop(columns="SALE PRICE").to_dict("records")
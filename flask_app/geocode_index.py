@@ -0,0 +1,404 @@
+"""
+Address resolution for address-in predictions.
+
+'GeocodeIndex' holds the geocodes table in memory as an open-addressing
+hash table of numpy arrays: the 64-bit 'GEO_KEY' of every address (the same
+hash of the normalized primary key as 'helpers.geo_keys') and its
+coordinates, 24 bytes per slot at a load of at most 0.5. A lookup hashes
+the address once and probes a slot or two, so it is O(1), with no address
+strings kept in memory.
+
+'GeocodeResolver' looks addresses up in the index, then in the geocode
+cache shared with the processor (see `geocode_cache.py`), and only calls
+the geocoding API on a miss of both. The index is reloaded from the
+database every 'refresh_seconds' on a background thread.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import time
+import threading
+
+# DATA SCIENCE
+import numpy as np
+import pandas as pd
+
+# API STUFF
+import requests
+
+# PROJECT MODULES
+import db  # Mounted from `project/`, see `compose.yaml`
+from geocode_cache import cache_key  # Mounted from `project/`
+
+try:  # The hash of 'pd.util.hash_array', without its per-call overhead
+    from pandas._libs.hashing import hash_object_array
+    from pandas.core.util.hashing import _default_hash_key
+except ImportError:
+    hash_object_array = None
+
+# VARS -----------------------------------------
+
+GEOCODES_TABLE = "geocodes"
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# API statuses & HTTP codes of a geocoding API that's down or over quota,
+# like in `geocoder.py`. Other failures mean it answered something unexpected
+TRANSIENT_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+TRANSIENT_HTTP_CODES = {429, 500, 502, 503, 504}
+
+# Seconds between reloads of the index
+REFRESH_SECONDS = 15 * 60
+
+# Marks an empty slot, a real key with this value is moved to the next one
+EMPTY_KEY = np.iinfo(np.int64).min
+
+MASK_64 = (1 << 64) - 1
+
+# Borough codes of the model, by borough name
+BOROUGH_CODES = {
+    "MANHATTAN": 1,
+    "BRONX": 2,
+    "BROOKLYN": 3,
+    "QUEENS": 4,
+    "STATEN ISLAND": 5,
+}
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def geo_keys(boroughs, addresses):
+    """
+    Returns the int64 keys of (borough, address) pairs, like 'helpers.geo_keys'.
+    """
+    keys = np.array(
+        [cache_key(borough, address) for borough, address in zip(boroughs, addresses)],
+        dtype=object,
+    )
+    keys = pd.util.hash_array(keys).view(np.int64)
+    return np.where(keys == EMPTY_KEY, EMPTY_KEY + 1, keys)
+
+
+def geo_key(borough, address):
+    """
+    Returns the key of one address, equal to 'geo_keys([borough], [address])[0]'.
+
+    Hashing a one-element array with 'pd.util.hash_array' takes ~100µs,
+    mostly checks & array temporaries, so the final bit mixing is done on a
+    Python int instead.
+    """
+    if hash_object_array is None:
+        return int(geo_keys([borough], [address])[0])
+    keys = np.array([cache_key(borough, address)], dtype=object)
+    key = int(hash_object_array(keys, _default_hash_key, "utf8")[0])
+    key ^= key >> 30
+    key = (key * 0xBF58476D1CE4E5B9) & MASK_64
+    key ^= key >> 27
+    key = (key * 0x94D049BB133111EB) & MASK_64
+    key ^= key >> 31
+    key = key - (1 << 64) if key >> 63 else key
+    return EMPTY_KEY + 1 if key == EMPTY_KEY else key
+
+
+class GeocodeIndex:
+    """
+    Read-only hash table of geocoded addresses, keyed on 'GEO_KEY'.
+    """
+
+    def __init__(self, keys, latitudes, longitudes):
+        """
+        :param keys: 'GEO_KEY's of the geocoded addresses
+        :param latitudes: Latitudes, in the same order
+        :param longitudes: Longitudes, in the same order
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        keys = np.where(keys == EMPTY_KEY, EMPTY_KEY + 1, keys)
+        keys, first = np.unique(keys, return_index=True)
+        locations = np.column_stack(
+            [np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)]
+        )[first]
+
+        capacity = 1 << max(4, (2 * len(keys) - 1).bit_length())
+        self.mask = capacity - 1
+        self.keys = np.full(capacity, EMPTY_KEY, dtype=np.int64)
+        self.locations = np.full((capacity, 2), np.nan)
+
+        # Linear probing, vectorized: every round, the keys still pending try
+        # the next slot, and the first key to reach a free slot takes it
+        home = keys & self.mask
+        pending = np.arange(len(keys))
+        probe = 0
+        while len(pending):
+            slots = (home[pending] + probe) & self.mask
+            free = self.keys[slots] == EMPTY_KEY
+            slots, first = np.unique(slots[free], return_index=True)
+            placed = pending[free][first]
+            self.keys[slots] = keys[placed]
+            self.locations[slots] = locations[placed]
+            pending = np.setdiff1d(pending, placed, assume_unique=True)
+            probe += 1
+
+    @classmethod
+    def from_sql(cls, engine, sql_table_name=GEOCODES_TABLE, chunksize=100000):
+        """
+        Builds the index from the geocoded rows of the geocodes table.
+        """
+        parts = list(
+            pd.read_sql_query(
+                f"SELECT GEO_KEY, LATITUDE, LONGITUDE FROM {sql_table_name} "
+                f"WHERE NOT `GEOCODING ERR` AND LATITUDE IS NOT NULL "
+                f"AND LONGITUDE IS NOT NULL",
+                engine,
+                chunksize=chunksize,
+            )
+        )
+        geocodes = pd.concat(parts, ignore_index=True)
+        return cls(geocodes["GEO_KEY"], geocodes["LATITUDE"], geocodes["LONGITUDE"])
+
+    def __len__(self):
+        return int((self.keys != EMPTY_KEY).sum())
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.locations.nbytes
+
+    def get(self, key):
+        """
+        Returns the (latitude, longitude) of a 'GEO_KEY', or None if it isn't indexed.
+        """
+        slot = key & self.mask
+        while True:
+            found = self.keys[slot]
+            if found == key:
+                latitude, longitude = self.locations[slot]
+                return float(latitude), float(longitude)
+            if found == EMPTY_KEY:
+                return None
+            slot = (slot + 1) & self.mask
+
+    def lookup(self, borough, address):
+        return self.get(geo_key(borough, address))
+
+
+class UpstreamError(Exception):
+    """
+    The geocoding API failed to answer, so the address is neither found nor
+    known to be missing. 'status' is the HTTP status to answer with: 503 if
+    the API is unreachable, down or over quota, 502 if it answered something
+    unexpected, e.g. a rejected key.
+    """
+
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+def fetch_geocode(borough, address, api_key, url=GEOCODE_URL, timeout=5):
+    """
+    Geocodes one address with the geocoding API, like 'helpers.geolocate'.
+
+    :return: (latitude, longitude), or None if it wasn't found ('ZERO_RESULTS')
+             or only partly matched
+    :raises UpstreamError: On any other answer, or no answer, so the failure
+                           isn't cached as a missing address
+    """
+    try:
+        response = requests.get(
+            url,
+            params={"address": f"{address}, {borough}, New York City", "key": api_key},
+            timeout=timeout,
+        )
+    except requests.RequestException as err:
+        raise UpstreamError(f"Geocoding API unreachable: {err}", 503)
+
+    unavailable = response.status_code in TRANSIENT_HTTP_CODES
+    try:
+        res = response.json()
+    except ValueError:
+        raise UpstreamError(
+            f"Geocoding API answered HTTP {response.status_code}, not JSON",
+            503 if unavailable else 502,
+        )
+    if str(res.get("error_message", {})).find("key") != -1:
+        raise UpstreamError("Invalid API Key for geocoding!")
+
+    status = res.get("status")
+    if status == "ZERO_RESULTS":
+        return None
+    if status != "OK" or not res.get("results"):
+        raise UpstreamError(
+            f"Geocoding API answered HTTP {response.status_code}, status {status}",
+            503 if unavailable or status in TRANSIENT_STATUSES else 502,
+        )
+    if res["results"][0].get("partial_match"):
+        return None
+    location = res["results"][0]["geometry"]["location"]
+    return location["lat"], location["lng"]
+
+
+def sql_index_loader(url, sql_table_name=GEOCODES_TABLE):
+    """
+    Returns a function loading the index from a database, for 'GeocodeResolver'.
+    """
+
+    def load():
+        return GeocodeIndex.from_sql(db.get_engine(url), sql_table_name)
+
+    return load
+
+
+class GeocodeResolver:
+    """
+    Coordinates of addresses: the in-memory index, the shared geocode cache,
+    then the geocoding API.
+
+    'stats' counts index hits, cache hits, API calls, unresolved addresses
+    and index loads. The index is replaced with one assignment, so lookups
+    carry on during a reload.
+    """
+
+    def __init__(
+        self, load_index=None, cache=None, fetch=None, refresh_seconds=REFRESH_SECONDS
+    ):
+        """
+        :param load_index: Function returning a GeocodeIndex, e.g. 'sql_index_loader'
+        :param cache: 'geocode_cache.GeocodeCache' shared with the processor
+        :param fetch: Function of (borough, address) returning (latitude, longitude)
+                      or None, e.g. a 'fetch_geocode' partial. None never calls the API.
+        :param refresh_seconds: Seconds between index reloads, 0 to never reload
+        """
+        self.load_index = load_index
+        self.cache = cache
+        self.fetch = fetch
+        self.refresh_seconds = refresh_seconds
+        self.index = None
+        self.stats = {
+            "index_hits": 0,
+            "cache_hits": 0,
+            "api_calls": 0,
+            "unresolved": 0,
+            "loads": 0,
+            "failed_loads": 0,
+        }
+        self.lock = threading.Lock()
+        self._watcher_pid = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reloads the index. A failed load keeps the current index.
+
+        :return: True if a new index was swapped in
+        """
+        if self.load_index is None:
+            return False
+        start = time.perf_counter()
+        try:
+            index = self.load_index()
+        except Exception as err:
+            self.stats["failed_loads"] += 1
+            print(f"Geocodes index not loaded: {err}")
+            return False
+        self.index = index
+        self.stats["loads"] += 1
+        print(
+            f"Loaded {len(index)} geocodes ({index.nbytes / 2**20:.1f}MiB) "
+            f"in {time.perf_counter() - start:.2f}s."
+        )
+        return True
+
+    def watch(self):
+        """
+        Starts this process's refresh thread, if it isn't running yet, see
+        'model_store.ModelStore.watch'.
+        """
+        if self.load_index is None or not self.refresh_seconds:
+            return
+        if self._watcher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._watcher_pid != os.getpid():
+                self._watcher_pid = os.getpid()
+                threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            self.refresh()
+
+    def _count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def resolve(self, borough, address):
+        """
+        Returns the (latitude, longitude) of an address, or None if it can't be geocoded.
+
+        :param borough: Borough name, e.g. 'MANHATTAN'
+        :param address: Street address, e.g. '254 WEST 27TH STREET'
+        :raises UpstreamError: If the geocoding API failed to answer, see 'fetch_geocode'
+        """
+        index = self.index
+        location = index.lookup(borough, address) if index is not None else None
+        if location is not None:
+            self._count("index_hits")
+            return location
+
+        if self.cache is not None and self.fetch is None:
+            entry = self.cache.get(cache_key(borough, address))
+            if entry is not None:
+                self._count("cache_hits")
+                location = None if entry.failed else (entry.latitude, entry.longitude)
+        elif self.cache is not None:
+            # Failed lookups are cached too, so a bad address isn't sent to
+            # the API on every request
+            called = []
+
+            def fetch(borough, address):
+                called.append(True)
+                self._count("api_calls")
+                return self.fetch(borough, address)
+
+            entry = self.cache.geolocate(borough, address, fetch)
+            if not called:
+                self._count("cache_hits")
+            location = None if entry.failed else (entry.latitude, entry.longitude)
+        elif self.fetch is not None:
+            self._count("api_calls")
+            location = self.fetch(borough, address)
+
+        if location is None:
+            self._count("unresolved")
+        return location
+
+
+def address_listing(data):
+    """
+    Splits an address-in request into its (borough, address) and its listing.
+
+    :param data: Request dict with 'ADDRESS', 'BOROUGH' (a name) or 'BOROUGH CODE',
+                 and the listing's other features
+    :return: (borough name, address, listing without the address fields)
+    :raises TypeError: If the request isn't a JSON object
+    :raises ValueError: If the borough or address is missing or unknown
+    """
+    if not isinstance(data, dict):
+        raise TypeError(f"Expected a JSON object, got {type(data).__name__}")
+    listing = dict(data)
+    address = str(listing.pop("ADDRESS", "") or "").strip()
+    borough = str(listing.pop("BOROUGH", "") or "").strip().upper()
+    if not address:
+        raise ValueError("Missing 'ADDRESS'")
+
+    if borough:
+        if borough not in BOROUGH_CODES:
+            raise ValueError(f"Unknown borough '{borough}'")
+        code = listing.setdefault("BOROUGH CODE", BOROUGH_CODES[borough])
+        if int(code) != BOROUGH_CODES[borough]:
+            raise ValueError(f"'BOROUGH CODE' {code} isn't {borough}")
+    else:
+        names = {code: name for name, code in BOROUGH_CODES.items()}
+        code = listing.get("BOROUGH CODE")
+        if code is None or int(code) not in names:
+            raise ValueError("Missing or unknown 'BOROUGH' / 'BOROUGH CODE'")
+        borough = names[int(code)]
+    return borough, address, listing
@@ -0,0 +1,273 @@
+# --------------------------------------------------------
+# TEST: In-memory geocode index & address resolution
+# --------------------------------------------------------
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import geocode_index
+from geocode_cache import GeocodeCache
+from geocode_index import GeocodeIndex, GeocodeResolver
+
+
+def make_addresses(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    boroughs = rng.choice(list(geocode_index.BOROUGH_CODES), rows)
+    addresses = [f"{n} WEST {s} STREET" for n, s in rng.integers(1, 9999, (rows, 2))]
+    return boroughs, addresses
+
+
+# Keys match the processor's 'GEO_KEY' column
+def test_geo_keys_match_helpers():
+    helpers = pytest.importorskip("helpers")
+    boroughs, addresses = make_addresses(200)
+    assert np.array_equal(
+        geocode_index.geo_keys(boroughs, addresses),
+        helpers.geo_keys(boroughs, addresses),
+    )
+
+
+# The single-address key is the same as the vectorized one
+def test_geo_key():
+    boroughs, addresses = make_addresses(2000)
+    keys = [geocode_index.geo_key(b, a) for b, a in zip(boroughs, addresses)]
+    assert keys == geocode_index.geo_keys(boroughs, addresses).tolist()
+
+
+# Every indexed key is found with its coordinates, other keys aren't
+def test_index_lookup():
+    rng = np.random.default_rng(1)
+    keys = np.unique(rng.integers(-(2**63), 2**63 - 1, 20000, dtype=np.int64))
+    latitudes = rng.uniform(40.5, 40.9, len(keys))
+    longitudes = rng.uniform(-74.2, -73.7, len(keys))
+    index = GeocodeIndex(keys, latitudes, longitudes)
+
+    assert len(index) == len(keys)
+    assert len(index.keys) >= 2 * len(keys)
+    for key, latitude, longitude in zip(keys[:2000], latitudes, longitudes):
+        assert index.get(int(key)) == (latitude, longitude)
+    missing = np.setdiff1d(
+        rng.integers(-(2**63), 2**63 - 1, 2000, dtype=np.int64), keys
+    )
+    assert all(index.get(int(key)) is None for key in missing)
+
+
+# Colliding keys are probed past, a key equal to the empty-slot marker is
+# moved to the next value, like 'geo_keys' does
+def test_index_collisions():
+    keys = [16 * i for i in range(8)] + [geocode_index.EMPTY_KEY]
+    index = GeocodeIndex(keys, np.arange(9.0), -np.arange(9.0))
+    for i, key in enumerate(keys[:-1] + [geocode_index.EMPTY_KEY + 1]):
+        assert index.get(key) == (i, -i)
+    assert index.get(16 * 8) is None
+
+    assert len(GeocodeIndex([], [], [])) == 0
+    assert GeocodeIndex([], [], []).get(5) is None
+
+
+# Only geocoded rows of the geocodes table are indexed
+def test_index_from_sql(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    keys = geocode_index.geo_keys(
+        ["MANHATTAN", "BRONX", "QUEENS"],
+        ["254 WEST 27TH STREET", "1 MAIN STREET", "9 NOWHERE LANE"],
+    )
+    pd.DataFrame(
+        {
+            "GEO_KEY": keys,
+            "LATITUDE": [40.74, 40.85, None],
+            "LONGITUDE": [-73.99, -73.87, None],
+            "GEOCODING ERR": [False, False, True],
+        }
+    ).to_sql("geocodes", engine, index=False)
+
+    index = GeocodeIndex.from_sql(engine)
+    assert len(index) == 2
+    assert index.lookup("MANHATTAN", "254 W 27 ST") == (40.74, -73.99)
+    assert index.lookup("QUEENS", "9 NOWHERE LANE") is None
+
+
+# The index is tried first, then the geocode cache, then the API, once
+def test_resolver(tmp_path):
+    calls = []
+
+    def fetch(borough, address):
+        calls.append(address)
+        return None if "NOWHERE" in address else (40.7, -74.0)
+
+    index = GeocodeIndex(
+        geocode_index.geo_keys(["MANHATTAN"], ["254 WEST 27TH STREET"]),
+        [40.74],
+        [-73.99],
+    )
+    resolver = GeocodeResolver(
+        lambda: index,
+        cache=GeocodeCache(str(tmp_path / "geocodes.sqlite")),
+        fetch=fetch,
+        refresh_seconds=0,
+    )
+    assert resolver.resolve("MANHATTAN", "254 W 27 ST") == (40.74, -73.99)
+    assert resolver.resolve("BRONX", "1 MAIN STREET") == (40.7, -74.0)
+    assert resolver.resolve("BRONX", "1 Main St") == (40.7, -74.0)
+    assert resolver.resolve("QUEENS", "9 NOWHERE LANE") is None
+    assert resolver.resolve("QUEENS", "9 NOWHERE LANE") is None
+
+    assert calls == ["1 MAIN STREET", "9 NOWHERE LANE"]
+    assert resolver.stats == {
+        "index_hits": 1,
+        "cache_hits": 2,
+        "api_calls": 2,
+        "unresolved": 2,
+        "loads": 1,
+        "failed_loads": 0,
+    }
+
+
+# A failed reload keeps the current index, no API key never calls the API
+def test_resolver_refresh(tmp_path):
+    indexes = [GeocodeIndex([1], [40.0], [-74.0])]
+
+    def load():
+        if not indexes:
+            raise OSError("Database unavailable")
+        return indexes.pop()
+
+    resolver = GeocodeResolver(load, refresh_seconds=0)
+    index = resolver.index
+    assert resolver.refresh() is False
+    assert resolver.index is index
+    assert resolver.stats["failed_loads"] == 1
+
+    offline = GeocodeResolver(cache=GeocodeCache(str(tmp_path / "geocodes.sqlite")))
+    assert offline.resolve("BRONX", "1 MAIN STREET") is None
+    assert offline.stats["api_calls"] == 0
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        if isinstance(self.body, str):
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+        return self.body
+
+
+# Only a missing or partly matched address is None, other answers raise with
+# the HTTP status to answer with
+@pytest.mark.parametrize(
+    "status_code, body, expected",
+    [
+        (200, {"results": [], "status": "ZERO_RESULTS"}, None),
+        (200, {"results": [{"partial_match": True}], "status": "OK"}, None),
+        (200, {"results": [], "status": "OVER_QUERY_LIMIT"}, 503),
+        (500, {"results": [], "status": "UNKNOWN_ERROR"}, 503),
+        (503, "<html>Service Unavailable</html>", 503),
+        (403, "<html>Forbidden</html>", 502),
+        (200, {"status": "REQUEST_DENIED"}, 502),
+        (
+            200,
+            {"error_message": "The provided API key is expired.", "results": []},
+            502,
+        ),
+        (None, None, 503),
+    ],
+)
+def test_fetch_geocode_errors(monkeypatch, status_code, body, expected):
+    def get(url, params, timeout):
+        if status_code is None:
+            raise geocode_index.requests.ConnectionError("Connection refused")
+        return FakeResponse(status_code, body)
+
+    monkeypatch.setattr(geocode_index.requests, "get", get)
+    if expected is None:
+        assert geocode_index.fetch_geocode("BRONX", "1 MAIN ST", "key") is None
+    else:
+        with pytest.raises(geocode_index.UpstreamError) as err:
+            geocode_index.fetch_geocode("BRONX", "1 MAIN ST", "key")
+        assert err.value.status == expected
+
+
+# Requests name the borough, or give its code
+def test_address_listing():
+    borough, address, listing = geocode_index.address_listing(
+        {"BOROUGH": "brooklyn", "ADDRESS": "1 MAIN ST", "GROSS SQUARE FEET": 900}
+    )
+    assert (borough, address) == ("BROOKLYN", "1 MAIN ST")
+    assert listing == {"BOROUGH CODE": 3, "GROSS SQUARE FEET": 900}
+
+    borough, _, _ = geocode_index.address_listing(
+        {"BOROUGH CODE": "5", "ADDRESS": "1 MAIN ST"}
+    )
+    assert borough == "STATEN ISLAND"
+
+    for data in [
+        {"BOROUGH": "BROOKLYN"},
+        {"BOROUGH": "JERSEY", "ADDRESS": "1 MAIN ST"},
+        {"BOROUGH": "BROOKLYN", "BOROUGH CODE": 1, "ADDRESS": "1 MAIN ST"},
+        {"BOROUGH CODE": 9, "ADDRESS": "1 MAIN ST"},
+    ]:
+        with pytest.raises(ValueError):
+            geocode_index.address_listing(data)
+
+
+# Benchmark: lookups and memory of an index of a million addresses, against
+# a dict of address strings and a SQL query per lookup
+def test_index_benchmark(tmp_path):
+    rows = 1_000_000
+    rng = np.random.default_rng(2)
+    keys = rng.integers(-(2**63), 2**63 - 1, rows, dtype=np.int64)
+    latitudes = rng.uniform(40.5, 40.9, rows)
+    longitudes = rng.uniform(-74.2, -73.7, rows)
+
+    start = time.perf_counter()
+    index = GeocodeIndex(keys, latitudes, longitudes)
+    build_seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    table = {
+        f"BROOKLYN_{i} WEST {i % 300} ST": (lat, lng)
+        for i, lat, lng in zip(range(rows), latitudes.tolist(), longitudes.tolist())
+    }
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del table
+
+    probes = [int(key) for key in keys[:50000]]
+    start = time.perf_counter()
+    for key in probes:
+        index.get(key)
+    get_us = (time.perf_counter() - start) / len(probes) * 1e6
+
+    boroughs, addresses = make_addresses(2000, seed=3)
+    start = time.perf_counter()
+    for borough, address in zip(boroughs, addresses):
+        index.lookup(borough, address)
+    lookup_us = (time.perf_counter() - start) / len(addresses) * 1e6
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    pd.DataFrame({"GEO_KEY": keys[:100000], "LATITUDE": latitudes[:100000]}).to_sql(
+        "geocodes", engine, index=False
+    )
+    with engine.connect() as connection:
+        connection.exec_driver_sql("CREATE INDEX geo_key ON geocodes (GEO_KEY)")
+        start = time.perf_counter()
+        for key in probes[:2000]:
+            connection.exec_driver_sql(
+                "SELECT LATITUDE FROM geocodes WHERE GEO_KEY = ?", (key,)
+            ).fetchall()
+        sql_us = (time.perf_counter() - start) / 2000 * 1e6
+
+    print(
+        f"\n{rows} addresses: built in {build_seconds:.2f}s, "
+        f"{index.nbytes / 2**20:.0f}MiB (dict of address strings "
+        f"{dict_bytes / 2**20:.0f}MiB). Lookup by key {get_us:.2f}µs, "
+        f"by address {lookup_us:.1f}µs, indexed SQLite query {sql_us:.1f}µs"
+    )
+    assert index.nbytes < dict_bytes
+    assert get_us < sql_us
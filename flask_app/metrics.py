@@ -0,0 +1,433 @@
+"""
+Prometheus metrics of the prediction service, aggregated across uwsgi workers.
+
+Each worker adds its counters and histogram buckets up in a list of
+floats, under a lock shared with its other threads, so an observation
+costs a few hundred nanoseconds and no system call, and the stages of a
+request are observed under one lock. A background thread copies the
+list every 'FLUSH_SECONDS' into a memory-mapped file of the worker's own
+in 'METRICS_DIR', next to a file naming the series of each slot.
+'/metrics' reads every worker's files and sums the series. A dead
+worker's files are kept, so counters stay monotonic when uwsgi restarts
+a worker (less its last unflushed second), and the directory is only
+cleared when the app is loaded by the uwsgi master (see `app.py`).
+
+'Stages' times the steps of a prediction (parse, coerce, dataframe,
+encode, predict, inverse) as laps of one stopwatch, see `predictor.py`.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import json
+import mmap
+import array
+import time
+from time import perf_counter
+import bisect
+import tempfile
+import threading
+
+# DATA SCIENCE
+import numpy as np
+
+# VARS -----------------------------------------
+
+METRICS_DIR = os.path.join(tempfile.gettempdir(), "predictor_metrics")
+
+# float64 slots per worker, the files are sparse so unused slots cost nothing
+CAPACITY = 1 << 16
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    float("inf"),
+)
+
+# Seconds between copies of a worker's totals to its file
+FLUSH_SECONDS = 1
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def escape(value):
+    """
+    Escapes a label value for the Prometheus text format.
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def read_keys(keys_path):
+    """
+    Returns the (start, size, name, labels) of every complete line of a keys file.
+    """
+    try:
+        with open(keys_path) as f:
+            lines = f.read().split("\n")[:-1]  # The last one may be half written
+    except OSError:
+        return []
+    keys = []
+    for line in lines:
+        try:
+            keys.append(json.loads(line))
+        except ValueError:  # Empty, or cut short by a crash
+            continue
+    return keys
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+class Counter:
+    """
+    Monotonic counter, one series per tuple of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, metrics, name, documentation, labelnames=()):
+        self.metrics = metrics
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.size = 1
+        self.starts = {}  # Slots of this process's series, see 'Metrics.slot'
+
+    def inc(self, labels=(), value=1):
+        """
+        :param labels: Label values, in 'labelnames' order
+        """
+        with self.metrics.lock:
+            self.add(labels, value)
+
+    def add(self, labels, value):
+        # Called under the lock, see 'Metrics.update'
+        start = self.starts.get(labels)
+        if start is None:
+            start = self.metrics.slot(self, labels)
+            if start is None:
+                return
+        self.metrics.totals[start] += value
+
+    def samples(self, labels, values):
+        yield self.name, self.labelnames, labels, values[0]
+
+
+class Histogram:
+    """
+    Histogram of latencies, one series per tuple of label values.
+
+    A series is its bucket counts (not cumulative, summed up when exposed),
+    then its sum and count.
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self, metrics, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS
+    ):
+        self.metrics = metrics
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        if self.buckets[-1] != float("inf"):
+            self.buckets += (float("inf"),)
+        self.size = len(self.buckets) + 2
+        self.starts = {}
+
+    def observe(self, labels, seconds):
+        """
+        :param labels: Label values, in 'labelnames' order
+        :param seconds: Observed latency
+        """
+        with self.metrics.lock:
+            self.add(labels, seconds)
+
+    def add(self, labels, seconds):
+        # Called under the lock, see 'Metrics.update'
+        start = self.starts.get(labels)
+        if start is None:
+            start = self.metrics.slot(self, labels)
+            if start is None:
+                return
+        totals = self.metrics.totals
+        totals[start + bisect.bisect_left(self.buckets, seconds)] += 1
+        start += len(self.buckets)
+        totals[start] += seconds
+        totals[start + 1] += 1
+
+    def samples(self, labels, values):
+        labelnames = self.labelnames + ("le",)
+        counts = np.cumsum(values[: len(self.buckets)])
+        for bound, count in zip(self.buckets, counts):
+            yield f"{self.name}_bucket", labelnames, labels + (
+                format_bound(bound),
+            ), count
+        yield f"{self.name}_sum", self.labelnames, labels, values[-2]
+        yield f"{self.name}_count", self.labelnames, labels, values[-1]
+
+
+class Stages:
+    """
+    Stopwatch of the stages of one prediction call. Each lap is observed in
+    a 'Histogram' labelled with its stage, when the laps are flushed.
+    """
+
+    __slots__ = ("histogram", "start", "last", "updates")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = self.last = perf_counter()
+        self.updates = []
+
+    def lap(self, stage):
+        """
+        Times the stage since the previous lap (or the start).
+        """
+        now = perf_counter()
+        self.updates.append((self.histogram, (stage,), now - self.last))
+        self.last = now
+
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def flush(self, *updates):
+        """
+        Observes the laps so far, and other (family, labels, value) updates
+        of the request, all under one lock.
+        """
+        laps, self.updates = self.updates, []
+        self.histogram.metrics.update(laps + list(updates))
+
+
+class Metrics:
+    """
+    Metric families of the service, stored in per-worker files of 'directory'.
+
+    Updates go to a plain list of this worker's totals, copied into its
+    memory-mapped file every 'flush_seconds' by a background thread, and
+    before every exposition.
+    """
+
+    def __init__(
+        self, directory=METRICS_DIR, capacity=CAPACITY, flush_seconds=FLUSH_SECONDS
+    ):
+        """
+        :param directory: Folder shared by the workers, e.g. on a tmpfs
+        :param capacity: float64 slots per worker, series past it are dropped
+        :param flush_seconds: Seconds between copies of the totals to the file,
+                              0 to only copy them on 'flush'
+        """
+        self.directory = directory
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.families = {}
+        self.lock = threading.Lock()
+        self.totals = []
+        self.slots = {}
+        self._values = None
+        self._keys_file = None
+        self._full = False
+        self._pid = None
+
+    def counter(self, name, documentation, labelnames=()):
+        family = Counter(self, name, documentation, labelnames)
+        self.families[name] = family
+        return family
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        family = Histogram(self, name, documentation, labelnames, buckets)
+        self.families[name] = family
+        return family
+
+    def _paths(self, pid):
+        return (
+            os.path.join(self.directory, f"{pid}.keys"),
+            os.path.join(self.directory, f"{pid}.values"),
+        )
+
+    def start(self):
+        """
+        Opens this process's files and starts its flush thread, if it hasn't yet.
+
+        Threads and files don't survive a fork, so call it in the worker,
+        e.g. before every request. It is the only pid check, the updates
+        themselves don't make system calls.
+        """
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid != os.getpid():
+                self._open()
+
+    def _open(self):
+        # Called under 'lock'. The totals inherited from the parent process
+        # are its own, so they're dropped. A restarted worker that reuses a
+        # pid carries on with the old worker's series, so the counters stay
+        # monotonic.
+        os.makedirs(self.directory, exist_ok=True)
+        keys_path, values_path = self._paths(os.getpid())
+        with open(values_path, "a+b") as f:
+            f.truncate(self.capacity * 8)
+            self._values = memoryview(mmap.mmap(f.fileno(), 0)).cast("d")
+
+        self.slots, size = {}, 0
+        for family in self.families.values():
+            family.starts = {}
+        for start, length, name, labels in read_keys(keys_path):
+            self.slots[(name, tuple(labels))] = start
+            if name in self.families:
+                self.families[name].starts[tuple(labels)] = start
+            size = max(size, start + length)
+        self.totals = self._values[:size].tolist()
+        self._full = False
+
+        self._keys_file = open(keys_path, "a", buffering=1)
+        if self._keys_file.tell():
+            self._keys_file.write("\n")  # Ends a line a crash cut short
+        self._pid = os.getpid()
+        if self.flush_seconds:
+            threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def slot(self, family, labels):
+        """
+        Returns the first slot of a series in 'totals', adding it if it's new.
+
+        Called under 'lock', by the families, when the series isn't in their
+        'starts' yet.
+
+        :return: The slot, or None if the worker's file is full
+        """
+        if self._pid != os.getpid():
+            self._open()
+        start = self.slots.get((family.name, labels))
+        if start is not None:
+            family.starts[labels] = start
+            return start
+
+        start = len(self.totals)
+        if start + family.size > self.capacity:
+            if not self._full:
+                print(f"Metrics file full, dropping new series of '{family.name}'.")
+                self._full = True
+            return None
+        self.totals.extend([0.0] * family.size)
+        self._keys_file.write(
+            json.dumps([start, family.size, family.name, list(labels)]) + "\n"
+        )
+        self.slots[(family.name, labels)] = start
+        family.starts[labels] = start
+        return start
+
+    def update(self, updates):
+        """
+        Applies (family, labels, value) updates, e.g. the counters & latencies
+        of a request, taking the lock once.
+        """
+        with self.lock:
+            for family, labels, value in updates:
+                family.add(labels, value)
+
+    def flush(self):
+        """
+        Copies this worker's totals to its file.
+
+        Totals of a process that forked without calling 'start' are dropped,
+        they'd be mixed with its parent's.
+        """
+        with self.lock:
+            if self._pid != os.getpid():
+                return
+            totals = array.array("d", self.totals)
+            self._values[: len(totals)] = totals
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def clear(self):
+        """
+        Deletes every worker's files, e.g. when the service starts.
+        """
+        with self.lock:
+            if self._keys_file is not None:
+                self._keys_file.close()
+            self.totals, self.slots, self._values = [], {}, None
+            for family in self.families.values():
+                family.starts = {}
+            self._keys_file, self._pid = None, None
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith((".keys", ".values")):
+                        os.remove(os.path.join(self.directory, name))
+
+    def collect(self):
+        """
+        Sums the series of every worker's files.
+
+        :return: Dict of (name, label values) to numpy arrays of slot values
+        """
+        series = {}
+        if not os.path.isdir(self.directory):
+            return series
+        for name in os.listdir(self.directory):
+            if not name.endswith(".keys"):
+                continue
+            keys_path, values_path = self._paths(name[: -len(".keys")])
+            keys = read_keys(keys_path)
+            try:
+                values = np.fromfile(values_path, dtype=np.float64)
+            except OSError:  # Cleared meanwhile
+                continue
+            for start, size, family, labels in keys:
+                key = (family, tuple(labels))
+                part = values[start : start + size]
+                series[key] = series[key] + part if key in series else part.copy()
+        return series
+
+    def exposition(self):
+        """
+        Returns the metrics of every worker in the Prometheus text format.
+        """
+        self.flush()
+        series = self.collect()
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            found = sorted(labels for name, labels in series if name == family.name)
+            for labels in found:
+                values = series[(family.name, labels)]
+                for name, labelnames, labelvalues, value in family.samples(
+                    labels, values
+                ):
+                    pairs = ",".join(
+                        f'{labelname}="{escape(labelvalue)}"'
+                        for labelname, labelvalue in zip(labelnames, labelvalues)
+                    )
+                    value = repr(float(value))
+                    lines.append(
+                        f"{name}{{{pairs}}} {value}" if pairs else f"{name} {value}"
+                    )
+        return "\n".join(lines) + "\n"
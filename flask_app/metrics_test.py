@@ -0,0 +1,151 @@
+# --------------------------------------------------------
+# TEST: Prometheus metrics, aggregated across processes
+# --------------------------------------------------------
+import os
+import time
+import multiprocessing
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def registry(tmp_path):
+    registry = metrics.Metrics(str(tmp_path))
+    registry.counter("requests_total", "Requests.", ["endpoint"])
+    registry.histogram("stage_seconds", "Stages.", ["stage"], buckets=(0.001, 0.01))
+    return registry
+
+
+def samples(registry):
+    # {sample with labels: value} of the exposition, without the comments
+    lines = registry.exposition().splitlines()
+    return dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+
+
+# Counters add up, histogram buckets are cumulative up to +Inf
+def test_exposition(registry):
+    requests, stages = registry.families.values()
+    requests.inc(("predict",))
+    requests.inc(("predict",), 2)
+    requests.inc(('say "hi"\n',))
+    for seconds in [0.0005, 0.001, 0.005, 0.5]:
+        stages.observe(("encode",), seconds)
+
+    text = registry.exposition()
+    assert "# HELP requests_total Requests.\n# TYPE requests_total counter\n" in text
+    assert "# TYPE stage_seconds histogram" in text
+    assert samples(registry) == {
+        'requests_total{endpoint="predict"}': "3.0",
+        'requests_total{endpoint="say \\"hi\\"\\n"}': "1.0",
+        'stage_seconds_bucket{stage="encode",le="0.001"}': "2.0",
+        'stage_seconds_bucket{stage="encode",le="0.01"}': "3.0",
+        'stage_seconds_bucket{stage="encode",le="+Inf"}': "4.0",
+        'stage_seconds_sum{stage="encode"}': repr(0.0005 + 0.001 + 0.005 + 0.5),
+        'stage_seconds_count{stage="encode"}': "4.0",
+    }
+
+
+def work(registry, requests):
+    registry.start()
+    requests_total, stages = registry.families.values()
+    for _ in range(requests):
+        requests_total.inc(("predict",))
+        stages.observe(("encode",), 0.002)
+    registry.flush()  # A worker's last second is lost if it exits unflushed
+
+
+# Every process writes its own file, the exposition sums them, and a cut
+# short line of a crashed process is skipped
+@pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(), reason="Needs fork"
+)
+def test_processes(registry):
+    work(registry, 10)  # Before the fork, like the uwsgi master
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=work, args=(registry, 100)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+
+    with open(os.path.join(registry.directory, "123.keys"), "w") as f:
+        f.write('[0, 1, "requests_total", ["pre')
+    assert samples(registry)['requests_total{endpoint="predict"}'] == "410.0"
+    assert samples(registry)['stage_seconds_count{stage="encode"}'] == "410.0"
+
+    registry.clear()
+    assert os.listdir(registry.directory) == []
+    work(registry, 1)
+    assert samples(registry)['requests_total{endpoint="predict"}'] == "1.0"
+
+
+# A restarted worker with the same pid carries on with its series
+def test_reopen(registry, tmp_path):
+    work(registry, 3)
+    again = metrics.Metrics(str(tmp_path))
+    again.counter("requests_total", "Requests.", ["endpoint"]).inc(("predict",))
+    assert samples(again)['requests_total{endpoint="predict"}'] == "4.0"
+
+
+# New series past the capacity are dropped, known ones are still counted
+def test_capacity(tmp_path):
+    registry = metrics.Metrics(str(tmp_path), capacity=2)
+    requests = registry.counter("requests_total", "Requests.", ["endpoint"])
+    for endpoint in ["a", "b", "c", "a"]:
+        requests.inc((endpoint,))
+    assert samples(registry) == {
+        'requests_total{endpoint="a"}': "2.0",
+        'requests_total{endpoint="b"}': "1.0",
+    }
+
+
+# Benchmark: the instrumentation of a /predict request, its stages (parse,
+# coerce, wait for the micro-batch) & its counters, and a micro-batch of 12
+# (encode, predict, inverse), the mean batch under load
+def test_overhead(registry):
+    requests, stages = registry.families.values()
+    latency = registry.histogram("request_seconds", "Requests.", ["endpoint"])
+
+    def batch():
+        timer = metrics.Stages(stages)
+        timer.lap("encode")
+        timer.lap("predict")
+        timer.lap("inverse")
+        timer.flush()
+
+    def request():
+        timer = metrics.Stages(stages)
+        timer.lap("parse")
+        timer.lap("coerce")
+        timer.lap("batch_wait")
+        timer.flush(
+            (requests, ("predict",), 1),
+            (latency, ("predict",), timer.elapsed()),
+        )
+
+    def timed(function, rounds=20000):
+        function()
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                function()
+            best = min(best, (time.perf_counter() - start) / rounds * 1e6)
+        return best
+
+    request_us, batch_us, nothing_us = timed(request), timed(batch), timed(lambda: None)
+
+    start = time.perf_counter()
+    for _ in range(20):
+        registry.exposition()
+    exposition_ms = (time.perf_counter() - start) / 20 * 1e3
+
+    print(
+        f"\nInstrumentation {request_us + batch_us / 12:.2f}µs per request "
+        f"(request {request_us:.2f}µs, batch {batch_us:.2f}µs, "
+        f"empty call {nothing_us * 1e3:.0f}ns), /metrics {exposition_ms:.2f}ms"
+    )
+    assert request_us + batch_us / 12 < 10
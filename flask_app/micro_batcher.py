@@ -0,0 +1,159 @@
+"""
+Micro-batching of concurrent single-listing predictions.
+
+Every '/predict' request pays the fixed cost of an encode and a
+'model.predict' call, for one row. 'MicroBatcher' queues the listings of
+concurrent requests in a worker and predicts them as one vectorized batch,
+once 'max_batch_size' listings are queued or the first one has waited
+'max_wait' seconds, then hands each request its own result. A request
+waits at most 'max_wait' longer when it has the worker to itself.
+
+'MicroBatcher' is for threaded workers (uwsgi 'threads', see `app.ini`);
+'AsyncMicroBatcher' does the same on an asyncio event loop, e.g. under an
+ASGI server.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import time
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# VARS -----------------------------------------
+
+# Listings predicted per batch
+MAX_BATCH_SIZE = 64
+
+# Seconds the first listing of a batch waits for others
+MAX_WAIT_SECONDS = 0.002
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def resolve(predict_many, batch, stats):
+    """
+    Predicts a batch of (item, future) pairs and sets every future.
+
+    If the batch fails, its items are retried one by one, so only the bad
+    ones fail.
+    """
+    stats["batches"] += 1
+    stats["items"] += len(batch)
+    try:
+        results = predict_many([item for item, _ in batch])
+    except Exception:
+        results = None
+        stats["failed_batches"] += 1
+
+    for i, (item, future) in enumerate(batch):
+        if future.done():  # Cancelled by the caller
+            continue
+        try:
+            result = results[i] if results is not None else predict_many([item])[0]
+        except Exception as err:
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+
+
+class MicroBatcher:
+    """
+    Batches items submitted from many threads, predicted on one background thread.
+
+    'stats' counts batches, items and failed batches; items / batches is
+    the mean batch size.
+    """
+
+    def __init__(
+        self, predict_many, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS
+    ):
+        """
+        :param predict_many: Function of a list of items returning a list of results
+        :param max_batch_size: Items predicted per batch
+        :param max_wait: Seconds the first item of a batch waits for others
+        """
+        self.predict_many = predict_many
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.stats = {"batches": 0, "items": 0, "failed_batches": 0}
+        self.lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """
+        Starts this process's batching thread, if it isn't running yet.
+
+        Threads don't survive a fork, so it is started by the first 'submit'
+        in each uwsgi worker.
+        """
+        if self._pid == os.getpid():
+            return
+        with self.lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, item, timeout=None):
+        """
+        Queues an item and waits for its result.
+
+        :raises Exception: The item's own prediction error
+        """
+        self.start()
+        future = Future()
+        self.queue.put((item, future))
+        return future.result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            resolve(self.predict_many, batch, self.stats)
+
+
+class AsyncMicroBatcher:
+    """
+    'MicroBatcher' for an asyncio event loop, without a thread.
+
+    Batches are predicted on the event loop, which is busy for the length
+    of a batch, like it would be for each request without batching.
+    """
+
+    def __init__(
+        self, predict_many, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT_SECONDS
+    ):
+        self.predict_many = predict_many
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.stats = {"batches": 0, "items": 0, "failed_batches": 0}
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        resolve(self.predict_many, batch, self.stats)
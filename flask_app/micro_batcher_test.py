@@ -0,0 +1,144 @@
+# --------------------------------------------------------
+# TEST: Micro-batching scheduler
+# --------------------------------------------------------
+import time
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+import app as service
+import flat_forest
+import predictor
+from compiled_encoder import CompiledEncoder
+from conftest import make_listings
+from micro_batcher import AsyncMicroBatcher, MicroBatcher
+from model_store import LoadedModel
+from prediction_cache import PredictionCache
+
+
+def double_all(items):
+    # Fails the whole batch on a bad item, like an encoder would
+    if any(item < 0 for item in items):
+        raise ValueError("Negative item")
+    return [item * 2 for item in items]
+
+
+def submit_all(batcher, items):
+    results = [None] * len(items)
+
+    def submit(i):
+        try:
+            results[i] = batcher.submit(items[i], timeout=5)
+        except Exception as err:
+            results[i] = err
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(items))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Full batches are flushed without waiting, a lone item waits 'max_wait'
+def test_micro_batcher_flush(listings):
+    batcher = MicroBatcher(double_all, max_batch_size=4, max_wait=10)
+    start = time.perf_counter()
+    assert submit_all(batcher, list(range(8))) == [i * 2 for i in range(8)]
+    assert time.perf_counter() - start < 5
+    assert batcher.stats == {"batches": 2, "items": 8, "failed_batches": 0}
+
+    batcher = MicroBatcher(double_all, max_batch_size=4, max_wait=0.05)
+    start = time.perf_counter()
+    assert batcher.submit(21) == 42
+    assert time.perf_counter() - start >= 0.05
+
+
+# A bad item only fails its own request
+def test_micro_batcher_errors():
+    batcher = MicroBatcher(double_all, max_batch_size=3, max_wait=10)
+    results = submit_all(batcher, [1, -1, 2])
+    assert results[0] == 2 and results[2] == 4
+    assert isinstance(results[1], ValueError)
+    assert batcher.stats["failed_batches"] == 1
+
+
+# The asyncio variant batches the same way
+def test_async_micro_batcher():
+    batcher = AsyncMicroBatcher(double_all, max_batch_size=4, max_wait=0.01)
+
+    async def main():
+        return await asyncio.gather(
+            *(batcher.submit(item) for item in [1, 2, 3, 4, 5, -1]),
+            return_exceptions=True,
+        )
+
+    results = asyncio.run(main())
+    assert results[:5] == [2, 4, 6, 8, 10]
+    assert isinstance(results[5], ValueError)
+    assert batcher.stats["batches"] == 2
+
+
+# Batched prices match single-listing prices, across two model versions
+def test_predict_listings(model, encoder, listings):
+    compiled = CompiledEncoder(encoder)
+    first = LoadedModel(model, encoder, compiled, "v1")
+    second = LoadedModel(model, encoder, None, "v2")
+    data = [predictor.coerce(listing) for listing in listings[:6]]
+
+    prices = service.predict_listings(
+        [(first if i % 2 else second, listing) for i, listing in enumerate(data)]
+    )
+    expected = [predictor.predict_one(model, compiled, listing) for listing in data]
+    np.testing.assert_allclose(prices, expected, rtol=1e-9)
+
+
+def load_test(listings, clients, seconds):
+    # Concurrent clients posting listings to /predict, for 'seconds'
+    latencies = []
+    stop = time.perf_counter() + seconds
+
+    def run(offset):
+        client = service.app.test_client()
+        i = offset
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            response = client.post("/predict", json=listings[i % len(listings)])
+            latencies.append(time.perf_counter() - start)
+            assert "prediction_price" in response.get_json()
+            i += clients
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies) / seconds, np.percentile(latencies, 99) * 1e3
+
+
+# Load test of /predict with the served model's shape, 32 concurrent clients
+# in one worker, with & without micro-batching
+def test_micro_batching_load(monkeypatch, encoder, serving_model):
+    forest = flat_forest.export_forest(serving_model)
+    loaded = LoadedModel(forest, encoder, CompiledEncoder(encoder), "load")
+    monkeypatch.setattr(service.store, "current", loaded)
+    monkeypatch.setattr(service.store, "reload_seconds", 0)
+    monkeypatch.setattr(service, "cache", PredictionCache(capacity=0))
+    monkeypatch.setattr(service, "batcher", MicroBatcher(service.predict_listings))
+    listings = make_listings(5000, seed=5).drop(columns="SALE PRICE").to_dict("records")
+
+    results = {}
+    for batching in (False, True):
+        monkeypatch.setattr(service, "MICRO_BATCHING", batching)
+        results[batching] = load_test(listings, clients=32, seconds=2)
+
+    stats = service.batcher.stats
+    print(
+        f"\nOff: {results[False][0]:.0f} requests/s, p99 {results[False][1]:.1f}ms. "
+        f"On: {results[True][0]:.0f} requests/s, p99 {results[True][1]:.1f}ms, "
+        f"mean batch {stats['items'] / stats['batches']:.1f}"
+    )
+    assert stats["items"] > stats["batches"]
+    assert results[True][1] < results[False][1]
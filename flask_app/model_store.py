@@ -0,0 +1,172 @@
+"""
+Model loading and hot reload for the Flask service.
+
+'ModelStore.current' is an immutable 'LoadedModel'. A request reads it
+once and uses that model, encoder and version throughout, and a reload
+replaces it with a single assignment, so in-flight requests finish on the
+old model and no request is dropped or mixes two versions.
+
+The flat forest is memory-mapped, so the uwsgi workers share one copy of
+the node tables through the page cache instead of holding a private copy
+each. A joblib model is loaded with 'mmap_mode="r"' too, but sklearn
+copies its tree nodes out of the mapped arrays, so only the flat forest
+is shared.
+
+A watcher thread per worker polls the published version (see
+`model_artifacts.py`) and loads a new one in the background. Files copied
+straight into the model folder are picked up too, by their modification
+times. uwsgi only runs the thread with 'enable-threads', see `app.ini`.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import time
+import hashlib
+import threading
+from collections import namedtuple
+
+# MODEL PACKAGING
+import joblib
+
+# PROJECT MODULES
+import compiled_encoder
+import flat_forest  # Mounted from `project/`, see `compose.yaml`
+import model_artifacts  # Mounted from `project/`, see `compose.yaml`
+
+# VARS -----------------------------------------
+
+MODEL_DIR = "./model"
+
+# Seconds between checks for a new model version
+RELOAD_SECONDS = 5
+
+LoadedModel = namedtuple("LoadedModel", ["model", "encoder", "compiled", "version"])
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def artifact_version(*paths):
+    """
+    Returns a short version id of model files, from their sizes & modification times.
+    """
+    stats = [(os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths]
+    return hashlib.sha1(repr(stats).encode()).hexdigest()[:12]
+
+
+def find_model(model_dir):
+    """
+    Returns the (folder, version) of the model to serve.
+
+    :param model_dir: Model folder, with a published version or copied files
+    :raises OSError: If there are no model files
+    """
+    version = model_artifacts.current_version(model_dir)
+    if version is not None:
+        return model_artifacts.version_dir(model_dir, version), version
+
+    forest = os.path.join(model_dir, model_artifacts.FOREST_DIR)
+    if os.path.isdir(forest):
+        model_file = os.path.join(forest, flat_forest.META_FILE)
+    else:
+        model_file = os.path.join(model_dir, model_artifacts.MODEL_FILE)
+    encoder_file = os.path.join(model_dir, model_artifacts.ENCODER_FILE)
+    return model_dir, artifact_version(model_file, encoder_file)
+
+
+def load_model(folder, version, mmap_mode="r"):
+    """
+    Loads a model folder, the flat forest if it was exported.
+
+    :param folder: Folder of the model files, see 'find_model'
+    :param version: Version of the files, used in the prediction cache keys
+    :param mmap_mode: Memory-maps the arrays if 'r', None reads them into memory
+    :return: LoadedModel
+    """
+    forest = os.path.join(folder, model_artifacts.FOREST_DIR)
+    if os.path.isdir(forest):
+        model = flat_forest.FlatForest.load(forest, mmap_mode=mmap_mode)
+    else:
+        model = joblib.load(
+            os.path.join(folder, model_artifacts.MODEL_FILE), mmap_mode=mmap_mode
+        )
+    encoder = joblib.load(os.path.join(folder, model_artifacts.ENCODER_FILE))
+
+    # Pandas-free single-listing path, see `compiled_encoder.py`
+    try:
+        compiled = compiled_encoder.CompiledEncoder(encoder)
+    except ValueError as err:
+        print(f"Encoder not compiled, using the ColumnTransformer: {err}")
+        compiled = None
+    return LoadedModel(model, encoder, compiled, version)
+
+
+class ModelStore:
+    """
+    The served model of one worker, reloaded when a new version is published.
+
+    'stats' counts loads and failed loads. A failed load keeps the current
+    model; 'error' is only set while there is no model at all.
+    """
+
+    def __init__(
+        self, model_dir=MODEL_DIR, reload_seconds=RELOAD_SECONDS, mmap_mode="r"
+    ):
+        """
+        :param model_dir: Model folder, e.g. the shared docker volume
+        :param reload_seconds: Seconds between checks for a new version, 0 to never check
+        :param mmap_mode: See 'load_model'
+        """
+        self.model_dir = model_dir
+        self.reload_seconds = reload_seconds
+        self.mmap_mode = mmap_mode
+        self.current = None
+        self.error = None
+        self.stats = {"loads": 0, "failed_loads": 0}
+        self.lock = threading.Lock()
+        self._watcher_pid = None
+        self.reload()
+
+    def reload(self):
+        """
+        Loads the model if its version changed.
+
+        :return: True if a new model was swapped in
+        """
+        with self.lock:
+            try:
+                folder, version = find_model(self.model_dir)
+                if self.current is not None and self.current.version == version:
+                    return False
+                loaded = load_model(folder, version, self.mmap_mode)
+            except Exception as err:
+                self.stats["failed_loads"] += 1
+                if self.current is None:
+                    self.error = "Model or encoder files not found."
+                if self.current is not None or self.stats["failed_loads"] == 1:
+                    print(f"Model not loaded from '{self.model_dir}': {err}")
+                return False
+
+            self.current = loaded
+            self.error = None
+            self.stats["loads"] += 1
+            print(f"Loaded model version '{version}' in process {os.getpid()}.")
+            return True
+
+    def watch(self):
+        """
+        Starts this process's watcher thread, if it isn't running yet.
+
+        Threads don't survive a fork, so call it in the worker, e.g. before
+        every request, rather than when the app is imported by the uwsgi master.
+        """
+        if not self.reload_seconds or self._watcher_pid == os.getpid():
+            return
+        with self.lock:
+            if self._watcher_pid != os.getpid():
+                self._watcher_pid = os.getpid()
+                threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.reload_seconds)
+            self.reload()
@@ -0,0 +1,225 @@
+# --------------------------------------------------------
+# TEST: Model loading & hot reload
+# --------------------------------------------------------
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+import flat_forest
+import model_artifacts
+import predictor
+from conftest import make_listings
+from model_store import ModelStore
+
+
+# A published version is memory-mapped, a new one is swapped in, and a
+# request still holding the old model can finish after it was pruned
+def test_store_reload(tmp_path, model, encoder, listings):
+    model_dir = str(tmp_path / "model")
+    first = model_artifacts.publish(model_dir, model, encoder, keep_versions=0)
+    store = ModelStore(model_dir, reload_seconds=0)
+    old = store.current
+
+    assert old.version == first
+    assert isinstance(old.model, flat_forest.FlatForest)
+    assert isinstance(old.model.threshold, np.memmap)
+    assert store.reload() is False
+
+    second = model_artifacts.publish(model_dir, model, encoder, keep_versions=0)
+    assert store.reload() is True
+    assert store.current.version == second
+    assert not os.path.exists(model_artifacts.version_dir(model_dir, first))
+
+    data = predictor.coerce(listings[0])
+    assert predictor.predict_one(old.model, old.compiled, data) == pytest.approx(
+        predictor.predict_one(store.current.model, store.current.compiled, data)
+    )
+    assert store.stats == {"loads": 2, "failed_loads": 0}
+
+
+# A broken version keeps the current model, no model at all sets 'error'
+def test_store_failed_reload(tmp_path, model, encoder):
+    model_dir = str(tmp_path / "model")
+    model_artifacts.publish(model_dir, model, encoder)
+    store = ModelStore(model_dir, reload_seconds=0)
+    loaded = store.current
+
+    with open(os.path.join(model_dir, "CURRENT"), "w") as f:
+        f.write("missing")
+    assert store.reload() is False
+    assert store.current is loaded and store.error is None
+    assert store.stats["failed_loads"] == 1
+
+    empty = ModelStore(str(tmp_path / "empty"), reload_seconds=0)
+    assert empty.current is None
+    assert empty.error == "Model or encoder files not found."
+
+
+# Files copied straight into the folder are versioned by modification time
+def test_store_copied_files(tmp_path, model, encoder):
+    joblib.dump(model, str(tmp_path / "model.joblib"))
+    joblib.dump(encoder, str(tmp_path / "preprocessor.joblib"))
+    store = ModelStore(str(tmp_path), reload_seconds=0)
+    assert isinstance(store.current.model, RandomForestRegressor)
+
+    version = store.current.version
+    flat_forest.export_forest(model).save(str(tmp_path / "forest"))
+    assert store.reload() is True
+    assert store.current.version != version
+    assert isinstance(store.current.model, flat_forest.FlatForest)
+
+
+# The watcher thread picks up a new version by itself
+def test_store_watch(tmp_path, model, encoder):
+    model_dir = str(tmp_path / "model")
+    model_artifacts.publish(model_dir, model, encoder)
+    store = ModelStore(model_dir, reload_seconds=0.05)
+    store.watch()
+    store.watch()  # Once per process
+
+    version = model_artifacts.publish(model_dir, model, encoder)
+    deadline = time.time() + 5
+    while store.current.version != version and time.time() < deadline:
+        time.sleep(0.01)
+    assert store.current.version == version
+    assert threading.active_count() >= 2
+
+
+WORKER_SCRIPT = """
+import sys
+import numpy as np
+import sklearn.ensemble  # Not counted
+import model_store
+
+def memory():
+    with open("/proc/self/smaps_rollup") as f:
+        fields = dict(line.split()[:2] for line in f if line.split()[0][-1] == ":")
+    return np.array([int(fields["Rss:"]), int(fields["Pss:"])]) * 1024
+
+before = memory()
+mmap_mode = None if sys.argv[2] == "none" else sys.argv[2]
+loaded = model_store.load_model(sys.argv[1], "bench", mmap_mode)
+for rows in np.array_split(np.load(sys.argv[3]), 40):  # Small temporaries
+    loaded.model.predict(rows)
+print(*(memory() - before), flush=True)
+sys.stdin.read()  # Stay alive until every worker has measured
+"""
+
+
+def worker_memory(folder, mmap_mode, rows_path, workers=5):
+    # Rss & Pss each of 'workers' concurrent processes gains by loading the model
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-c",
+                WORKER_SCRIPT,
+                folder,
+                mmap_mode or "none",
+                rows_path,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        for _ in range(workers)
+    ]
+    results = [
+        list(map(int, process.stdout.readline().split())) for process in processes
+    ]
+    for process in processes:
+        process.communicate(b"")
+    return np.mean(results, axis=0)
+
+
+def percentile_ms(latencies, q):
+    return np.percentile(latencies, q) * 1e3 if latencies else float("nan")
+
+
+# Benchmark with the serving model's shape, 200 trees of depth 10:
+# memory of 5 workers, and request latency while a new version is swapped in
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/smaps_rollup"), reason="Linux 4.14+ only"
+)
+def test_store_benchmark(tmp_path, encoder, serving_model):
+    model = serving_model
+    X = np.delete(
+        encoder.transform(make_listings(2000, seed=4)), predictor.TARGET_INDEX, axis=1
+    )
+
+    model_dir = str(tmp_path / "model")
+    model_artifacts.publish(model_dir, model, encoder)
+    folder = model_artifacts.version_dir(
+        model_dir, model_artifacts.current_version(model_dir)
+    )
+    joblib.dump(model, str(tmp_path / "model.joblib"))
+    joblib.dump(encoder, str(tmp_path / "preprocessor.joblib"))
+    np.save(str(tmp_path / "rows.npy"), X)
+    rows_path = str(tmp_path / "rows.npy")
+
+    memory = {
+        "sklearn": worker_memory(str(tmp_path), None, rows_path),
+        "flat": worker_memory(folder, None, rows_path),
+        "flat, mmap": worker_memory(folder, "r", rows_path),
+    }
+
+    # Requests in a loop, while the main thread swaps in new versions
+    store = ModelStore(model_dir, reload_seconds=0)
+    data = predictor.coerce(
+        make_listings(1, seed=3).drop(columns="SALE PRICE").to_dict("records")[0]
+    )
+    # Requests that overlap a publish (the processor's work) aren't counted
+    phase = ["steady"]
+    latencies = {"steady": [], "reload": []}
+
+    def requests():
+        while phase[0] != "done":
+            before = phase[0]
+            start = time.perf_counter()
+            loaded = store.current
+            predictor.predict_one(loaded.model, loaded.compiled, data)
+            seconds = time.perf_counter() - start
+            if "reload" in (before, phase[0]):
+                latencies["reload"].append(seconds)
+            elif before == phase[0] == "steady":
+                latencies["steady"].append(seconds)
+
+    thread = threading.Thread(target=requests)
+    thread.start()
+    reload_seconds = []
+    for _ in range(5):
+        time.sleep(0.2)
+        phase[0] = "publish"
+        model_artifacts.publish(model_dir, model, encoder)
+        phase[0] = "reload"
+        start = time.perf_counter()
+        assert store.reload() is True
+        reload_seconds.append(time.perf_counter() - start)
+        phase[0] = "steady"
+    time.sleep(0.2)
+    phase[0] = "done"
+    thread.join()
+
+    print()
+    for name, (rss, pss) in memory.items():
+        print(
+            f"{name}: per worker Rss +{rss / 2**20:.1f}MiB, Pss +{pss / 2**20:.1f}MiB"
+        )
+    print(
+        f"Reload {np.mean(reload_seconds) * 1e3:.1f}ms. Request p50/p99/max: "
+        f"steady {percentile_ms(latencies['steady'], 50):.2f}/"
+        f"{percentile_ms(latencies['steady'], 99):.2f}/"
+        f"{max(latencies['steady']) * 1e3:.2f}ms, during reloads "
+        f"{len(latencies['reload'])} requests, max "
+        f"{max(latencies['reload'], default=0) * 1e3:.2f}ms"
+    )
+    assert memory["flat, mmap"][1] < memory["flat"][1] < memory["sklearn"][1]
+    assert store.stats["failed_loads"] == 0
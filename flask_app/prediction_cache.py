@@ -0,0 +1,112 @@
+"""
+Bounded in-process cache of predicted prices.
+
+The same listings are scored again and again (the same building, with the
+same square footage and coordinates), so prices are cached per uwsgi
+worker in an LRU. Keys are canonical listings: the typed feature values,
+with the coordinates rounded to 'precision' decimals, plus the model
+version, so loading a new model never serves an old price. Listings are
+predicted from their canonical values, so a cached price is exactly the
+price the listing would get.
+"""
+
+# OPERATING SYSTEM STUFF
+import threading
+from collections import OrderedDict
+
+# PROJECT MODULES
+import predictor
+
+# VARS -----------------------------------------
+
+# Prices kept per worker, a key and price take ~350 bytes
+PREDICTION_CACHE_SIZE = 100000
+
+# Decimals the coordinates are rounded to, 5 is ~1 m
+COORDINATE_PRECISION = 5
+
+# Key columns, every feature but the price
+KEY_COLUMNS = [column for column in predictor.FEATURE_COLUMNS if column != "SALE PRICE"]
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+class PredictionCache:
+    """
+    LRU of prices keyed on (model version, canonical listing).
+
+    'stats' counts hits, misses and evictions, to size 'capacity' from
+    real traffic. Safe to share between threads.
+    """
+
+    def __init__(self, capacity=PREDICTION_CACHE_SIZE, precision=COORDINATE_PRECISION):
+        """
+        :param capacity: Prices kept, 0 disables the cache
+        :param precision: Decimals the coordinates are rounded to, None to keep them
+        """
+        self.capacity = capacity
+        self.precision = precision
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def canonical(self, data):
+        """
+        Returns a coerced listing with only its features and rounded coordinates.
+
+        :param data: Coerced listing dict, see 'predictor.coerce'
+        """
+        canonical = {column: data.get(column) for column in KEY_COLUMNS}
+        if self.precision is not None:
+            for column in predictor.FLOAT_COLUMNS:
+                if canonical[column] is not None:
+                    canonical[column] = round(canonical[column], self.precision)
+        return canonical
+
+    def key(self, canonical, model_version):
+        return (model_version,) + tuple(canonical[column] for column in KEY_COLUMNS)
+
+    def get(self, key):
+        """
+        Returns the cached price of a key, or None on a miss.
+        """
+        with self.lock:
+            price = self.memory.get(key)
+            if price is None:
+                self.stats["misses"] += 1
+                return None
+            self.memory.move_to_end(key)
+            self.stats["hits"] += 1
+            return price
+
+    def put(self, key, price):
+        with self.lock:
+            self.memory[key] = price
+            self.memory.move_to_end(key)
+            if len(self.memory) > self.capacity:
+                self.memory.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def predict(self, data, model_version, predict):
+        """
+        Returns the price of a listing, calling 'predict' on a miss.
+
+        :param data: Coerced listing dict, see 'predictor.coerce'
+        :param model_version: Version of the model 'predict' uses
+        :param predict: Function of a coerced listing dict returning its price
+        :return: The price
+        """
+        canonical = self.canonical(data)
+        key = self.key(canonical, model_version)
+        price = self.get(key)
+        if price is None:
+            price = predict(canonical)
+            self.put(key, price)
+        return price
+
+    def info(self):
+        """
+        Returns the counters, size and capacity, e.g. for a JSON endpoint.
+        """
+        with self.lock:
+            return dict(self.stats, size=len(self.memory), capacity=self.capacity)
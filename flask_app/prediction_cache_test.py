@@ -0,0 +1,89 @@
+# --------------------------------------------------------
+# TEST: Prediction cache
+# --------------------------------------------------------
+import time
+
+import pytest
+
+import predictor
+from compiled_encoder import CompiledEncoder
+from prediction_cache import PredictionCache
+
+
+# Nearby coordinates & extra fields share a key, the model version doesn't
+def test_cache_keys(listings):
+    cache = PredictionCache(precision=3)
+    data = predictor.coerce(listings[0])
+    nearby = dict(data, LATITUDE=data["LATITUDE"] + 1e-5, extra="ignored")
+
+    key = cache.key(cache.canonical(data), "v1")
+    assert cache.key(cache.canonical(nearby), "v1") == key
+    assert cache.key(cache.canonical(data), "v2") != key
+    assert cache.canonical(data)["LATITUDE"] == round(data["LATITUDE"], 3)
+
+    exact = PredictionCache(precision=None)
+    assert exact.canonical(data)["LATITUDE"] == data["LATITUDE"]
+
+
+# Misses are predicted from the canonical listing, the oldest price is evicted
+def test_cache_predict_and_evict(listings):
+    cache = PredictionCache(capacity=2)
+    calls = []
+
+    def predict(data):
+        calls.append(data)
+        return data["GROSS SQUARE FEET"] * 100.0
+
+    data = [predictor.coerce(listing) for listing in listings[:3]]
+    for listing in data + data[2:] + data[:1]:
+        cache.predict(listing, "v1", predict)
+
+    assert cache.info() == {
+        "hits": 1,
+        "misses": 4,
+        "evictions": 2,
+        "size": 2,
+        "capacity": 2,
+    }
+    assert [call["GROSS SQUARE FEET"] for call in calls] == [
+        listing["GROSS SQUARE FEET"] for listing in data + data[:1]
+    ]
+    assert calls[0] == cache.canonical(data[0])
+
+
+# Batches predict the misses only, with the same prices
+def test_cache_predict_batch(model, encoder, listings):
+    cache = PredictionCache()
+    expected = predictor.predict_batch(model, encoder, listings[:10], cache=cache)
+    assert cache.info()["misses"] == 10
+
+    results = predictor.predict_batch(
+        model, encoder, listings[:20] + [{"LATITUDE": "x"}], cache=cache
+    )
+    assert results[:10] == expected
+    assert results[20]["error_type"] == "ValueError"
+    assert (cache.info()["hits"], cache.info()["misses"]) == (10, 20)
+
+
+# Single-listing latency of a hit against a miss
+def test_cache_latency(model, encoder, listings):
+    cache = PredictionCache()
+    compiled = CompiledEncoder(encoder)
+
+    def predict(data):
+        return predictor.predict_one(model, compiled, data)
+
+    data = [predictor.coerce(listing) for listing in listings]
+    start = time.perf_counter()
+    for listing in data:
+        cache.predict(listing, "v1", predict)
+    miss = (time.perf_counter() - start) / len(data)
+
+    start = time.perf_counter()
+    for listing in data:
+        cache.predict(listing, "v1", predict)
+    hit = (time.perf_counter() - start) / len(data)
+
+    print(f"\nOne listing: miss {miss * 1e6:.0f}us, hit {hit * 1e6:.1f}us")
+    assert cache.info()["hits"] == len(data)
+    assert hit * 10 < miss
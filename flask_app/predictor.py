@@ -0,0 +1,234 @@
+"""
+Vectorized price prediction for the Flask service.
+
+Listings are coerced to the request types one by one, so a bad listing only
+fails itself, then every valid listing goes through one 'encoder.transform'
+and one 'model.predict' call.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# VARS -----------------------------------------
+
+# Columns the encoder was fitted on, in order
+FEATURE_COLUMNS = [
+    "BOROUGH CODE",
+    "GROSS SQUARE FEET",
+    "LAND SQUARE FEET",
+    "GROUPED CATEGORY",
+    "LATITUDE",
+    "LONGITUDE",
+    "SALE PRICE",
+]
+INT_COLUMNS = ["BOROUGH CODE", "GROSS SQUARE FEET", "LAND SQUARE FEET"]
+FLOAT_COLUMNS = ["LATITUDE", "LONGITUDE"]
+
+# Position of the target ('SALE PRICE') in the encoded features
+TARGET_INDEX = 4
+
+# Listings encoded and predicted per call, bounds the memory of a large batch
+BATCH_CHUNKSIZE = 10000
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def lap(stages, stage):
+    """
+    Ends a timed stage of a prediction, if it is timed (see 'metrics.Stages').
+    """
+    if stages is not None:
+        stages.lap(stage)
+
+
+def error_response(err):
+    """
+    Returns the JSON error body of an exception.
+    """
+    return {"error_message": str(err), "error_type": err.__class__.__name__}
+
+
+def coerce(data):
+    """
+    Converts a listing's values to the types the encoder expects.
+
+    :param data: Listing dict, e.g. from a JSON request body
+    :return: A copy with integer and float columns converted
+    :raises TypeError: If the listing isn't a JSON object
+    :raises ValueError: If a value can't be converted
+    """
+    if not isinstance(data, dict):
+        raise TypeError(f"Expected a JSON object, got {type(data).__name__}")
+    data = dict(data)
+    for key in data:
+        if key in INT_COLUMNS:
+            data[key] = int(data[key])
+        elif key in FLOAT_COLUMNS:
+            data[key] = float(data[key])
+    return data
+
+
+def validate(data, compiled=None):
+    """
+    Rejects a coerced listing that would fail its whole chunk in 'predict_batch'.
+
+    :param data: Coerced listing dict, see 'coerce'
+    :param compiled: Optional 'compiled_encoder.CompiledEncoder', to check the
+                     categories against the fitted ones
+    :raises ValueError: On a non-finite number or an unknown category
+    """
+    for key in FLOAT_COLUMNS:
+        value = data.get(key)
+        if value is not None and not math.isfinite(value):
+            raise ValueError(f"'{key}' must be a finite number, got {value}")
+    if compiled is None:
+        return
+    for column, positions in compiled.categories.items():
+        value = data.get(column)
+        if value not in positions and not compiled.ignore_unknown[column]:
+            raise ValueError(
+                f"Found unknown categories [{value!r}] in column '{column}' "
+                f"during transform"
+            )
+
+
+def predict_prices(model, encoder, listings, stages=None):
+    """
+    Predicts the prices of coerced listings with one transform and one predict call.
+
+    :param model: Fitted regressor, predicting the scaled price
+    :param encoder: Fitted ColumnTransformer, its first transformer scales the price
+    :param listings: List of coerced listing dicts, see 'coerce'
+    :param stages: Optional 'metrics.Stages' timing the call
+    :return: numpy array of prices
+    """
+    frame = pd.DataFrame(listings, columns=FEATURE_COLUMNS)
+    lap(stages, "dataframe")
+    features = encoder.transform(frame)
+    lap(stages, "encode")
+
+    # Delete the target (price) & predict its scaled value
+    predictions = model.predict(np.delete(features, TARGET_INDEX, axis=1))
+    lap(stages, "predict")
+
+    # Inverse-scale the price column only
+    scaled = np.zeros((len(predictions), TARGET_INDEX + 1))
+    scaled[:, TARGET_INDEX] = predictions
+    prices = encoder.transformers_[0][1].inverse_transform(scaled)[:, TARGET_INDEX]
+    lap(stages, "inverse")
+    return prices
+
+
+def predict_one(model, compiled, data, stages=None):
+    """
+    Predicts one coerced listing's price, without pandas or the ColumnTransformer.
+
+    :param model: Fitted regressor, see 'predict_prices'
+    :param compiled: 'compiled_encoder.CompiledEncoder' of the fitted encoder
+    :param data: Coerced listing dict, see 'coerce'
+    :param stages: Optional 'metrics.Stages' timing the call
+    :return: The price
+    """
+    features = compiled.transform_one(data)
+    lap(stages, "encode")
+    prediction = model.predict(features)
+    lap(stages, "predict")
+    price = compiled.inverse_price(prediction[0])
+    lap(stages, "inverse")
+    return price
+
+
+def predict_compiled(model, compiled, listings, stages=None):
+    """
+    Predicts the prices of coerced listings with a 'CompiledEncoder', in one call.
+
+    :return: numpy array of prices
+    """
+    features = compiled.transform_many(listings)
+    lap(stages, "encode")
+    predictions = model.predict(features)
+    lap(stages, "predict")
+    prices = compiled.inverse_price(predictions)
+    lap(stages, "inverse")
+    return prices
+
+
+def predict_chunk(model, encoder, chunk, results, stages=None):
+    """
+    Predicts a chunk of (index, coerced listing) pairs into 'results'.
+
+    If the chunk fails, its halves are retried, so a bad listing costs a
+    few calls on ever smaller halves instead of one call per listing.
+
+    :return: List of the (index, listing, price) that were predicted
+    """
+    try:
+        prices = predict_prices(model, encoder, [data for _, data in chunk], stages)
+    except Exception as err:
+        if len(chunk) == 1:
+            results[chunk[0][0]] = error_response(err)
+            return []
+        middle = len(chunk) // 2
+        return predict_chunk(model, encoder, chunk[:middle], results) + predict_chunk(
+            model, encoder, chunk[middle:], results
+        )
+    return [(i, data, price) for (i, data), price in zip(chunk, prices)]
+
+
+def predict_batch(
+    model,
+    encoder,
+    listings,
+    chunksize=BATCH_CHUNKSIZE,
+    cache=None,
+    model_version=None,
+    stages=None,
+    compiled=None,
+):
+    """
+    Predicts a batch of listings, with a result or an error per listing.
+
+    A listing that fails type coercion or 'validate' gets its own error.
+    If encoding or predicting a chunk still fails, it is split in halves
+    until only the bad listings fail, see 'predict_chunk'.
+
+    :param model: Fitted regressor, see 'predict_prices'
+    :param encoder: Fitted ColumnTransformer, see 'predict_prices'
+    :param listings: List of listing dicts, e.g. from a JSON request body
+    :param chunksize: Listings per transform and predict call
+    :param cache: Optional 'prediction_cache.PredictionCache', only misses are predicted
+    :param model_version: Version of 'model' in the cache keys
+    :param stages: Optional 'metrics.Stages' timing the batch
+    :param compiled: Optional 'compiled_encoder.CompiledEncoder' of 'encoder',
+                     rejects unknown categories before predicting
+    :return: List of {"prediction_price": int} or error dicts, in listing order
+    """
+    results = [None] * len(listings)
+    valid = []
+    for i, data in enumerate(listings):
+        try:
+            data = coerce(data)
+            validate(data, compiled)
+            if cache is not None:
+                data = cache.canonical(data)
+                price = cache.get(cache.key(data, model_version))
+                if price is not None:
+                    results[i] = {"prediction_price": int(price)}
+                    continue
+            valid.append((i, data))
+        except Exception as err:
+            results[i] = error_response(err)
+    lap(stages, "coerce")
+
+    for start in range(0, len(valid), chunksize):
+        chunk = valid[start : start + chunksize]
+        for i, data, price in predict_chunk(model, encoder, chunk, results, stages):
+            try:
+                results[i] = {"prediction_price": int(price)}
+                if cache is not None:
+                    cache.put(cache.key(data, model_version), price)
+            except Exception as err:
+                results[i] = error_response(err)
+    return results
@@ -0,0 +1,94 @@
+# --------------------------------------------------------
+# TEST: Vectorized price prediction
+# --------------------------------------------------------
+import time
+
+import pytest
+
+import predictor
+from compiled_encoder import CompiledEncoder
+
+
+# A batch predicts the same prices as one listing at a time
+def test_predict_batch_matches_single(model, encoder, listings):
+    results = predictor.predict_batch(model, encoder, listings)
+
+    single = [
+        int(predictor.predict_prices(model, encoder, [predictor.coerce(data)])[0])
+        for data in listings
+    ]
+    assert [result["prediction_price"] for result in results] == single
+
+
+# Bad listings fail alone, in coercion or in encoding
+def test_predict_batch_errors(model, encoder, listings):
+    batch = [
+        listings[0],
+        dict(listings[1], **{"GROSS SQUARE FEET": "big"}),
+        "not a listing",
+        dict(listings[2], **{"GROUPED CATEGORY": "Castle"}),  # Unknown category
+        listings[3],
+    ]
+
+    results = predictor.predict_batch(model, encoder, batch, chunksize=3)
+
+    assert [result.get("error_type") for result in results] == [
+        None,
+        "ValueError",
+        "TypeError",
+        "ValueError",
+        None,
+    ]
+    assert results[4]["prediction_price"] == (
+        predictor.predict_batch(model, encoder, [listings[3]])[0]["prediction_price"]
+    )
+
+
+# Unknown categories & non-finite numbers are rejected before predicting, and
+# a chunk that still fails is split in halves, not retried row by row
+def test_predict_batch_bad_chunk(model, encoder, listings, monkeypatch):
+    batch = listings * 100
+    batch[10] = dict(batch[10], **{"GROUPED CATEGORY": "Castle"})
+    batch[20] = dict(batch[20], **{"LATITUDE": float("nan")})
+    batch[30] = dict(batch[30], **{"LONGITUDE": "inf"})
+    calls = []
+    predict_prices = predictor.predict_prices
+
+    def counted(model, encoder, listings, stages=None):
+        calls.append(len(listings))
+        return predict_prices(model, encoder, listings, stages)
+
+    monkeypatch.setattr(predictor, "predict_prices", counted)
+    results = predictor.predict_batch(
+        model, encoder, batch, compiled=CompiledEncoder(encoder)
+    )
+    assert [i for i, result in enumerate(results) if "error_type" in result] == [
+        10,
+        20,
+        30,
+    ]
+    assert calls == [len(batch) - 3]
+
+    # Without the compiled encoder the unknown category fails in the encoder
+    calls.clear()
+    results = predictor.predict_batch(model, encoder, batch)
+    assert results[10]["error_type"] == "ValueError"
+    assert sum("error_type" in result for result in results) == 3
+    assert len(calls) < 30
+
+
+# Throughput of one batch call vs one call per listing
+def test_predict_batch_throughput(model, encoder, listings):
+    batch = listings * 20
+
+    start = time.perf_counter()
+    for data in batch[:200]:
+        predictor.predict_batch(model, encoder, [data])
+    single_rate = 200 / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    predictor.predict_batch(model, encoder, batch)
+    batch_rate = len(batch) / (time.perf_counter() - start)
+
+    print(f"\nOne per call: {single_rate:.0f} rows/s, batched: {batch_rate:.0f} rows/s")
+    assert batch_rate > 10 * single_rate
@@ -70,13 +70,13 @@ sleep 30s
 
 # RUN DATA PROCESSING PYTHON SCRIPT
 
-# Specify path to notebook
-NOTEBOOK_PATH=./notebook.ipynb # We're in the `./project` folder in the container at this point
+# Specify path to pipeline script
+PIPELINE_PATH=./pipeline.py # We're in the `./project` folder in the container at this point
 CONTAINER_NAME=real-estate-predictor_processor_1
 
-# Run the command on the container
+# Run the command on the container (add `--resume` to continue a failed run)
 echo "Running data processor script..."
-sudo docker exec $CONTAINER_NAME sh -c "jupyter nbconvert --execute $NOTEBOOK_PATH --to python"
+sudo docker exec $CONTAINER_NAME sh -c "python3 $PIPELINE_PATH"
 echo "Data processor script complete..."
 
 # Copy model and encoder to flask server directory
@@ -95,8 +95,8 @@ sudo docker exec -it real-estate-predictor_processor_1 jupyter-notebook list
 # Write the cron job to the user's crontab, overwriting existing jobs
 # echo "$CRON_JOB" | crontab -
 
-echo "Restarting server with new configuration..."
-sudo docker container restart real-estate-predictor_flask-server_1
+# No restart needed: the server reloads newly published models by itself
+# (see `flask_app/model_store.py`)
 
 echo "The prediction API is available at..."
 echo -n "http://" ; curl -s ipinfo.io/ip ; echo ":8080/predict"
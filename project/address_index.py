@@ -0,0 +1,305 @@
+"""
+Offline address resolution against the addresses we already geocoded.
+
+Many "new" addresses are spelling variants of geocoded ones ('254 WEST 27TH
+STREET' vs '254 W 27 ST', unit suffixes like ', 1'). 'AddressIndex' resolves
+those locally so they don't cost a geocoding API call.
+"""
+
+# OPERATING SYSTEM STUFF
+import re
+from difflib import SequenceMatcher
+
+# DATA SCIENCE
+import numpy as np
+import pandas as pd
+
+# SQL STUFF
+from sqlalchemy import text
+
+# VARS -----------------------------------------
+
+# Canonical spelling of street-address tokens
+TOKEN_ALIASES = {
+    "WEST": "W",
+    "EAST": "E",
+    "NORTH": "N",
+    "SOUTH": "S",
+    "STREET": "ST",
+    "AVENUE": "AVE",
+    "AV": "AVE",
+    "ROAD": "RD",
+    "PLACE": "PL",
+    "LANE": "LN",
+    "BOULEVARD": "BLVD",
+    "DRIVE": "DR",
+    "COURT": "CT",
+    "PARKWAY": "PKWY",
+    "TERRACE": "TER",
+    "CIRCLE": "CIR",
+    "CRESCENT": "CRES",
+    "HIGHWAY": "HWY",
+    "EXPRESSWAY": "EXPY",
+    "FIRST": "1",
+    "SECOND": "2",
+    "THIRD": "3",
+    "FOURTH": "4",
+    "FIFTH": "5",
+    "SIXTH": "6",
+    "SEVENTH": "7",
+    "EIGHTH": "8",
+    "NINTH": "9",
+    "TENTH": "10",
+}
+STREET_TYPES = set(TOKEN_ALIASES.values()) - {"W", "E", "N", "S"} | {
+    "LOOP",
+    "WAY",
+    "WALK",
+    "PLZ",
+    "SQ",
+}
+
+# '46 STUYVESANT STREET, 1', '10 MAIN ST APT 4B', '3 ELM ST #2'
+UNIT_PATTERN = re.compile(r",.*$|\s+(APT|UNIT|STE|SUITE|FL)\b.*$|\s*#.*$")
+ORDINAL_PATTERN = re.compile(r"^(\d+)(ST|ND|RD|TH)$")
+# '254', '108-47' (Queens), '12A'
+HOUSE_NUMBER_PATTERN = re.compile(r"^\d+(-\d+)?[A-Z]?$")
+
+# Minimum similarity of street names for a fuzzy match
+FUZZY_CUTOFF = 0.85
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def tokenize_address(address):
+    """
+    Splits an address into its house number and canonical street tokens.
+
+    Unit suffixes and punctuation are dropped, and every token is mapped to
+    its canonical spelling ('WEST' -> 'W', 'STREET' -> 'ST', '27TH' -> '27').
+
+    :param address: Street address, e.g. '254 WEST 27TH STREET, 1'
+    :return: Tuple of the house number ('' if there is none) and the street tokens,
+             e.g. ('254', ('W', '27', 'ST'))
+    """
+    address = UNIT_PATTERN.sub("", str(address).upper())
+    tokens = re.sub(r"[^\w\s-]", " ", address).split()
+
+    house = ""
+    if tokens and HOUSE_NUMBER_PATTERN.match(tokens[0]):
+        house = tokens.pop(0)
+
+    street = []
+    for token in tokens:
+        token = TOKEN_ALIASES.get(token, token)
+        ordinal = ORDINAL_PATTERN.match(token)
+        street.append(ordinal.group(1) if ordinal else token)
+    return house, tuple(street)
+
+
+def normalize_address(address):
+    """
+    Returns the canonical form of an address, e.g. '254 W 27 ST'.
+    """
+    house, street = tokenize_address(address)
+    return " ".join((house,) + street).strip()
+
+
+def _street_parts(street):
+    """
+    Splits street tokens into the part that must match exactly (numbers and
+    street type, '27 ST' is not '28 ST' or '27 AVE') and the name that may
+    match fuzzily, with spaces removed ('MAC DONOUGH' is 'MACDONOUGH').
+    """
+    street_type = street[-1] if street and street[-1] in STREET_TYPES else ""
+    name_tokens = street[:-1] if street_type else street
+    numbers = tuple(token for token in name_tokens if token.isdigit())
+    name = "".join(token for token in name_tokens if not token.isdigit())
+    return (numbers, street_type), name
+
+
+def candidate_blocks(missing_rows):
+    """
+    Returns the (borough, LIKE pattern) of every house number of the missing rows.
+
+    A geocode can only match a missing row with the same borough and house
+    number (see 'AddressIndex.lookup'), and the house number is the start of
+    the address, so '254 %' finds every geocode of '254 W 27 ST, 1'.
+
+    :return: pandas.DataFrame with 'BOROUGH' and 'PATTERN' columns
+    """
+    houses = [tokenize_address(address)[0] for address in missing_rows["ADDRESS"]]
+    blocks = pd.DataFrame(
+        {"BOROUGH": missing_rows["BOROUGH"].to_numpy(), "PATTERN": houses}
+    )
+    blocks = blocks[blocks["PATTERN"] != ""].drop_duplicates()
+    blocks["PATTERN"] = blocks["PATTERN"] + " %"
+    return blocks.reset_index(drop=True)
+
+
+def _load_candidate_blocks(connection, blocks, chunksize):
+    # Bulk-loads 'candidate_blocks', like 'helpers._load_candidate_keys'
+    connection.execute(
+        text(
+            "DROP TEMPORARY TABLE IF EXISTS candidate_blocks"
+            if connection.dialect.name == "mysql"
+            else "DROP TABLE IF EXISTS temp.candidate_blocks"
+        )
+    )
+    connection.execute(
+        text(
+            "CREATE TEMPORARY TABLE candidate_blocks "
+            "(BOROUGH VARCHAR(32) NOT NULL, PATTERN VARCHAR(64) NOT NULL)"
+        )
+    )
+    insert = text(
+        "INSERT INTO candidate_blocks (BOROUGH, PATTERN) VALUES (:borough, :pattern)"
+    )
+    rows = [
+        {"borough": borough, "pattern": pattern}
+        for borough, pattern in zip(blocks["BOROUGH"], blocks["PATTERN"])
+    ]
+    for start in range(0, len(rows), chunksize):
+        connection.execute(insert, rows[start : start + chunksize])
+
+
+class AddressIndex:
+    """
+    In-process index of geocoded addresses.
+
+    Lookups try the exact canonical address first ('normalize_address'), then
+    a fuzzy match on the street name. The fuzzy match only compares addresses
+    in the same borough, with the same house number, street numbers and street
+    type, so it stays cheap and never moves a sale to another building.
+    """
+
+    def __init__(self, geocodes, cutoff=FUZZY_CUTOFF):
+        """
+        :param geocodes: pandas.DataFrame with 'BOROUGH', 'ADDRESS', 'LATITUDE',
+                         'LONGITUDE' and 'GEOCODING ERR' columns, e.g. the geocodes table.
+                         Rows that failed geocoding are ignored.
+        :param cutoff: Minimum street name similarity (0 to 1) for a fuzzy match
+        """
+        self.cutoff = cutoff
+        self.exact = {}
+        self.blocks = {}
+        self.stats = {"exact": 0, "fuzzy": 0, "miss": 0}
+
+        geocoded = geocodes[
+            ~geocodes["GEOCODING ERR"].astype(bool)
+            & geocodes["LATITUDE"].notna()
+            & geocodes["LONGITUDE"].notna()
+        ]
+        for borough, address, lat, lng in zip(
+            geocoded["BOROUGH"],
+            geocoded["ADDRESS"],
+            geocoded["LATITUDE"].astype(float),
+            geocoded["LONGITUDE"].astype(float),
+        ):
+            house, street = tokenize_address(address)
+            key = (borough, house, street)
+            if key in self.exact:
+                continue
+            self.exact[key] = (lat, lng)
+
+            block, name = _street_parts(street)
+            self.blocks.setdefault((borough, house, block), []).append(
+                (name, (lat, lng))
+            )
+
+    @classmethod
+    def from_sql(
+        cls, engine, sql_table_name, missing_rows=None, chunksize=10000, **kwargs
+    ):
+        """
+        Builds the index from the geocodes SQL table.
+
+        With 'missing_rows', only the geocodes that can match them are read,
+        the ones in the same borough with the same house number, see
+        'candidate_blocks'. Rows without a house number are left to the API.
+
+        :param missing_rows: Optional output of 'helpers.check_missing_rows'
+        :param chunksize: Rows per insert into the temporary table
+        """
+        columns = "g.BOROUGH, g.ADDRESS, g.LATITUDE, g.LONGITUDE, g.`GEOCODING ERR`"
+        if missing_rows is None:
+            geocodes = pd.read_sql_query(
+                f"SELECT {columns} FROM {sql_table_name} g", engine
+            )
+            return cls(geocodes, **kwargs)
+
+        blocks = candidate_blocks(missing_rows)
+        with engine.begin() as connection:
+            _load_candidate_blocks(connection, blocks, chunksize)
+            geocodes = pd.read_sql_query(
+                f"SELECT {columns} FROM {sql_table_name} g "
+                f"JOIN candidate_blocks c "
+                f"ON g.BOROUGH = c.BOROUGH AND g.ADDRESS LIKE c.PATTERN",
+                connection,
+            )
+            connection.execute(text("DROP TABLE candidate_blocks"))
+        print(f"Read {len(geocodes)} geocodes for {len(blocks)} house numbers.")
+        return cls(geocodes, **kwargs)
+
+    def __len__(self):
+        return len(self.exact)
+
+    def lookup(self, borough, address):
+        """
+        Returns the (latitude, longitude) of an address, or None if it isn't indexed.
+        """
+        house, street = tokenize_address(address)
+        location = self.exact.get((borough, house, street))
+        if location is not None:
+            self.stats["exact"] += 1
+            return location
+
+        block, name = _street_parts(street)
+        best, best_ratio = None, self.cutoff
+        matcher = SequenceMatcher(b=name, autojunk=False)
+        for candidate, candidate_location in self.blocks.get(
+            (borough, house, block), ()
+        ):
+            matcher.set_seq1(candidate)
+            # Cheap upper bounds first, most candidates stop here
+            if (
+                matcher.real_quick_ratio() < best_ratio
+                or matcher.quick_ratio() < best_ratio
+            ):
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = candidate_location, ratio
+
+        self.stats["fuzzy" if best is not None else "miss"] += 1
+        return best
+
+    def resolve(self, missing_rows):
+        """
+        Fills in the coordinates of the missing rows found in the index.
+
+        Args:
+        missing_rows (pandas.DataFrame): Output of 'helpers.check_missing_rows'.
+
+        Returns:
+        tuple: (resolved, unresolved) DataFrames. 'resolved' has its
+        'LATITUDE' and 'LONGITUDE' filled in, 'unresolved' still needs geocoding.
+        """
+        locations = [
+            self.lookup(borough, address)
+            for borough, address in zip(
+                missing_rows["BOROUGH"], missing_rows["ADDRESS"]
+            )
+        ]
+        found = np.array([location is not None for location in locations], dtype=bool)
+
+        resolved = missing_rows[found].copy()
+        resolved["LATITUDE"] = [location[0] for location in locations if location]
+        resolved["LONGITUDE"] = [location[1] for location in locations if location]
+        resolved["GEOCODING ERR"] = False
+
+        print(
+            f"Resolved {len(resolved)} of {len(missing_rows)} missing rows "
+            f"from the address index."
+        )
+        return resolved, missing_rows[~found].copy()
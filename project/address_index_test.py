@@ -0,0 +1,164 @@
+# --------------------------------------------------------
+# TEST: Offline address index
+# --------------------------------------------------------
+import time
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import address_index
+import geocode_stub
+
+
+@pytest.fixture
+def geocodes_df():
+    return pd.DataFrame(
+        {
+            "BOROUGH": ["MANHATTAN", "BROOKLYN", "BRONX", "QUEENS"],
+            "ADDRESS": [
+                "254 WEST 27TH STREET",
+                "781 MAC DONOUGH STREET",
+                "2744 BOUCK AVE",
+                "108-47 SUTPHIN BOULEVARD",
+            ],
+            "LATITUDE": [40.747, 40.683, 40.867, None],
+            "LONGITUDE": [-73.994, -73.921, -73.845, None],
+            "GEOCODING ERR": [False, False, False, True],
+        }
+    )
+
+
+def missing_rows_df(boroughs, addresses):
+    return pd.DataFrame(
+        {
+            "BOROUGH": boroughs,
+            "ADDRESS": addresses,
+            "PRIMARY_KEY": [b + "_" + a for b, a in zip(boroughs, addresses)],
+            "LATITUDE": None,
+            "LONGITUDE": None,
+            "GEOCODING ERR": False,
+        }
+    )
+
+
+# Spelling variants share one canonical form
+@pytest.mark.parametrize(
+    "address",
+    ["254 WEST 27TH STREET", "254 W 27 ST", "254 West 27th St.", "254 W 27TH ST, 1"],
+)
+def test_normalize_address(address):
+    assert address_index.normalize_address(address) == "254 W 27 ST"
+
+
+# Exact and fuzzy hits resolve, different buildings don't
+@pytest.mark.parametrize(
+    "borough, address, expected",
+    [
+        ("MANHATTAN", "254 W 27 ST, 4B", (40.747, -73.994)),
+        ("BROOKLYN", "781 MACDONOUGH ST", (40.683, -73.921)),  # Fuzzy
+        ("BROOKLYN", "781 MAC DONOGH STREET", (40.683, -73.921)),  # Fuzzy
+        ("MANHATTAN", "254 W 28 ST", None),  # Other street
+        ("MANHATTAN", "256 W 27 ST", None),  # Other house
+        ("MANHATTAN", "254 E 27 ST", None),  # Other side
+        ("MANHATTAN", "254 W 27 AVE", None),  # Other street type
+        ("BRONX", "254 W 27 ST", None),  # Other borough
+        ("QUEENS", "108-47 SUTPHIN BLVD", None),  # Failed geocodes aren't indexed
+    ],
+)
+def test_lookup(geocodes_df, borough, address, expected):
+    index = address_index.AddressIndex(geocodes_df)
+    assert index.lookup(borough, address) == expected
+
+
+# Missing rows are split into the resolved and the unresolved ones
+def test_resolve(geocodes_df):
+    index = address_index.AddressIndex(geocodes_df)
+    missing_rows = missing_rows_df(
+        ["MANHATTAN", "BRONX", "BRONX"],
+        ["254 W 27 ST", "2744 BOUCK AVENUE", "2746 BOUCK AVE"],
+    )
+
+    resolved, unresolved = index.resolve(missing_rows)
+
+    assert resolved["PRIMARY_KEY"].tolist() == [
+        "MANHATTAN_254 W 27 ST",
+        "BRONX_2744 BOUCK AVENUE",
+    ]
+    assert resolved["LATITUDE"].tolist() == [40.747, 40.867]
+    assert not resolved["GEOCODING ERR"].any()
+    assert unresolved["PRIMARY_KEY"].tolist() == ["BRONX_2746 BOUCK AVE"]
+    assert index.stats == {"exact": 2, "fuzzy": 0, "miss": 1}
+
+
+# Only the geocodes sharing a borough & house number with a missing row are
+# read, and they resolve the rows like the whole table does
+def test_from_sql_missing_rows(geocodes_df, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    pd.concat(
+        [
+            geocodes_df,
+            pd.DataFrame(
+                {
+                    "BOROUGH": ["MANHATTAN", "BRONX", "BRONX"],
+                    "ADDRESS": ["2544 BROADWAY", "254 WEST 27TH STREET", "NO NUMBER"],
+                    "LATITUDE": [40.79, 40.81, 40.82],
+                    "LONGITUDE": [-73.97, -73.91, -73.92],
+                    "GEOCODING ERR": False,
+                }
+            ),
+        ]
+    ).to_sql("geocodes", engine, index=False)
+    missing_rows = missing_rows_df(
+        ["MANHATTAN", "BRONX", "BRONX", "BRONX"],
+        ["254 W 27 ST, 4", "2744 BOUCK AVENUE", "2746 BOUCK AVE", "NO NUMBER"],
+    )
+
+    index = address_index.AddressIndex.from_sql(
+        engine, "geocodes", missing_rows=missing_rows
+    )
+    assert sorted(index.exact) == [
+        ("BRONX", "2744", ("BOUCK", "AVE")),
+        ("MANHATTAN", "254", ("W", "27", "ST")),
+    ]
+    resolved, unresolved = index.resolve(missing_rows)
+    everything = address_index.AddressIndex.from_sql(engine, "geocodes")
+    assert len(everything) == 6
+    assert resolved["LATITUDE"].tolist() == [40.747, 40.867]
+    assert unresolved["ADDRESS"].tolist() == ["2746 BOUCK AVE", "NO NUMBER"]
+
+
+# Hit rate and throughput on spelling variants of the backup addresses
+def test_resolve_throughput():
+    sales = pd.read_csv("geocodes_export_backup_1.csv", usecols=["BOROUGH", "ADDRESS"])
+    geocodes = sales.drop_duplicates().reset_index(drop=True)
+    locations = [geocode_stub.stub_location(a) for a in geocodes["ADDRESS"]]
+    geocodes["LATITUDE"] = [lat for lat, _ in locations]
+    geocodes["LONGITUDE"] = [lng for _, lng in locations]
+    geocodes["GEOCODING ERR"] = False
+
+    start = time.perf_counter()
+    index = address_index.AddressIndex(geocodes)
+    build = time.perf_counter() - start
+
+    variants = (
+        geocodes["ADDRESS"]
+        .str.replace("STREET", "ST", regex=False)
+        .str.replace("AVENUE", "AVE", regex=False)
+        .str.replace(r"(\d+)(ST|ND|RD|TH) ", r"\1 ", regex=True)
+        .str.replace("MAC ", "MAC", regex=False)
+        + ", 1"
+    )
+    missing_rows = missing_rows_df(geocodes["BOROUGH"].tolist(), variants.tolist())
+
+    start = time.perf_counter()
+    resolved, _ = index.resolve(missing_rows)
+    elapsed = time.perf_counter() - start
+
+    hit_rate = len(resolved) / len(missing_rows)
+    print(
+        f"\n{len(index)} addresses indexed in {build:.2f}s, "
+        f"{len(missing_rows) / elapsed:.0f} lookups/s, hit rate {hit_rate:.1%} "
+        f"({index.stats['exact']} exact, {index.stats['fuzzy']} fuzzy)"
+    )
+    assert hit_rate > 0.99
@@ -0,0 +1,193 @@
+"""
+Database access layer.
+
+One pooled engine per database URL and process, with pre-ping (stale pooled
+connections are replaced instead of failing the next query), a connection
+retry with exponential backoff, and per-query timing and row counts.
+
+Any SQLAlchemy URL works: MySQL in production, SQLite to run and benchmark
+the helpers locally, e.g. 'sqlite:///local.db'.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import time
+import threading
+
+# SQL
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+# VARS -----------------------------------------
+
+# Pool settings for server databases (SQLite uses SQLAlchemy's defaults)
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_RECYCLE = 3600  # MySQL drops idle connections after 'wait_timeout'
+
+# Queries slower than this are printed
+SLOW_QUERY_SECONDS = 5.0
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def mysql_url(username, password, hostname, database_name=None):
+    """
+    Returns the PyMySQL URL of a MySQL server, or of one of its databases.
+    """
+    url = f"mysql+pymysql://{username}:{password}@{hostname}"
+    return f"{url}/{database_name}" if database_name else url
+
+
+class QueryStats:
+    """
+    Per-engine query counters, filled in by SQLAlchemy cursor events.
+
+    'by_kind' breaks the totals down by statement kind (SELECT, INSERT, ...).
+    Row counts are the driver's 'rowcount', which some drivers don't report
+    for SELECTs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.queries = 0
+            self.seconds = 0.0
+            self.rows = 0
+            self.by_kind = {}
+
+    def record(self, statement, seconds, rows, executemany):
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement else "?"
+        with self.lock:
+            self.queries += 1
+            self.seconds += seconds
+            self.rows += max(rows, 0)
+            totals = self.by_kind.setdefault(kind, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += max(rows, 0)
+        if seconds > SLOW_QUERY_SECONDS:
+            print(
+                f"Slow query ({seconds:.2f}s, {rows} rows"
+                f"{', executemany' if executemany else ''}): {statement[:200]}"
+            )
+
+    def summary(self):
+        """
+        Returns a one-line summary, e.g. '12 queries, 0.35s, 20000 rows (INSERT: ...)'.
+        """
+        with self.lock:
+            kinds = ", ".join(
+                f"{kind}: {count} in {seconds:.2f}s, {rows} rows"
+                for kind, (count, seconds, rows) in sorted(self.by_kind.items())
+            )
+            return f"{self.queries} queries, {self.seconds:.2f}s, {self.rows} rows" + (
+                f" ({kinds})" if kinds else ""
+            )
+
+
+def instrument(engine):
+    """
+    Attaches a QueryStats to an engine, as 'engine.query_stats'.
+    """
+    if hasattr(engine, "query_stats"):
+        return engine.query_stats
+    stats = engine.query_stats = QueryStats()
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info["query_start"].pop()
+        stats.record(
+            statement, time.perf_counter() - start, cursor.rowcount, executemany
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # A failed execute never reaches 'after_cursor_execute', its start
+        # would be popped by the connection's next query
+        connection = context.connection
+        if connection is not None and context.execution_context is not None:
+            starts = connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+    return stats
+
+
+def get_engine(url, **kwargs):
+    """
+    Returns the process-wide pooled engine of a database URL, creating it on first use.
+
+    Engines are per process, so a forked worker never shares pooled
+    connections with its parent.
+
+    :param url: SQLAlchemy database URL, see 'mysql_url'
+    :param kwargs: Extra 'create_engine' arguments for a new engine
+    :return: Instrumented SQLAlchemy engine, see 'instrument'
+    """
+    key = (str(url), os.getpid())
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            options = {"pool_pre_ping": True}
+            if make_url(url).get_backend_name() != "sqlite":
+                options.update(
+                    pool_size=POOL_SIZE,
+                    max_overflow=MAX_OVERFLOW,
+                    pool_recycle=POOL_RECYCLE,
+                )
+            options.update(kwargs)
+            engine = _engines[key] = create_engine(url, **options)
+            instrument(engine)
+    return engine
+
+
+def connect_with_retry(engine, max_retries=10, backoff=1.0, max_backoff=30.0):
+    """
+    Waits until the database accepts connections, e.g. while its container starts.
+
+    :param engine: SQLAlchemy engine instance
+    :param max_retries: Retries after the first failed attempt
+    :param backoff: Seconds to wait before the first retry, doubled every retry
+    :param max_backoff: Longest wait between two attempts
+    :return: The engine
+    :raises OperationalError: If the database still refuses after 'max_retries' retries
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            with engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return engine
+        except OperationalError:
+            if attempt == max_retries:
+                raise
+            wait = min(backoff * 2**attempt, max_backoff)
+            print(
+                f"Connection attempt {attempt + 1} failed. "
+                f"Retrying in {wait:.0f} seconds..."
+            )
+            time.sleep(wait)
+
+
+def dispose_all():
+    """
+    Closes the pooled connections of every engine of this process.
+    """
+    with _engines_lock:
+        for (url, pid), engine in list(_engines.items()):
+            if pid == os.getpid():
+                engine.dispose()
+                del _engines[(url, pid)]
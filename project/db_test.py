@@ -0,0 +1,106 @@
+# --------------------------------------------------------
+# TEST: Database access layer
+# --------------------------------------------------------
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import db
+import helpers
+
+
+# Local SQLite stand-in for the MySQL database
+@pytest.fixture
+def url(tmp_path):
+    yield f"sqlite:///{tmp_path / 'db.db'}"
+    db.dispose_all()
+
+
+# Test that one pooled, pre-pinged engine is shared per URL
+def test_get_engine_is_shared(url, tmp_path):
+    engine = db.get_engine(url)
+
+    assert db.get_engine(url) is engine
+    assert db.get_engine(f"sqlite:///{tmp_path / 'other.db'}") is not engine
+    assert engine.pool._pre_ping
+
+
+# Test that the retry really connects, backing off exponentially
+@patch("db.time.sleep")
+def test_connect_with_retry(mock_sleep, url):
+    engine = db.get_engine(url)
+    refused = OperationalError("SELECT 1", {}, Exception("Connection refused"))
+    connect = engine.connect
+    with patch.object(
+        engine, "connect", side_effect=[refused, refused, refused, connect()]
+    ):
+        assert db.connect_with_retry(engine, backoff=1, max_backoff=3) is engine
+
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [1, 2, 3]
+
+
+# Test that the last failure is raised once the retries run out
+@patch("db.time.sleep")
+def test_connect_with_retry_gives_up(mock_sleep, url):
+    engine = db.get_engine(url)
+    refused = OperationalError("SELECT 1", {}, Exception("Connection refused"))
+    with patch.object(engine, "connect", side_effect=refused):
+        with pytest.raises(OperationalError):
+            db.connect_with_retry(engine, max_retries=2)
+
+    assert mock_sleep.call_count == 2
+
+
+# Test that queries are counted and timed per statement kind, with row counts
+def test_query_stats(url):
+    engine = db.get_engine(url)
+    df = pd.DataFrame({"BOROUGH": ["BRONX", "QUEENS", "BROOKLYN"], "UNITS": [1, 2, 3]})
+    df.to_sql("sales", engine, index=False)
+    engine.query_stats.reset()
+
+    with engine.begin() as connection:
+        connection.execute(text("UPDATE sales SET UNITS = UNITS + 1 WHERE UNITS > 1"))
+        connection.execute(text("SELECT * FROM sales")).fetchall()
+
+    stats = engine.query_stats
+    assert stats.queries == 2
+    assert stats.by_kind["UPDATE"][0] == 1
+    assert stats.by_kind["UPDATE"][2] == 2  # Rows updated
+    assert stats.seconds > 0
+    assert "2 queries" in stats.summary()
+
+
+# Test that a failed query doesn't leave its start time on the connection
+def test_query_stats_error(url):
+    engine = db.get_engine(url)
+    with engine.connect() as connection:
+        for _ in range(3):
+            with pytest.raises(Exception):
+                connection.execute(text("SELECT * FROM no_such_table"))
+        assert connection.info.get("query_start") == []
+
+
+# Test that the helpers run on a local database, without MySQL
+def test_helpers_on_sqlite(url, tmp_path):
+    engine = db.get_engine(url)
+    csv_file = tmp_path / "geocodes.csv"
+    pd.DataFrame(
+        {
+            "BOROUGH": ["BRONX", "BRONX"],
+            "ADDRESS": ["2744 BOUCK AVE", "2746 BOUCK AVE"],
+            "LATITUDE": [40.1, None],
+            "LONGITUDE": [-73.1, None],
+            "GEOCODING ERR": [False, True],
+        }
+    ).to_csv(csv_file, index=False)
+
+    assert helpers.create_database(engine, "housing") is engine
+    helpers.create_table_from_csv(engine, "geocodes", csv_file)
+    helpers.add_geo_key(engine, "geocodes")
+
+    local = pd.DataFrame({"GEO_KEY": helpers.geo_keys(["BRONX"], ["2744 BOUCK AVE"])})
+    assert helpers.is_local_sql_subset(engine, local, "geocodes", "GEO_KEY")
+    assert engine.query_stats.by_kind["INSERT"][2] == 4  # CSV, then keyed copy
@@ -0,0 +1,307 @@
+# OPERATING SYSTEM STUFF
+import os
+import json
+import time
+import hashlib
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# DATA SCIENCE
+import pandas as pd
+
+# API STUFF
+import requests
+from requests.adapters import HTTPAdapter
+
+# VARS -----------------------------------------
+
+# Local folder the borough workbooks are downloaded to
+CACHE_DIR = "data_cache"
+
+# Number of junk rows at the top of every NYC rolling-sales workbook
+WORKBOOK_SKIPROWS = 4
+
+# Columns kept in the Parquet cache, everything else is projected away
+CACHED_COLUMNS = [
+    "BOROUGH",
+    "NEIGHBORHOOD",
+    "BUILDING CLASS CATEGORY",
+    "ADDRESS",
+    "LAND SQUARE FEET",
+    "GROSS SQUARE FEET",
+    "SALE PRICE",
+]
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def cache_path_for(url, cache_dir=CACHE_DIR):
+    """
+    Returns the local path a workbook URL is cached at.
+
+    :param url: URL of the workbook
+    :param cache_dir: Folder the workbooks are cached in
+    :return: Path of the cached workbook, e.g. 'data_cache/rollingsales_bronx.xlsx'
+    """
+    return os.path.join(cache_dir, os.path.basename(urlparse(url).path))
+
+
+def _read_metadata(path):
+    # Validators ('ETag' / 'Last-Modified') saved next to the workbook
+    try:
+        with open(path + ".meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_metadata(path, metadata):
+    with open(path + ".meta.json", "w") as f:
+        json.dump(metadata, f)
+
+
+def download_workbook(url, cache_dir=CACHE_DIR, session=None, timeout=120):
+    """
+    Downloads a workbook into the local cache, unless the cached copy is still current.
+
+    A conditional GET is sent with the 'ETag' and 'Last-Modified' validators
+    saved from the previous download, so the server answers '304 Not Modified'
+    without a body when the workbook has not changed.
+
+    Args:
+    url (str): URL of the workbook.
+    cache_dir (str): Folder the workbooks are cached in.
+    session (requests.Session): Optional session to reuse pooled connections.
+    timeout (int): Request timeout in seconds.
+
+    Returns:
+    tuple: (path, fetched) where 'path' is the local workbook path and 'fetched'
+    is True if the workbook was (re-)downloaded, False if the cached copy was used.
+
+    Raises:
+    requests.HTTPError: If the server responds with an error status.
+    """
+    session = session or requests
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path_for(url, cache_dir)
+
+    # Only send validators if we actually have the workbook on disk
+    headers = {}
+    if os.path.exists(path):
+        metadata = _read_metadata(path)
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=timeout, stream=True)
+
+    # The cached copy is still current
+    if response.status_code == 304:
+        response.close()
+        return path, False
+
+    response.raise_for_status()
+
+    # Write to a temporary file first so a failed download never
+    # leaves a truncated workbook in the cache
+    with open(path + ".part", "wb") as f:
+        for chunk in response.iter_content(chunk_size=1 << 16):
+            f.write(chunk)
+    os.replace(path + ".part", path)
+
+    _write_metadata(
+        path,
+        {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        },
+    )
+    return path, True
+
+
+def download_workbooks(urls, cache_dir=CACHE_DIR, max_workers=None):
+    """
+    Downloads several workbooks concurrently into the local cache.
+
+    Args:
+    urls (list): Workbook URLs, e.g. 'helpers.dataURLs'.
+    cache_dir (str): Folder the workbooks are cached in.
+    max_workers (int): Number of download threads. Defaults to one per URL.
+
+    Returns:
+    list: Local workbook paths, in the same order as 'urls'.
+    """
+    max_workers = max_workers or len(urls)
+
+    # One keep-alive connection pool shared by every download thread
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(
+            pool.map(lambda url: download_workbook(url, cache_dir, session), urls)
+        )
+
+    fetched = sum(1 for _, was_fetched in results if was_fetched)
+    print(f"Downloaded {fetched} workbook(s), {len(results) - fetched} up to date.")
+    return [path for path, _ in results]
+
+
+def read_workbook(path):
+    """
+    Reads a single NYC rolling-sales workbook into a DataFrame.
+
+    :param path: Path of the '.xlsx' workbook
+    :return: pandas.DataFrame of the sales in the workbook
+    """
+    return pd.read_excel(path, skiprows=WORKBOOK_SKIPROWS, engine="openpyxl")
+
+
+def parse_workbooks(paths, max_workers=None):
+    """
+    Parses several workbooks in a process pool.
+
+    openpyxl parsing is CPU bound, so worker processes (rather than threads)
+    are used to parse the workbooks side by side.
+
+    Args:
+    paths (list): Paths of the '.xlsx' workbooks.
+    max_workers (int): Number of worker processes. 1 parses serially in-process.
+                       Defaults to one per workbook, capped at the CPU count.
+
+    Returns:
+    list: pandas.DataFrames, in the same order as 'paths'.
+    """
+    max_workers = max_workers or min(len(paths), os.cpu_count() or 1)
+    if max_workers <= 1:
+        return [read_workbook(path) for path in paths]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(read_workbook, paths))
+
+
+def workbook_cache_key(path, columns=CACHED_COLUMNS):
+    """
+    Returns the content hash a parsed workbook is cached under.
+
+    The hash covers the workbook bytes and the projected columns, so a new
+    workbook (or a new column projection) never hits a stale cache entry.
+
+    :param path: Path of the '.xlsx' workbook
+    :param columns: Columns kept in the cached DataFrame
+    :return: Hex digest of the workbook and column set
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    digest.update("\0".join(columns or []).encode())
+    return digest.hexdigest()
+
+
+def _project(df, columns):
+    # Strip the padded header names before selecting columns
+    df.columns = df.columns.str.strip()
+    if columns:
+        df = df[[col for col in columns if col in df.columns]]
+
+    # Arrow cannot store object columns that mix numbers and strings
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(
+            df[col], skipna=True
+        ).startswith("mixed"):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def _parse_and_cache(path, parquet_path, columns):
+    # Runs in a worker process: parse, project, then write the Parquet file
+    df = _project(read_workbook(path), columns)
+    df.to_parquet(parquet_path + ".part", index=False)
+    os.replace(parquet_path + ".part", parquet_path)
+    return df
+
+
+def load_workbooks(
+    paths, cache_dir=CACHE_DIR, columns=CACHED_COLUMNS, max_workers=None
+):
+    """
+    Loads parsed workbooks from the Parquet cache, parsing only the ones that changed.
+
+    Every parsed workbook is stored as '<cache_dir>/parsed/<hash>.parquet',
+    keyed by 'workbook_cache_key'. A workbook whose bytes changed gets a new
+    hash, so its cache entry is invalidated automatically. Cache misses are
+    parsed in a process pool.
+
+    Args:
+    paths (list): Paths of the '.xlsx' workbooks.
+    cache_dir (str): Folder the Parquet files are cached in.
+    columns (list): Columns to keep. None keeps every column.
+    max_workers (int): Number of worker processes for the cache misses.
+
+    Returns:
+    list: pandas.DataFrames with stripped column names, in the same order as 'paths'.
+    """
+    parsed_dir = os.path.join(cache_dir, "parsed")
+    os.makedirs(parsed_dir, exist_ok=True)
+
+    parquet_paths = [
+        os.path.join(parsed_dir, workbook_cache_key(path, columns) + ".parquet")
+        for path in paths
+    ]
+
+    data = [None] * len(paths)
+    misses = []
+    for i, parquet_path in enumerate(parquet_paths):
+        if os.path.exists(parquet_path):
+            data[i] = pd.read_parquet(parquet_path)
+        else:
+            misses.append(i)
+
+    if misses:
+        args = (
+            [paths[i] for i in misses],
+            [parquet_paths[i] for i in misses],
+            [columns] * len(misses),
+        )
+        max_workers = max_workers or min(len(misses), os.cpu_count() or 1)
+        if max_workers <= 1:
+            parsed = list(map(_parse_and_cache, *args))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                parsed = list(pool.map(_parse_and_cache, *args))
+        for i, df in zip(misses, parsed):
+            data[i] = df
+
+    print(f"Parsed {len(misses)} workbook(s), {len(paths) - len(misses)} from cache.")
+    return data
+
+
+def fetch_housing_data(
+    urls, cache_dir=CACHE_DIR, columns=CACHED_COLUMNS, max_workers=None
+):
+    """
+    Downloads (if changed) and parses (if changed) the borough rolling-sales workbooks.
+
+    Args:
+    urls (list): Workbook URLs, e.g. 'helpers.dataURLs'.
+    cache_dir (str): Folder the workbooks and their Parquet copies are cached in.
+    columns (list): Columns to keep. None keeps every column.
+    max_workers (int): Worker count for both the download and the parse step.
+
+    Returns:
+    list: pandas.DataFrames, one per URL, ready for 'helpers.combineHousingDataSets'.
+    """
+    start = time.perf_counter()
+    paths = download_workbooks(urls, cache_dir, max_workers)
+    downloaded = time.perf_counter()
+    data = load_workbooks(paths, cache_dir, columns, max_workers)
+    parsed = time.perf_counter()
+    print(
+        f"Fetched in {downloaded - start:.2f}s, loaded in {parsed - downloaded:.2f}s."
+    )
+    return data
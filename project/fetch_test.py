@@ -0,0 +1,226 @@
+# --------------------------------------------------------
+# TEST: Concurrent, conditional workbook download
+# --------------------------------------------------------
+import os
+import time
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+
+import pandas as pd
+import pytest
+from unittest.mock import patch
+
+import fetch
+
+BOROUGH_FILES = [
+    "rollingsales_manhattan.xlsx",
+    "rollingsales_bronx.xlsx",
+    "rollingsales_brooklyn.xlsx",
+    "rollingsales_queens.xlsx",
+    "rollingsales_statenisland.xlsx",
+]
+
+# Latency the stand-in server adds to every full response (seconds)
+SERVER_LATENCY = 0.2
+
+
+# Writes a workbook laid out like the NYC ones: 4 junk rows, then the header
+def write_fixture_workbook(path, borough_code, rows=200):
+    df = pd.DataFrame(
+        {
+            "BOROUGH": [borough_code] * rows,
+            "NEIGHBORHOOD": ["CHELSEA"] * rows,
+            "BUILDING CLASS CATEGORY": ["01 ONE FAMILY DWELLINGS"] * rows,
+            "ADDRESS": [f"{i} WEST 27TH STREET" for i in range(rows)],
+            "LAND SQUARE FEET": range(rows),
+            "GROSS SQUARE FEET": range(rows),
+            "SALE PRICE": range(rows),
+        }
+    )
+    df.to_excel(path, startrow=4, index=False, engine="openpyxl")
+
+
+# Static file handler that adds an 'ETag' header, honours 'If-None-Match'
+# and counts the full (200) and conditional (304) responses it sends
+class FixtureHandler(SimpleHTTPRequestHandler):
+    counts = {200: 0, 304: 0}
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        with open(self.translate_path(self.path), "rb") as f:
+            self.etag = '"' + hashlib.md5(f.read()).hexdigest() + '"'
+
+        if self.headers.get("If-None-Match") == self.etag:
+            self.counts[304] += 1
+            self.send_response(304)
+            self.end_headers()
+            return None
+
+        self.counts[200] += 1
+        time.sleep(SERVER_LATENCY)
+        return super().send_head()
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.send_header("ETag", self.etag)
+
+
+# Local HTTP stand-in serving the fixture workbooks
+@pytest.fixture
+def workbook_server(tmp_path):
+    served = tmp_path / "served"
+    served.mkdir()
+    for code, name in enumerate(BOROUGH_FILES, start=1):
+        write_fixture_workbook(served / name, code)
+
+    FixtureHandler.counts = {200: 0, 304: 0}
+    handler = partial(FixtureHandler, directory=str(served))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    base = f"http://127.0.0.1:{server.server_address[1]}/"
+    yield served, [base + name for name in BOROUGH_FILES]
+
+    server.shutdown()
+    server.server_close()
+
+
+# Test that every workbook is downloaded into the cache
+def test_download_workbooks(workbook_server, tmp_path):
+    served, urls = workbook_server
+    cache_dir = tmp_path / "cache"
+
+    paths = fetch.download_workbooks(urls, str(cache_dir))
+
+    assert paths == [str(cache_dir / name) for name in BOROUGH_FILES]
+    for path in paths:
+        assert os.path.exists(path)
+    assert FixtureHandler.counts == {200: 5, 304: 0}
+
+
+# Test that unchanged workbooks are not downloaded again,
+# and that a changed workbook is
+def test_download_workbooks_conditional(workbook_server, tmp_path):
+    served, urls = workbook_server
+    cache_dir = str(tmp_path / "cache")
+
+    fetch.download_workbooks(urls, cache_dir)
+    fetch.download_workbooks(urls, cache_dir)
+    assert FixtureHandler.counts == {200: 5, 304: 5}
+
+    # Publish a new Bronx workbook
+    write_fixture_workbook(served / BOROUGH_FILES[1], 2, rows=300)
+    _, fetched = fetch.download_workbook(urls[1], cache_dir)
+
+    assert fetched
+    assert len(fetch.read_workbook(fetch.cache_path_for(urls[1], cache_dir))) == 300
+
+
+# Test that the parsed workbooks have the NYC header row
+def test_fetch_housing_data(workbook_server, tmp_path):
+    served, urls = workbook_server
+
+    data = fetch.fetch_housing_data(urls, str(tmp_path / "cache"))
+
+    assert len(data) == 5
+    for code, df in enumerate(data, start=1):
+        assert "SALE PRICE" in df.columns
+        assert (df["BOROUGH"] == code).all()
+
+
+# Compare serial and parallel download & parse timings
+def test_serial_vs_parallel_timings(workbook_server, tmp_path):
+    served, urls = workbook_server
+
+    start = time.perf_counter()
+    paths = fetch.download_workbooks(urls, str(tmp_path / "serial"), max_workers=1)
+    serial_download = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fetch.download_workbooks(urls, str(tmp_path / "parallel"))
+    parallel_download = time.perf_counter() - start
+
+    start = time.perf_counter()
+    serial_data = fetch.parse_workbooks(paths, max_workers=1)
+    serial_parse = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parallel_data = fetch.parse_workbooks(paths)
+    parallel_parse = time.perf_counter() - start
+
+    print(
+        f"\ndownload: serial {serial_download:.2f}s, parallel {parallel_download:.2f}s"
+        f"\nparse:    serial {serial_parse:.2f}s, parallel {parallel_parse:.2f}s"
+    )
+
+    # Downloads overlap the server latency when run concurrently
+    assert parallel_download < serial_download
+    for serial_df, parallel_df in zip(serial_data, parallel_data):
+        assert serial_df.equals(parallel_df)
+
+
+# --------------------------------------------------------
+# TEST: Parquet cache for parsed workbooks
+# --------------------------------------------------------
+
+
+# Workbook with padded header names and a column no later step uses
+@pytest.fixture
+def padded_workbook(tmp_path):
+    path = tmp_path / "rollingsales_bronx.xlsx"
+    df = pd.DataFrame(
+        {
+            "BOROUGH ": [2, 2],
+            "NEIGHBORHOOD": ["BATHGATE", "BATHGATE"],
+            "BUILDING CLASS CATEGORY": ["01 ONE FAMILY DWELLINGS"] * 2,
+            "ADDRESS": ["2744 BOUCK AVE", "2746 BOUCK AVE"],
+            "APARTMENT NUMBER": ["4B", 12],
+            "LAND SQUARE FEET": [1000, 2000],
+            "GROSS SQUARE FEET": [1500, 2500],
+            "SALE PRICE": [500000, 600000],
+        }
+    )
+    df.to_excel(path, startrow=4, index=False, engine="openpyxl")
+    return str(path)
+
+
+# Test that parsed workbooks are projected, cached, and read back from the cache
+def test_load_workbooks_cache_hit(padded_workbook, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+
+    (first,) = fetch.load_workbooks([padded_workbook], cache_dir, max_workers=1)
+    assert list(first.columns) == fetch.CACHED_COLUMNS
+
+    # A second load must not touch openpyxl
+    with patch("fetch.read_workbook") as mock_read:
+        (second,) = fetch.load_workbooks([padded_workbook], cache_dir, max_workers=1)
+        mock_read.assert_not_called()
+
+    pd.testing.assert_frame_equal(first, second)
+
+
+# Test that a changed workbook invalidates its cache entry
+def test_load_workbooks_invalidation(padded_workbook, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    old_key = fetch.workbook_cache_key(padded_workbook)
+    fetch.load_workbooks([padded_workbook], cache_dir, max_workers=1)
+
+    write_fixture_workbook(padded_workbook, 2, rows=10)
+    assert fetch.workbook_cache_key(padded_workbook) != old_key
+
+    (df,) = fetch.load_workbooks([padded_workbook], cache_dir, max_workers=1)
+    assert len(df) == 10
+
+
+# Test that the whole workbook is kept when no projection is given
+def test_load_workbooks_no_projection(padded_workbook, tmp_path):
+    (df,) = fetch.load_workbooks(
+        [padded_workbook], str(tmp_path / "cache"), columns=None, max_workers=1
+    )
+    assert "APARTMENT NUMBER" in df.columns
+    assert "BOROUGH" in df.columns
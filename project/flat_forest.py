@@ -0,0 +1,167 @@
+"""
+Flat, array-based RandomForest inference.
+
+'export_forest' turns a fitted sklearn forest into struct-of-arrays node
+tables, with every tree's nodes stored end to end:
+
+    feature     int32    split feature of each node
+    threshold   float32  a row goes left when 'x[feature] <= threshold'
+    children    int32    (right, left) child node indexes, by 'x <= threshold'
+    value       float32  prediction of each node
+    roots       int32    root node of each tree
+
+Leaves point to themselves, so 'predict' walks every row down every tree
+in 'depth' vectorized numpy steps, with no masks and no per-tree Python
+loop. The tables are saved as '.npy' files that 'FlatForest.load' can
+memory-map.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import json
+
+# DATA SCIENCE
+import numpy as np
+
+# VARS -----------------------------------------
+
+ARRAYS = ("feature", "threshold", "children", "value", "roots")
+META_FILE = "forest.json"
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+class FlatForest:
+    """
+    Node tables of a regression forest, with an sklearn-like 'predict'.
+    """
+
+    def __init__(self, feature, threshold, children, value, roots, depth, n_features):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.n_features = n_features
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def predict(self, X):
+        """
+        Predicts every row of X, like 'RandomForestRegressor.predict'.
+
+        Rows are cast to float32 first, as sklearn does, so every row reaches
+        the same leaves; only the float32 leaf values differ, by ~1e-7.
+
+        :param X: Array of shape (n_rows, n_features)
+        :return: numpy array of n_rows predictions
+        :raises ValueError: On a wrong shape, NaN or infinity
+        """
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(
+                f"Expected {self.n_features} features, got an array of shape {X.shape}"
+            )
+        if not np.isfinite(X).all():
+            raise ValueError("Input contains NaN or infinity")
+
+        # One node per tree and row, tree by tree so each step's lookups stay
+        # within one tree's tables; 'offsets' are the rows' flat positions in X
+        rows = len(X)
+        offsets = np.tile(np.arange(0, X.size, self.n_features), len(self.roots))
+        X = X.ravel()
+        children = self.children.ravel()
+        nodes = np.repeat(self.roots, rows)
+        for _ in range(self.depth):
+            go_left = X.take(offsets + self.feature.take(nodes)) <= self.threshold.take(
+                nodes
+            )
+            nodes = children.take(nodes * 2 + go_left)
+        return self.value.take(nodes).reshape(-1, rows).mean(axis=0, dtype=np.float64)
+
+    def save(self, folder):
+        """
+        Saves the node tables as '.npy' files, and the shape as JSON, in a folder.
+        """
+        os.makedirs(folder, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(folder, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(folder, META_FILE), "w") as f:
+            json.dump({"depth": self.depth, "n_features": self.n_features}, f)
+
+    @classmethod
+    def load(cls, folder, mmap_mode=None):
+        """
+        Loads a saved forest.
+
+        :param folder: Folder written by 'save'
+        :param mmap_mode: e.g. 'r' to memory-map the tables instead of reading them
+        :return: FlatForest
+        """
+        with open(os.path.join(folder, META_FILE)) as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(folder, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in ARRAYS
+        }
+        return cls(**arrays, **meta)
+
+
+def export_forest(model):
+    """
+    Flattens a fitted single-output sklearn forest, e.g. a RandomForestRegressor.
+
+    Thresholds are rounded down to float32, so a float32 feature goes left
+    exactly when it does in sklearn.
+
+    :param model: Fitted forest, with 'estimators_' of decision trees
+    :return: FlatForest
+    :raises ValueError: If the forest predicts more than one output
+    """
+    if model.n_outputs_ != 1:
+        raise ValueError("Only single-output forests can be flattened")
+
+    tables = {name: [] for name in ARRAYS[:-1]}
+    roots, depth, offset = [], 0, 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        leaf = tree.children_left == -1
+
+        threshold = tree.threshold.astype(np.float32)
+        rounded_up = threshold > tree.threshold
+        threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+        threshold[leaf] = 0
+
+        tables["feature"].append(np.where(leaf, 0, tree.feature))
+        tables["threshold"].append(threshold)
+        tables["children"].append(
+            np.stack(
+                [
+                    np.where(leaf, nodes, tree.children_right),
+                    np.where(leaf, nodes, tree.children_left),
+                ],
+                axis=1,
+            )
+            + offset
+        )
+        tables["value"].append(tree.value.reshape(tree.node_count))
+
+        roots.append(offset)
+        depth = max(depth, tree.max_depth)
+        offset += tree.node_count
+
+    dtypes = {"threshold": np.float32, "value": np.float32}
+    arrays = {
+        name: np.concatenate(parts).astype(dtypes.get(name, np.int32))
+        for name, parts in tables.items()
+    }
+    return FlatForest(
+        **arrays,
+        roots=np.array(roots, dtype=np.int32),
+        depth=depth,
+        n_features=model.n_features_in_,
+    )
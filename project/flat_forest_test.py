@@ -0,0 +1,135 @@
+# --------------------------------------------------------
+# TEST: Flat RandomForest inference
+# --------------------------------------------------------
+import os
+import sys
+import time
+import subprocess
+
+import joblib
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+import flat_forest
+
+
+def fit_forest(rows, n_estimators, max_depth, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(rows, 12))
+    X[:, 4:] = rng.integers(0, 2, size=(rows, 8))  # One-hot like columns
+    y = X[:, 0] * 2 + np.sin(X[:, 1] * 3) + X[:, 5] + rng.normal(0, 0.1, rows)
+    model = RandomForestRegressor(
+        n_estimators=n_estimators, max_depth=max_depth, random_state=seed, n_jobs=-1
+    )
+    return model.fit(X, y), X
+
+
+@pytest.fixture(scope="module")
+def fitted():
+    return fit_forest(2000, 20, 8)
+
+
+# Same predictions as sklearn, also for training values on the split thresholds
+def test_flat_forest_parity(fitted):
+    model, X = fitted
+    forest = flat_forest.export_forest(model)
+
+    X_new = np.random.default_rng(1).normal(size=(500, 12))
+    for rows in (X, X_new, X[:1]):
+        np.testing.assert_allclose(
+            forest.predict(rows), model.predict(rows), rtol=1e-6, atol=1e-6
+        )
+    assert forest.depth == 8
+    assert forest.feature.dtype == forest.children.dtype == np.int32
+    assert forest.threshold.dtype == forest.value.dtype == np.float32
+
+
+# The saved tables load back, memory-mapped or not
+def test_flat_forest_save_load(fitted, tmp_path):
+    model, X = fitted
+    forest = flat_forest.export_forest(model)
+    forest.save(str(tmp_path / "forest"))
+
+    for mmap_mode in (None, "r"):
+        loaded = flat_forest.FlatForest.load(str(tmp_path / "forest"), mmap_mode)
+        np.testing.assert_array_equal(loaded.predict(X), forest.predict(X))
+    assert isinstance(loaded.threshold, np.memmap)
+
+
+# Bad input fails like sklearn instead of walking the trees
+def test_flat_forest_bad_input(fitted):
+    model, X = fitted
+    forest = flat_forest.export_forest(model)
+
+    with pytest.raises(ValueError, match="features"):
+        forest.predict(X[:, :5])
+    with pytest.raises(ValueError, match="NaN"):
+        forest.predict(np.where(np.eye(1, 12, dtype=bool), np.nan, X[:1]))
+    with pytest.raises(ValueError, match="single-output"):
+        flat_forest.export_forest(
+            RandomForestRegressor(n_estimators=2).fit(X[:50], X[:50, :2])
+        )
+
+
+RSS_SCRIPT = """
+import sys, joblib, flat_forest
+import sklearn.ensemble  # Not counted
+
+def rss():
+    with open("/proc/self/status") as f:
+        return next(int(l.split()[1]) for l in f if l.startswith("VmRSS")) * 1024
+
+before = rss()
+if sys.argv[1] == "flat":
+    model = flat_forest.FlatForest.load(sys.argv[2])
+else:
+    model = joblib.load(sys.argv[2])
+print(rss() - before)
+"""
+
+
+def loaded_rss(kind, path):
+    # RSS a fresh process gains by loading the model
+    output = subprocess.check_output(
+        [sys.executable, "-c", RSS_SCRIPT, kind, path],
+        cwd=os.path.dirname(os.path.abspath(flat_forest.__file__)),
+    )
+    return int(output)
+
+
+# Benchmark of the serving model's shape, 200 trees of depth 10:
+# single-row latency, batch throughput and resident memory
+@pytest.mark.skipif(not os.path.exists("/proc/self/status"), reason="Linux only")
+def test_flat_forest_benchmark(tmp_path):
+    model, X = fit_forest(20000, 200, 10)
+    model.set_params(n_jobs=None)
+    forest = flat_forest.export_forest(model)
+
+    row = X[:1]
+    timings = {}
+    for name, predict in (("sklearn", model.predict), ("flat", forest.predict)):
+        start = time.perf_counter()
+        for _ in range(20):
+            predict(row)
+        single = (time.perf_counter() - start) / 20
+
+        start = time.perf_counter()
+        predict(X[:10000])
+        timings[name] = (single, 10000 / (time.perf_counter() - start))
+
+    joblib.dump(model, str(tmp_path / "model.joblib"))
+    forest.save(str(tmp_path / "forest"))
+    sklearn_rss = loaded_rss("sklearn", str(tmp_path / "model.joblib"))
+    flat_rss = loaded_rss("flat", str(tmp_path / "forest"))
+
+    print(
+        f"\n{len(forest.feature)} nodes. One row: sklearn "
+        f"{timings['sklearn'][0] * 1e3:.2f}ms, flat {timings['flat'][0] * 1e3:.2f}ms. "
+        f"Batch: sklearn {timings['sklearn'][1]:.0f} rows/s, "
+        f"flat {timings['flat'][1]:.0f} rows/s. "
+        f"RSS: sklearn {sklearn_rss / 2**20:.1f}MiB, flat {flat_rss / 2**20:.1f}MiB "
+        f"(tables {forest.nbytes / 2**20:.1f}MiB)"
+    )
+    assert timings["flat"][0] * 10 < timings["sklearn"][0]
+    assert flat_rss < sklearn_rss
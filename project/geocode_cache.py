@@ -0,0 +1,243 @@
+"""
+Persistent geocode cache in front of the geocoding API.
+
+Two tiers: an in-memory LRU per process, backed by a SQLite file shared by
+every process (the ETL, the notebook and the uwsgi workers of the Flask
+service). Entries are keyed by the normalized primary key, so spelling
+variants of an address share one entry. Failed lookups are cached too, but
+expire after a TTL so they are eventually retried.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+# PROJECT MODULES
+from address_index import normalize_address
+
+# VARS -----------------------------------------
+
+GEOCODE_CACHE_PATH = os.path.join("data_cache", "geocodes.sqlite")
+
+# Entries kept in memory per process
+LRU_CAPACITY = 50000
+
+# Seconds before a failed lookup is retried
+NEGATIVE_TTL = 30 * 24 * 60 * 60
+
+CachedGeocode = namedtuple("CachedGeocode", ["latitude", "longitude", "failed"])
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def cache_key(borough, address):
+    """
+    Returns the normalized primary key of an address, e.g. 'MANHATTAN_254 W 27 ST'.
+    """
+    return f"{borough}_{normalize_address(address)}"
+
+
+class GeocodeCache:
+    """
+    In-memory LRU backed by an on-disk SQLite store.
+
+    'stats' counts memory hits, disk hits, negative hits (cached failures),
+    misses and API calls made through 'geolocate' / 'geolocate_rows'.
+    Safe to share between threads; the SQLite connection is reopened after
+    a fork, so it is also safe to create before uwsgi forks its workers.
+    """
+
+    def __init__(
+        self, path=GEOCODE_CACHE_PATH, capacity=LRU_CAPACITY, negative_ttl=NEGATIVE_TTL
+    ):
+        self.path = path
+        self.capacity = capacity
+        self.negative_ttl = negative_ttl
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+            "api_calls": 0,
+        }
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False
+            )
+            # WAL lets readers in other processes carry on during a write
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS geocodes ("
+                "key TEXT PRIMARY KEY, latitude REAL, longitude REAL, "
+                "failed INTEGER NOT NULL, expires_at REAL)"
+            )
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Returns the CachedGeocode of a normalized key, or None on a miss.
+        Expired failures count as misses.
+        """
+        with self.lock:
+            now = time.time()
+            cached = self.memory.get(key)
+            if cached is not None:
+                entry, expires_at = cached
+                if expires_at is None or expires_at > now:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    self.stats["negative_hits"] += entry.failed
+                    return entry
+                del self.memory[key]
+
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT latitude, longitude, failed, expires_at "
+                    "FROM geocodes WHERE key = ?",
+                    (key,),
+                )
+                .fetchone()
+            )
+            if row is None or (row[3] is not None and row[3] <= now):
+                self.stats["misses"] += 1
+                return None
+
+            entry = CachedGeocode(row[0], row[1], bool(row[2]))
+            self._remember(key, (entry, row[3]))
+            self.stats["disk_hits"] += 1
+            self.stats["negative_hits"] += entry.failed
+            return entry
+
+    def put_many(self, entries):
+        """
+        Stores (key, latitude, longitude, failed) tuples in one transaction.
+        """
+        now = time.time()
+        rows = [
+            (
+                key,
+                None if failed else latitude,
+                None if failed else longitude,
+                int(failed),
+                now + self.negative_ttl if failed else None,
+            )
+            for key, latitude, longitude, failed in entries
+        ]
+        with self.lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)", rows
+                )
+            for key, latitude, longitude, failed, expires_at in rows:
+                entry = CachedGeocode(latitude, longitude, bool(failed))
+                self._remember(key, (entry, expires_at))
+
+    def put(self, key, latitude, longitude, failed=False):
+        self.put_many([(key, latitude, longitude, failed)])
+
+    def geolocate(self, borough, address, fetch):
+        """
+        Returns the CachedGeocode of an address, calling 'fetch' on a miss.
+
+        :param borough: Borough name, e.g. 'MANHATTAN'
+        :param address: Street address
+        :param fetch: Function of (borough, address) returning (latitude, longitude),
+                      or None if the address couldn't be geocoded
+        :return: CachedGeocode
+        """
+        key = cache_key(borough, address)
+        entry = self.get(key)
+        if entry is None:
+            with self.lock:
+                self.stats["api_calls"] += 1
+            location = fetch(borough, address)
+            failed = location is None
+            latitude, longitude = (None, None) if failed else location
+            self.put(key, latitude, longitude, failed)
+            entry = CachedGeocode(latitude, longitude, failed)
+        return entry
+
+    def geolocate_rows(self, missing_rows, fetch_rows):
+        """
+        Geolocates rows from the cache, calling 'fetch_rows' for the misses only.
+
+        Args:
+        missing_rows (pandas.DataFrame): Output of 'helpers.check_missing_rows'.
+        fetch_rows (callable): Geocodes a DataFrame of rows the same way, e.g.
+                               'lambda rows: geocoder.geolocate_rows(rows, api_key)'.
+                               Rows it leaves out aren't cached.
+
+        Returns:
+        pandas.DataFrame: A geocoded copy of 'missing_rows', less the rows
+        'fetch_rows' left out. Cached failures come back with 'GEOCODING ERR'
+        set, without an API call.
+        """
+        rows = missing_rows.copy()
+        if not rows.index.is_unique:
+            rows = rows.reset_index(drop=True)
+        keys = [
+            cache_key(borough, address)
+            for borough, address in zip(rows["BOROUGH"], rows["ADDRESS"])
+        ]
+        entries = [self.get(key) for key in keys]
+
+        hit = [entry is not None for entry in entries]
+        hits = [entry for entry in entries if entry is not None]
+        if hits:
+            rows.loc[hit, "LATITUDE"] = [entry.latitude for entry in hits]
+            rows.loc[hit, "LONGITUDE"] = [entry.longitude for entry in hits]
+            rows.loc[hit, "GEOCODING ERR"] = [entry.failed for entry in hits]
+
+        miss = [not h for h in hit]
+        if any(miss):
+            misses = rows[miss]
+            with self.lock:
+                self.stats["api_calls"] += int((~misses["GEOCODING ERR"]).sum())
+            fetched = fetch_rows(misses)
+
+            # Matched on the index, the rows that failed for good are left out
+            fetched_keys = dict(zip(rows.index, keys))
+            self.put_many(
+                (fetched_keys[label], latitude, longitude, bool(failed))
+                for label, latitude, longitude, failed in zip(
+                    fetched.index,
+                    fetched["LATITUDE"],
+                    fetched["LONGITUDE"],
+                    fetched["GEOCODING ERR"],
+                )
+            )
+            for col in ("LATITUDE", "LONGITUDE", "GEOCODING ERR"):
+                rows.loc[fetched.index, col] = fetched[col].to_numpy()
+            rows = rows.drop(misses.index.difference(fetched.index))
+
+        print(
+            f"Geocode cache: {len(hits)} of {len(missing_rows)} rows cached, "
+            f"{sum(miss)} looked up, {len(missing_rows) - len(rows)} left out."
+        )
+        return rows
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,128 @@
+# --------------------------------------------------------
+# TEST: Two-tier geocode cache
+# --------------------------------------------------------
+import pandas as pd
+import pytest
+
+import geocode_cache
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / "geocodes.sqlite")
+
+
+def missing_rows_df(addresses):
+    return pd.DataFrame(
+        {
+            "BOROUGH": "BRONX",
+            "ADDRESS": addresses,
+            "PRIMARY_KEY": ["BRONX_" + address for address in addresses],
+            "LATITUDE": None,
+            "LONGITUDE": None,
+            "GEOCODING ERR": False,
+        }
+    )
+
+
+def fake_fetch_rows(calls):
+    # Geocodes every address except the ones containing 'NOWHERE'
+    def fetch_rows(rows):
+        calls.append(rows["ADDRESS"].tolist())
+        rows = rows.copy()
+        failed = rows["ADDRESS"].str.contains("NOWHERE")
+        rows["LATITUDE"] = [None if f else 40.8 for f in failed]
+        rows["LONGITUDE"] = [None if f else -73.9 for f in failed]
+        rows["GEOCODING ERR"] = failed
+        return rows
+
+    return fetch_rows
+
+
+# Keys are normalized, so spelling variants share an entry
+def test_cache_key():
+    assert geocode_cache.cache_key(
+        "MANHATTAN", "254 WEST 27TH STREET, 1"
+    ) == geocode_cache.cache_key("MANHATTAN", "254 W 27 ST")
+
+
+# Entries survive in the SQLite store, the LRU only keeps the newest
+def test_get_put(cache_path):
+    cache = geocode_cache.GeocodeCache(cache_path, capacity=1)
+    cache.put("BRONX_1 A ST", 40.1, -73.1)
+    cache.put("BRONX_2 A ST", 40.2, -73.2)
+    assert list(cache.memory) == ["BRONX_2 A ST"]
+
+    assert cache.get("BRONX_2 A ST") == (40.2, -73.2, False)
+    assert cache.get("BRONX_1 A ST") == (40.1, -73.1, False)
+    assert cache.get("BRONX_3 A ST") is None
+    assert cache.stats["memory_hits"] == 1
+    assert cache.stats["disk_hits"] == 1
+    assert cache.stats["misses"] == 1
+
+    # A new process sees the same entries
+    assert geocode_cache.GeocodeCache(cache_path).get("BRONX_1 A ST").latitude == 40.1
+
+
+# Failures are cached until their TTL runs out
+@pytest.mark.parametrize(
+    "negative_ttl, expected", [(3600, (None, None, True)), (0, None)]
+)
+def test_negative_ttl(cache_path, negative_ttl, expected):
+    cache = geocode_cache.GeocodeCache(cache_path, negative_ttl=negative_ttl)
+    cache.put("BRONX_1 NOWHERE LANE", None, None, failed=True)
+
+    assert cache.get("BRONX_1 NOWHERE LANE") == expected
+    assert (
+        geocode_cache.GeocodeCache(cache_path).get("BRONX_1 NOWHERE LANE") == expected
+    )
+
+
+# Only cache misses reach the API, failures included
+def test_geolocate_rows(cache_path):
+    cache = geocode_cache.GeocodeCache(cache_path)
+    calls = []
+    rows = missing_rows_df(["2744 BOUCK AVE", "1 NOWHERE LANE"])
+
+    first = cache.geolocate_rows(rows, fake_fetch_rows(calls))
+    assert first["GEOCODING ERR"].tolist() == [False, True]
+    assert first["LATITUDE"].tolist()[0] == 40.8
+
+    # Spelling variants and failures are answered from the cache
+    second = cache.geolocate_rows(
+        missing_rows_df(["2744 BOUCK AVENUE", "1 NOWHERE LANE", "2746 BOUCK AVE"]),
+        fake_fetch_rows(calls),
+    )
+    assert second["GEOCODING ERR"].tolist() == [False, True, False]
+    assert calls == [["2744 BOUCK AVE", "1 NOWHERE LANE"], ["2746 BOUCK AVE"]]
+    assert cache.stats["api_calls"] == 3
+    assert cache.stats["negative_hits"] == 1
+
+
+# Rows the fetch leaves out aren't cached or returned, and are fetched again
+def test_geolocate_rows_left_out(cache_path):
+    cache = geocode_cache.GeocodeCache(cache_path)
+    calls = []
+    fetch_rows = fake_fetch_rows(calls)
+    rows = missing_rows_df(["2744 BOUCK AVE", "2746 BOUCK AVE"])
+
+    first = cache.geolocate_rows(rows, lambda rows: fetch_rows(rows).iloc[:1])
+    assert first["ADDRESS"].tolist() == ["2744 BOUCK AVE"]
+
+    second = cache.geolocate_rows(rows, fetch_rows)
+    assert second["ADDRESS"].tolist() == ["2744 BOUCK AVE", "2746 BOUCK AVE"]
+    assert calls[-1] == ["2746 BOUCK AVE"]
+
+
+# Single addresses, e.g. from the Flask service
+def test_geolocate(cache_path):
+    cache = geocode_cache.GeocodeCache(cache_path)
+    calls = []
+
+    def fetch(borough, address):
+        calls.append(address)
+        return (40.8, -73.9)
+
+    assert cache.geolocate("BRONX", "2744 BOUCK AVE", fetch) == (40.8, -73.9, False)
+    assert cache.geolocate("BRONX", "2744 Bouck Avenue", fetch) == (40.8, -73.9, False)
+    assert calls == ["2744 BOUCK AVE"]
@@ -0,0 +1,133 @@
+"""
+Local stand-in for the Google geocoding API.
+
+Answers '/maps/api/geocode/json?address=...&key=...' like the real API, so
+the geocoder's throughput can be measured without an API key or API cost.
+
+- Addresses containing 'PARTIAL' come back as a partial match.
+- Addresses containing 'NOWHERE' come back with no results.
+- Addresses containing 'GARBLED' get a 400 that isn't JSON, like a proxy's.
+- The key 'expired' is rejected like an expired key.
+- A fraction of requests ('--error-rate') fail with a transient 503.
+
+Usage:
+    python3 geocode_stub.py --port 8099 --latency 0.05
+"""
+
+# OPERATING SYSTEM STUFF
+import json
+import time
+import random
+import zlib
+import argparse
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def stub_location(address):
+    """
+    Returns a deterministic (lat, lng) inside New York City for an address.
+    """
+    digest = zlib.crc32(address.encode())
+    return (
+        40.5 + (digest % 10000) / 25000,
+        -74.2 + (digest // 10000 % 10000) / 20000,
+    )
+
+
+def stub_response(address, key):
+    """
+    Returns the JSON body the real API would send for an address and key.
+    """
+    if key == "expired":
+        return {
+            "error_message": "The provided API key is expired. ",
+            "results": [],
+            "status": "REQUEST_DENIED",
+        }
+    if "NOWHERE" in address:
+        return {"results": [], "status": "ZERO_RESULTS"}
+
+    lat, lng = stub_location(address)
+    result = {"geometry": {"location": {"lat": lat, "lng": lng}}}
+    if "PARTIAL" in address:
+        result["partial_match"] = True
+    return {"results": [result], "status": "OK"}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_stub_server(port=0, latency=0.0, error_rate=0.0, seed=None):
+    """
+    Creates (but doesn't start) a stub geocoding server.
+
+    :param port: Port to listen on, 0 picks a free port
+    :param latency: Seconds added to every response
+    :param error_rate: Fraction of requests answered with a transient 503
+    :param seed: Seed for the transient errors
+    :return: The server; 'server.stats' counts the requests and 503s sent
+    """
+    rng = random.Random(seed)
+    stats = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            with lock:
+                stats["requests"] += 1
+                failed = rng.random() < error_rate
+                if failed:
+                    stats["errors"] += 1
+            time.sleep(latency)
+
+            address = query.get("address", [""])[0]
+            if failed:
+                body, status = b'{"status": "UNKNOWN_ERROR"}', 503
+            elif "GARBLED" in address:
+                body, status = b"<html>Bad Request</html>", 400
+            else:
+                body = json.dumps(
+                    stub_response(address, query.get("key", [""])[0])
+                ).encode()
+                status = 200
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.stats = stats
+    return server
+
+
+def stub_url(server):
+    """
+    Returns the geocoding endpoint URL of a stub server.
+    """
+    return f"http://127.0.0.1:{server.server_address[1]}/maps/api/geocode/json"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = make_stub_server(args.port, args.latency, args.error_rate)
+    print(f"Stub geocoding API listening on {stub_url(server)}")
+    server.serve_forever()
@@ -0,0 +1,219 @@
+# OPERATING SYSTEM STUFF
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# API STUFF
+import requests
+from requests.adapters import HTTPAdapter
+
+# PROJECT MODULES
+import helpers
+
+# VARS -----------------------------------------
+
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+# API statuses worth retrying, everything else is final
+TRANSIENT_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+TRANSIENT_HTTP_CODES = {429, 500, 502, 503, 504}
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+class GeocodingError(Exception):
+    """
+    A geocoding request failed without an answer for its address, e.g. a
+    response that isn't the API's JSON.
+    """
+
+
+class TransientGeocodingError(GeocodingError):
+    """
+    A geocoding request failed in a way that is worth retrying.
+    """
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter for coroutines.
+
+    'rate' tokens are added per second, up to 'capacity'. Each request takes
+    one token, waiting for one to be added if the bucket is empty. Create it
+    inside the running event loop.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def make_session(pool_size):
+    """
+    Returns a requests session with a keep-alive pool of 'pool_size' connections.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_geocode(session, url, address, api_key, timeout=10):
+    """
+    Sends one geocoding request and returns the decoded JSON response.
+
+    Raises:
+    TransientGeocodingError: On connection errors, timeouts, 429/5xx responses,
+    and 'OVER_QUERY_LIMIT' / 'UNKNOWN_ERROR' API statuses.
+    GeocodingError: On a body that isn't JSON or has no 'results'. Not a
+    ValueError, which means a rejected key to the callers.
+    """
+    try:
+        response = session.get(
+            url, params={"address": address, "key": api_key}, timeout=timeout
+        )
+    except (requests.ConnectionError, requests.Timeout) as err:
+        raise TransientGeocodingError(str(err))
+
+    if response.status_code in TRANSIENT_HTTP_CODES:
+        raise TransientGeocodingError(f"HTTP {response.status_code}")
+
+    try:
+        res = response.json()
+    except ValueError:
+        raise GeocodingError(f"HTTP {response.status_code}, not a JSON response")
+    if res.get("status") in TRANSIENT_STATUSES:
+        raise TransientGeocodingError(res["status"])
+    if "results" not in res:
+        raise GeocodingError(f"HTTP {response.status_code}, {res.get('status')}")
+    return res
+
+
+async def geolocate_rows_async(
+    missing_rows,
+    api_key,
+    concurrency=10,
+    rate=40,
+    max_retries=5,
+    backoff=0.5,
+    url=GEOCODE_URL,
+):
+    """
+    Geolocates every row of a DataFrame concurrently. See 'geolocate_rows'.
+    """
+    rows = missing_rows.copy()
+    if rows.empty:
+        return rows
+
+    loop = asyncio.get_running_loop()
+    bucket = TokenBucket(rate)
+    semaphore = asyncio.Semaphore(concurrency)
+    session = make_session(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def geolocate_one(position):
+        row = rows.iloc[position].copy()
+        if row["GEOCODING ERR"]:
+            return row
+
+        address = helpers.geocoding_address(row)
+        for attempt in range(max_retries + 1):
+            async with semaphore:
+                await bucket.acquire()
+                try:
+                    res = await loop.run_in_executor(
+                        executor, fetch_geocode, session, url, address, api_key
+                    )
+                    return helpers.apply_geocoding_response(row, res)
+                except TransientGeocodingError as err:
+                    error = err
+                except GeocodingError as err:
+                    error = err
+                    break
+            if attempt < max_retries:
+                # Exponential backoff, outside the semaphore so others can proceed
+                await asyncio.sleep(backoff * 2**attempt)
+        # Left out of the results, so the row is looked up again next time
+        print(f"Geocoding '{address}' failed: {error}")
+        return None
+
+    tasks = [asyncio.ensure_future(geolocate_one(i)) for i in range(len(rows))]
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        # An invalid key stops the whole batch
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False)
+        session.close()
+
+    done = [row is not None for row in results]
+    rows = rows[done].copy()
+    for col in ("LATITUDE", "LONGITUDE", "GEOCODING ERR"):
+        rows[col] = [row[col] for row in results if row is not None]
+    return rows
+
+
+def geolocate_rows(missing_rows, api_key, **kwargs):
+    """
+    Geolocates every row of a DataFrame concurrently, e.g. the 'check_missing_rows' output.
+
+    Requests go through one pooled keep-alive session, with at most
+    'concurrency' in flight and at most 'rate' started per second. Transient
+    failures (timeouts, 429/5xx, 'OVER_QUERY_LIMIT') are retried with
+    exponential backoff. Rows get the same 'GEOCODING ERR', partial-match and
+    'LATITUDE'/'LONGITUDE' results as 'helpers.geolocate'. A row that still
+    fails after 'max_retries' retries, or gets a body that isn't the API's
+    JSON, is left out of the results instead of being marked as failed, so
+    it is looked up again on the next run.
+
+    The event loop runs on its own thread, so this also works inside a
+    notebook, where a loop is already running.
+
+    Args:
+    missing_rows (pandas.DataFrame): Rows with 'ADDRESS', 'BOROUGH', 'GEOCODING ERR',
+                                     'LATITUDE' and 'LONGITUDE' columns.
+    api_key (str): Google geocoding API key.
+    concurrency (int): Maximum number of requests in flight.
+    rate (float): Maximum number of requests started per second.
+    max_retries (int): Retries per row on transient failures.
+    backoff (float): Seconds to wait before the first retry, doubled every retry.
+    url (str): Geocoding endpoint, e.g. a local 'geocode_stub.py' server.
+
+    Returns:
+    pandas.DataFrame: A geocoded copy of the rows of 'missing_rows' that got an
+    answer, with their index.
+
+    Raises:
+    ValueError: If the API key was rejected.
+    """
+
+    def run():
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(
+                geolocate_rows_async(missing_rows, api_key, **kwargs)
+            )
+        finally:
+            loop.close()
+
+    with ThreadPoolExecutor(max_workers=1) as runner:
+        return runner.submit(run).result()
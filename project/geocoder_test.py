@@ -0,0 +1,136 @@
+# --------------------------------------------------------
+# TEST: Concurrent geocoding against the stub API
+# --------------------------------------------------------
+import time
+import threading
+
+import pandas as pd
+import pytest
+
+import helpers
+import geocoder
+import geocode_stub
+
+
+@pytest.fixture
+def stub_server(request):
+    options = getattr(request, "param", {})
+    server = geocode_stub.make_stub_server(seed=0, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def missing_rows_df(addresses):
+    return pd.DataFrame(
+        {
+            "BOROUGH CODE": 2,
+            "BOROUGH": "BRONX",
+            "NEIGHBORHOOD": "BATHGATE",
+            "ADDRESS": addresses,
+            "PRIMARY_KEY": ["BRONX_" + address for address in addresses],
+            "LATITUDE": None,
+            "LONGITUDE": None,
+            "GEOCODING ERR": False,
+        }
+    )
+
+
+# Results have the same semantics as 'helpers.geolocate'
+def test_geolocate_rows(stub_server):
+    rows = missing_rows_df(
+        ["2744 BOUCK AVE", "1 PARTIAL STREET", "1 NOWHERE LANE", "2746 BOUCK AVE"]
+    )
+    rows.loc[3, "GEOCODING ERR"] = True  # Already failed, must not be retried
+
+    result = geocoder.geolocate_rows(
+        rows, "key", url=geocode_stub.stub_url(stub_server)
+    )
+
+    lat, lng = geocode_stub.stub_location(helpers.geocoding_address(rows.iloc[0]))
+    assert result.loc[0, "LATITUDE"] == lat
+    assert result.loc[0, "LONGITUDE"] == lng
+    assert result["GEOCODING ERR"].tolist() == [False, True, True, True]
+    assert result.loc[1:, "LATITUDE"].isna().all()
+    assert stub_server.stats["requests"] == 3
+
+    # The input is not modified
+    assert rows["LATITUDE"].isna().all()
+
+
+# A rejected key stops the batch with the same error as 'helpers.geolocate'
+def test_geolocate_rows_invalid_key(stub_server):
+    rows = missing_rows_df(["2744 BOUCK AVE"])
+    with pytest.raises(ValueError, match="Invalid API Key for geocoding!"):
+        geocoder.geolocate_rows(rows, "expired", url=geocode_stub.stub_url(stub_server))
+
+
+# Transient 503s are retried until they succeed
+@pytest.mark.parametrize("stub_server", [{"error_rate": 0.3}], indirect=True)
+def test_geolocate_rows_retries(stub_server):
+    rows = missing_rows_df([f"{i} BOUCK AVE" for i in range(30)])
+
+    result = geocoder.geolocate_rows(
+        rows, "key", url=geocode_stub.stub_url(stub_server), backoff=0.01
+    )
+
+    assert stub_server.stats["errors"] > 0
+    assert stub_server.stats["requests"] == 30 + stub_server.stats["errors"]
+    assert not result["GEOCODING ERR"].any()
+    assert result["LATITUDE"].notna().all()
+
+
+# Rows that exhaust their retries or get a body that isn't JSON are left out
+# of the results, the others are kept
+@pytest.mark.parametrize("stub_server", [{"error_rate": 0.5}], indirect=True)
+def test_geolocate_rows_partial(stub_server):
+    rows = missing_rows_df([f"{i} BOUCK AVE" for i in range(30)] + ["1 GARBLED ST"])
+
+    result = geocoder.geolocate_rows(
+        rows, "key", url=geocode_stub.stub_url(stub_server), max_retries=0
+    )
+
+    # One request per row, every 503 but the garbled row's one cost a row
+    assert stub_server.stats["requests"] == 31
+    assert len(result) + stub_server.stats["errors"] in (30, 31)
+    assert 0 < len(result) < 30
+    assert 30 not in result.index
+    assert not result["GEOCODING ERR"].any()
+    assert result["LATITUDE"].notna().all()
+    assert rows.loc[result.index, "ADDRESS"].tolist() == result["ADDRESS"].tolist()
+
+
+# The token bucket caps the request rate
+def test_geolocate_rows_rate_limit(stub_server):
+    rows = missing_rows_df([f"{i} BOUCK AVE" for i in range(30)])
+
+    start = time.perf_counter()
+    geocoder.geolocate_rows(
+        rows, "key", url=geocode_stub.stub_url(stub_server), concurrency=30, rate=20
+    )
+
+    # 20 requests from the full bucket, 10 more at 20 per second
+    assert time.perf_counter() - start >= 0.45
+
+
+# Compare throughput with one blocking request per row
+@pytest.mark.parametrize("stub_server", [{"latency": 0.02}], indirect=True)
+def test_geolocate_rows_throughput(stub_server):
+    rows = missing_rows_df([f"{i} BOUCK AVE" for i in range(100)])
+    url = geocode_stub.stub_url(stub_server)
+
+    start = time.perf_counter()
+    geocoder.geolocate_rows(rows, "key", url=url, concurrency=1, rate=10000)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    geocoder.geolocate_rows(rows, "key", url=url, concurrency=20, rate=10000)
+    concurrent = time.perf_counter() - start
+
+    print(
+        f"\n100 rows: serial {100 / serial:.0f} rows/s, "
+        f"concurrent {100 / concurrent:.0f} rows/s"
+    )
+    assert concurrent < serial / 3
@@ -3,6 +3,7 @@ import os
 import io
 import gc
 import time
+from collections import namedtuple
 
 # CONFIG
 import importlib
@@ -30,23 +31,60 @@ from sqlalchemy import (
     text,
     String,
     Integer,
+    SmallInteger,
+    BigInteger,
     Float,
     Boolean,
+    DateTime,
     MetaData,
     Table,
     select,
     # OperationalError,
 )
 from sqlalchemy.exc import (
+    OperationalError,
     ProgrammingError,
 )  # ProgrammingError catches SQL write exceptions
 from sqlalchemy.sql import and_
+from sqlalchemy.engine import Engine
 
 # CONFIGURATION FILES
 import config
 
+# PROJECT MODULES
+import db
+import writer
+from address_index import normalize_address
+
 # VARS -----------------------------------------
 
+# Columns of the geocodes SQL table
+GEOCODES_TABLE_COLUMNS = [
+    "BOROUGH CODE",
+    "BOROUGH",
+    "NEIGHBORHOOD",
+    "ADDRESS",
+    "LATITUDE",
+    "LONGITUDE",
+    "GEOCODING ERR",
+    "PRIMARY_KEY",
+]
+
+# Hashed join key of the geocodes and sales tables, see 'geo_keys'
+GEO_KEY_COLUMN = "GEO_KEY"
+
+# Keys per INSERT batch in 'check_missing_rows_server_side'
+ANTI_JOIN_CHUNKSIZE = 5000
+
+# Key checksums of 'verify_sql_subset' are sums of the keys modulo this prime
+# (the largest below 2**32), so they fit in a 64-bit SUM on either side
+CHECKSUM_MODULUS = 4294967291
+
+# Result of 'verify_sql_subset'
+Verification = namedtuple(
+    "Verification", ["ok", "mismatched_partitions", "missing_keys"]
+)
+
 # Map between NYC and Zillow categories
 """
 mapping = {
@@ -119,6 +157,63 @@ geocoding_data_types_sqlalchemy = {
     "LATITUDE": Float,
     "LONGITUDE": Float,
     "GEOCODING ERR": Boolean,
+    "PRIMARY_KEY": String(255),
+    "GEO_KEY": BigInteger,
+}
+
+# SQL types of the sales table
+sales_data_types_sqlalchemy = {
+    "BOROUGH CODE": SmallInteger,
+    "BOROUGH": String(25),
+    "NEIGHBORHOOD": String(100),
+    "BUILDING CLASS CATEGORY": String(100),
+    "GROUPED CATEGORY": String(50),
+    "TAX CLASS AT PRESENT": String(5),
+    "BLOCK": Integer,
+    "LOT": Integer,
+    "EASEMENT": String(25),
+    "BUILDING CLASS AT PRESENT": String(5),
+    "ADDRESS": String(255),
+    "APARTMENT NUMBER": String(50),
+    "ZIP CODE": Integer,
+    "RESIDENTIAL UNITS": Integer,
+    "COMMERCIAL UNITS": Integer,
+    "TOTAL UNITS": Integer,
+    "LAND SQUARE FEET": Float,
+    "GROSS SQUARE FEET": Float,
+    "YEAR BUILT": SmallInteger,
+    "TAX CLASS AT TIME OF SALE": SmallInteger,
+    "BUILDING CLASS AT TIME OF SALE": String(5),
+    "SALE PRICE": Float(precision=53),  # DOUBLE, MySQL's FLOAT rounds like float32
+    "SALE DATE": DateTime,
+    "GEO_KEY": BigInteger,
+}
+
+# Compact in-memory types for the rolling-sales data. Repeated strings
+# become categoricals, numerics are downcast, and integer columns with
+# blanks use pandas' nullable integer types. Prices stay float64: float32
+# only has 24 bits of mantissa, so it rounds prices above ~$16.7M.
+sales_data_types_df = {
+    "BOROUGH CODE": "Int8",
+    "BOROUGH": "category",
+    "NEIGHBORHOOD": "category",
+    "BUILDING CLASS CATEGORY": "category",
+    "GROUPED CATEGORY": "category",
+    "TAX CLASS AT PRESENT": "category",
+    "BUILDING CLASS AT PRESENT": "category",
+    "BUILDING CLASS AT TIME OF SALE": "category",
+    "ADDRESS": "category",
+    "BLOCK": "Int32",
+    "LOT": "Int32",
+    "ZIP CODE": "Int32",
+    "RESIDENTIAL UNITS": "Int32",
+    "COMMERCIAL UNITS": "Int32",
+    "TOTAL UNITS": "Int32",
+    "YEAR BUILT": "Int16",
+    "TAX CLASS AT TIME OF SALE": "Int8",
+    "LAND SQUARE FEET": "float32",
+    "GROSS SQUARE FEET": "float32",
+    "SALE PRICE": "float64",
 }
 
 # URL order: [Manhattan, Bronx, Brooklyn, Queens, Staten Island]
@@ -142,56 +237,219 @@ def testFunction(toPrint):
     print(f"Printing:{toPrint}")
 
 
+# Columns every rolling-sales DataFrame must have
+REQUIRED_PREPROCESSING_COLUMNS = [
+    "BOROUGH",
+    "NEIGHBORHOOD",
+    "BUILDING CLASS CATEGORY",
+    "ADDRESS",
+    "LAND SQUARE FEET",
+    "GROSS SQUARE FEET",
+    "SALE PRICE",
+]
+
+
+def _common_dtypes(dataFrames, columns=None):
+    """
+    Finds the common column types of DataFrames, so 'pd.concat' doesn't upcast to object.
+
+    - Categorical columns get the union of every DataFrame's categories.
+    - Columns that are numeric in some DataFrames and strings in others
+      (blank cells in a workbook) are coerced to numeric.
+
+    Only reads dtypes and categories, see '_cast_dtypes' to apply them.
+
+    Returns:
+    tuple: ({column: CategoricalDtype}, set of columns to coerce to numeric)
+    """
+    # Gather each column's dtypes across the DataFrames
+    column_dtypes = {}
+    for dataFrame in dataFrames:
+        for col, dtype in dataFrame.dtypes.items():
+            if columns is None or col in columns:
+                column_dtypes.setdefault(col, []).append(dtype)
+
+    categorical, numeric = {}, set()
+    for col, dtypes in column_dtypes.items():
+        if any(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+            categories = [
+                (
+                    dataFrame[col].cat.categories
+                    if isinstance(dataFrame[col].dtype, pd.CategoricalDtype)
+                    else pd.Index(dataFrame[col].dropna().unique())
+                )
+                for dataFrame in dataFrames
+                if col in dataFrame.columns
+            ]
+            categorical[col] = pd.CategoricalDtype(
+                categories[0].append(categories[1:]).unique()
+            )
+        elif any(pd.api.types.is_numeric_dtype(dtype) for dtype in dtypes) and any(
+            pd.api.types.is_object_dtype(dtype) for dtype in dtypes
+        ):
+            numeric.add(col)
+    return categorical, numeric
+
+
+def _cast_dtypes(dataFrame, categorical, numeric):
+    """
+    Casts one DataFrame to the common column types of '_common_dtypes'.
+    """
+    converted = {
+        col: dataFrame[col].astype(dtype)
+        for col, dtype in categorical.items()
+        if col in dataFrame.columns and dataFrame[col].dtype != dtype
+    }
+    converted.update(
+        {
+            col: pd.to_numeric(dataFrame[col], errors="coerce")
+            for col in numeric
+            if col in dataFrame.columns
+            and pd.api.types.is_object_dtype(dataFrame[col].dtype)
+        }
+    )
+    return dataFrame.assign(**converted) if converted else dataFrame
+
+
 # Takes in an array of dataframes with the same columns, and returns
 # a larger dataframe of the data, combined.
-def combineHousingDataSets(dataFrames):
+def combineHousingDataSets(dataFrames, columns=None, lazy=False):
     """
     Combines multiple housing datasets into a single DataFrame.
 
+    Each DataFrame's columns are validated once, projected to 'columns' and
+    cast to common column types before they are concatenated, so any number
+    of borough or historical yearly files can be combined.
+
     Parameters:
     dataFrames (list): A list of pandas DataFrames containing housing data.
+    columns (list): Columns to keep. Defaults to every column of every DataFrame.
+    lazy (bool): If True, return a generator that yields the projected,
+                 reconciled DataFrames one at a time instead of concatenating
+                 them, e.g. to write them to SQL in chunks. Each DataFrame is
+                 only copied when it is yielded.
 
     Returns:
     - 'False' if all the required columns are not present in each of
     the dataFrames individually.
     - pandas.DataFrame, a combined DataFrame containing data from all input
     DataFrames if the required columns are present.
+    - generator of pandas.DataFrames if 'lazy' is True.
     """
-    # Define required columns
-    REQUIRED_PREPROCESSING_COLUMNS = [
-        "BOROUGH",
-        "NEIGHBORHOOD",
-        "BUILDING CLASS CATEGORY",
-        "ADDRESS",
-        "LAND SQUARE FEET",
-        "GROSS SQUARE FEET",
-        "SALE PRICE",
-    ]
+    required = set(REQUIRED_PREPROCESSING_COLUMNS)
 
-    # Check to see if columns exist
+    # Check to see if columns exist, in a single pass
     for dataFrame in dataFrames:
         # Removes extra spaces
         dataFrame.columns = dataFrame.columns.str.strip()
 
         # Checks if required columns are present
-        for dataFrame in dataFrames:
-            if not set(REQUIRED_PREPROCESSING_COLUMNS).issubset(dataFrame.columns):
-                # Returns false if they are not
-                print(dataFrame)
-                return False
+        if not required.issubset(dataFrame.columns):
+            # Returns false if they are not
+            print(dataFrame)
+            return False
+
+    # The common types only need dtypes & categories, the copies are made per
+    # DataFrame, so the lazy view holds one copy at a time
+    categorical, numeric = _common_dtypes(dataFrames, columns)
+
+    def reconciled(dataFrame):
+        # Projects to the requested columns
+        if columns is not None:
+            dataFrame = dataFrame[[col for col in columns if col in dataFrame.columns]]
+        return _cast_dtypes(dataFrame, categorical, numeric)
+
+    if lazy:
+        return (reconciled(dataFrame) for dataFrame in dataFrames)
 
     # Combine the dataframes and return a new DataFrame
-    return pd.concat(dataFrames, ignore_index=True)
+    return pd.concat(
+        [reconciled(dataFrame) for dataFrame in dataFrames], ignore_index=True
+    )
+
+
+def apply_sales_schema(df, schema=sales_data_types_df):
+    """
+    Converts a rolling-sales DataFrame to the compact types in 'schema'.
+
+    Columns not in the DataFrame are skipped, and columns not in the schema
+    are left as they are.
+
+    Parameters:
+    df (pd.DataFrame): The rolling-sales DataFrame, e.g. 'combined'.
+    schema (dict): A dictionary mapping column names to pandas dtypes.
+
+    Returns:
+    pd.DataFrame: A new DataFrame with the schema applied.
+
+    Raises:
+    ValueError: If a column cannot be converted to its schema type.
+    """
+    converted = {}
+    for col, dtype in schema.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        try:
+            if dtype == "category":
+                converted[col] = df[col].astype("category")
+            else:
+                # Blank cells in the NYC workbooks come through as strings
+                converted[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+        except (TypeError, ValueError) as err:
+            raise ValueError(f"Column '{col}' cannot be converted to {dtype}: {err}")
+
+    return df.assign(**converted)
+
+
+def group_categories(building_classes, mapping=category_mapping):
+    """
+    Maps NYC building class categories to the grouped (Zillow) categories.
+
+    For a categorical Series the mapping runs once per category and the
+    integer codes are remapped, instead of mapping every row's string.
+    Unmapped categories become NaN, like 'Series.map'.
+
+    Parameters:
+    building_classes (pd.Series): The 'BUILDING CLASS CATEGORY' column.
+    mapping (dict): A dictionary mapping building classes to grouped categories.
+
+    Returns:
+    pd.Series: The grouped categories, categorical if the input is categorical.
+    """
+    if not isinstance(building_classes.dtype, pd.CategoricalDtype):
+        return building_classes.map(mapping)
+
+    # Map each category once, then translate old codes to new codes
+    mapped = building_classes.cat.categories.map(lambda cat: mapping.get(cat))
+    grouped = pd.Index(mapped.dropna().unique())
+    code_table = np.append(grouped.get_indexer(mapped), -1)
+
+    # Code -1 (missing) indexes the trailing -1 in 'code_table'
+    codes = code_table[building_classes.cat.codes.to_numpy()]
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=grouped),
+        index=building_classes.index,
+        name=building_classes.name,
+    )
 
 
 # Remove outliars in the data
 def filterOutliers(
-    df: pd.DataFrame, thresholds: dict, quantile_lower: float, quantile_upper: float
+    df: pd.DataFrame,
+    thresholds: dict,
+    quantile_lower: float,
+    quantile_upper: float,
+    group_by=None,
 ) -> pd.DataFrame:
     """
     Removes rows with values "close to zero" and outliers from the given DataFrame based on the provided thresholds
     and quantiles.
 
+    A single boolean mask is built over all the columns and the DataFrame is
+    only materialized once, at the end. With 'group_by', the IQR bounds are
+    computed per group (e.g. per borough), since a Staten Island outlier is
+    not a Manhattan outlier.
+
     Parameters:
     df (pd.DataFrame): The input DataFrame to be cleaned.
     thresholds (dict): A dictionary mapping column names to thresholds. Rows in the columns specified where the value
@@ -200,6 +458,8 @@ def filterOutliers(
                             the lower bound for outliers.
     quantile_upper (float): The upper quantile for calculating the IQR. This is used to determine the upper bound for
                             outliers.
+    group_by (str or list): Optional column(s), e.g. 'BOROUGH CODE' and/or 'GROUPED CATEGORY', to compute the IQR
+                            bounds per group.
 
     Returns:
     pd.DataFrame: A new DataFrame with the outliers and values close to zero removed.
@@ -207,28 +467,38 @@ def filterOutliers(
     Raises:
     ValueError: If a column specified in thresholds does not exist in the DataFrame or if it does not contain numeric data.
     """
-    # Start by copying the data
-    data_clean = df.copy()
-
     # Validate columns and datatypes
     for col in thresholds:
-        if col not in data_clean.columns:
+        if col not in df.columns:
             raise ValueError(f"Column '{col}' not found in DataFrame.")
-        if not pd.api.types.is_numeric_dtype(data_clean[col]):
+        if not pd.api.types.is_numeric_dtype(df[col]):
             raise ValueError(f"Column '{col}' must contain numeric data.")
 
+    if isinstance(group_by, str):
+        group_by = [group_by]
+    for col in group_by or []:
+        if col not in df.columns:
+            raise ValueError(f"Column '{col}' not found in DataFrame.")
+
     # Remove rows with values "close to zero"
+    mask = np.ones(len(df), dtype=bool)
     for col, threshold in thresholds.items():
-        data_clean = data_clean[data_clean[col] >= threshold]
+        mask &= (df[col] >= threshold).to_numpy(dtype=bool, na_value=False)
 
-    # List of columns to remove outliers from
-    cols_to_check = list(thresholds.keys())
+    # Remove outliers, one column at a time, from the rows still in the mask
+    for col in thresholds:
+        values = df[col]
 
-    # Remove outliers
-    for col in cols_to_check:
-        # Calculate the IQR of each column
-        Q1 = data_clean[col].quantile(quantile_lower)
-        Q3 = data_clean[col].quantile(quantile_upper)
+        # Calculate the IQR of each column (per group, if grouped)
+        if group_by:
+            groups = values.where(mask).groupby(
+                [df[key] for key in group_by], observed=True, dropna=False
+            )
+            Q1 = groups.transform("quantile", quantile_lower)
+            Q3 = groups.transform("quantile", quantile_upper)
+        else:
+            Q1 = values[mask].quantile(quantile_lower)
+            Q3 = values[mask].quantile(quantile_upper)
         IQR = Q3 - Q1
 
         # Define the upper and lower bounds for outliers
@@ -236,45 +506,53 @@ def filterOutliers(
         upper_bound = Q3 + 1.5 * IQR
 
         # Remove outliers
-        data_clean = data_clean[
-            (data_clean[col] >= lower_bound) & (data_clean[col] <= upper_bound)
-        ]
+        mask &= ((values >= lower_bound) & (values <= upper_bound)).to_numpy(
+            dtype=bool, na_value=False
+        )
 
     # Return the cleaned data
-    return data_clean
+    return df[mask]
 
 
-# Checks for missing rows
-def check_missing_rows(local_df, sql_table_name, engine):
+def geo_keys(boroughs, addresses):
     """
-    Compares a local DataFrame with an SQL table to identify and return any missing rows.
+    Computes the 64-bit join key of every (borough, address) pair.
 
-    Args:
-    local_df (pandas.DataFrame): The DataFrame to be compared with the SQL table.
-    sql_table_name (str): The name of the SQL table to be compared with the local DataFrame.
-    engine: The SQLAlchemy engine instance facilitating the database connection.
-
-    Returns:
-    pandas.DataFrame or bool: Returns a DataFrame containing missing rows if any are found.
-    If no missing rows are detected, returns False.
+    The key hashes the normalized primary key, e.g. 'MANHATTAN_254 W 27 ST'
+    (see 'address_index.normalize_address'), so spelling variants of an
+    address share one key. Each distinct address is normalized once, the
+    hashing itself is vectorized.
 
-    Raises:
-    KeyError: If mandatory columns are missing in either the local DataFrame or the SQL table DataFrame.
-    IOError: If an error arises while executing the SQL query.
-    ValueError: If one of the following conditions are encountered:
-    - The SQL query yields an empty DataFrame.
-    - The local DataFrame is empty.
-    - The 'PRIMARY_KEY' column is absent in either the local DataFrame or the SQL table DataFrame.
+    :param boroughs: Borough names, e.g. the 'BOROUGH' column
+    :param addresses: Street addresses, e.g. the 'ADDRESS' column
+    :return: numpy int64 array of keys, in row order
     """
+    codes, uniques = pd.factorize(pd.Series(addresses).astype(object))
+    # Code -1 (missing address) picks the trailing ''
+    normalized = np.array(
+        [normalize_address(address) for address in uniques] + [""], dtype=object
+    )[codes]
+    keys = pd.Series(
+        pd.Series(boroughs).astype(str).to_numpy(object) + "_" + normalized
+    )
+
+    # MySQL BIGINT is signed
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy().view(np.int64)
+
+
+def _local_geocode_candidates(local_df):
+    # Geo-columns of the local data, with the columns filled in by geocoding
     try:
         # Create a DataFrame of geo-columns only from local data
         geocodes_local = local_df[
             ["BOROUGH CODE", "BOROUGH", "NEIGHBORHOOD", "ADDRESS"]
         ].copy()
 
-        # Add primary key column
+        # Add primary key column (categorical columns don't support '+')
         geocodes_local["PRIMARY_KEY"] = (
-            geocodes_local["BOROUGH"] + "_" + geocodes_local["ADDRESS"]
+            geocodes_local["BOROUGH"].astype(object)
+            + "_"
+            + geocodes_local["ADDRESS"].astype(object)
         )
 
         # Add additional geo-columns for geocoding
@@ -287,29 +565,14 @@ def check_missing_rows(local_df, sql_table_name, engine):
     except KeyError:
         # Error 1: If mandatory columns are missing in the local DataFrame
         raise KeyError(f"Columns are missing in local Dataframe")
+    return geocodes_local
 
-    try:
-        # Load geocodes SQL table into a DataFrame
-        geocodes_table_response = pd.read_sql_query(
-            f"SELECT * FROM {sql_table_name}", engine
-        )
-    except Exception as e:
-        # Error 2: If an error occurs while executing the SQL query
-        raise IOError(f"SQL query error: {e}")
 
+def _validate_geocodes_response(geocodes_table_response, geocodes_local):
+    # Errors 3 to 5 of 'check_missing_rows'
     if geocodes_table_response.empty:
         raise ValueError("SQL Database is empty")
-    expected_columns = [
-        "BOROUGH CODE",
-        "BOROUGH",
-        "NEIGHBORHOOD",
-        "ADDRESS",
-        "LATITUDE",
-        "LONGITUDE",
-        "GEOCODING ERR",
-        "PRIMARY_KEY",
-    ]
-    missing_columns = set(expected_columns) - set(geocodes_table_response.columns)
+    missing_columns = set(GEOCODES_TABLE_COLUMNS) - set(geocodes_table_response.columns)
     if missing_columns:
         # Error 3: If the SQL query returns data with the incorrect columns
         raise KeyError("Columns are missing in SQL response")
@@ -325,9 +588,79 @@ def check_missing_rows(local_df, sql_table_name, engine):
     ):
         raise ValueError("Missing 'PRIMARY_KEY' column in one of the DataFrames")
 
-    # Find rows in local data not in our existing geocoding data
+
+def _load_candidate_keys(connection, keys, key_column, key_type, chunksize):
+    # Bulk-loads distinct keys into the temporary table 'candidate_keys'
+    # Temporary tables outlive a failed transaction on a pooled connection
+    connection.execute(
+        text(
+            "DROP TEMPORARY TABLE IF EXISTS candidate_keys"
+            if connection.dialect.name == "mysql"
+            else "DROP TABLE IF EXISTS temp.candidate_keys"
+        )
+    )
+    connection.execute(
+        text(
+            f"CREATE TEMPORARY TABLE candidate_keys "
+            f"({key_column} {key_type} NOT NULL PRIMARY KEY)"
+        )
+    )
+    insert = text(f"INSERT INTO candidate_keys ({key_column}) VALUES (:key)")
+    for start in range(0, len(keys), chunksize):
+        connection.execute(
+            insert,
+            [{"key": key} for key in keys.iloc[start : start + chunksize].tolist()],
+        )
+
+
+# Checks for missing rows
+def check_missing_rows(local_df, sql_table_name, engine):
+    """
+    Compares a local DataFrame with an SQL table to identify and return any missing rows.
+
+    Reads the whole SQL table, see 'check_missing_rows_server_side' to only
+    transfer the missing keys.
+
+    Rows stored with 'GEOCODING ERR' count as missing too, so they go back
+    through the geocode cache, which retries them once their negative entry
+    expires (see 'geocode_cache.GeocodeCache').
+
+    Args:
+    local_df (pandas.DataFrame): The DataFrame to be compared with the SQL table.
+    sql_table_name (str): The name of the SQL table to be compared with the local DataFrame.
+    engine: The SQLAlchemy engine instance facilitating the database connection.
+
+    Returns:
+    pandas.DataFrame or bool: Returns a DataFrame containing missing rows if any are found.
+    If no missing rows are detected, returns False.
+
+    Raises:
+    KeyError: If mandatory columns are missing in either the local DataFrame or the SQL table DataFrame.
+    IOError: If an error arises while executing the SQL query.
+    ValueError: If one of the following conditions are encountered:
+    - The SQL query yields an empty DataFrame.
+    - The local DataFrame is empty.
+    - The 'PRIMARY_KEY' column is absent in either the local DataFrame or the SQL table DataFrame.
+    """
+    geocodes_local = _local_geocode_candidates(local_df)
+
+    try:
+        # Load geocodes SQL table into a DataFrame
+        geocodes_table_response = pd.read_sql_query(
+            f"SELECT * FROM {sql_table_name}", engine
+        )
+    except Exception as e:
+        # Error 2: If an error occurs while executing the SQL query
+        raise IOError(f"SQL query error: {e}")
+
+    _validate_geocodes_response(geocodes_table_response, geocodes_local)
+
+    # Find rows in local data not in our existing geocoding data, or failed there
+    geocoded = geocodes_table_response[
+        ~geocodes_table_response["GEOCODING ERR"].fillna(True).astype(bool)
+    ]
     missing_rows = geocodes_local[
-        ~geocodes_local["PRIMARY_KEY"].isin(geocodes_table_response["PRIMARY_KEY"])
+        ~geocodes_local["PRIMARY_KEY"].isin(geocoded["PRIMARY_KEY"])
     ].reset_index(drop=True)
 
     # If there are no missing rows, return False
@@ -339,10 +672,247 @@ def check_missing_rows(local_df, sql_table_name, engine):
     return missing_rows
 
 
+def check_missing_rows_server_side(
+    local_df,
+    sql_table_name,
+    engine,
+    chunksize=ANTI_JOIN_CHUNKSIZE,
+    key_column="PRIMARY_KEY",
+):
+    """
+    Same as 'check_missing_rows', but lets the database find the missing rows.
+
+    The distinct local keys are bulk-loaded into a temporary table on one
+    connection, and the database anti-joins it against the indexed key of
+    the geocodes table (NOT EXISTS). Only the missing keys come back over
+    the wire, instead of the whole geocodes table. Like 'check_missing_rows',
+    keys stored with 'GEOCODING ERR' count as missing.
+
+    Args:
+    local_df (pandas.DataFrame): The DataFrame to be compared with the SQL table.
+    sql_table_name (str): The name of the SQL table to be compared with the local DataFrame.
+    engine: The SQLAlchemy engine instance facilitating the database connection.
+    chunksize (int): Keys per INSERT batch into the temporary table.
+    key_column (str): 'PRIMARY_KEY', or 'GEO_KEY' to compare the hashed keys
+                      (see 'geo_keys'). The missing rows then include 'GEO_KEY'.
+
+    Returns:
+    pandas.DataFrame or bool: Returns a DataFrame containing missing rows if any are found.
+    If no missing rows are detected, returns False.
+
+    Raises:
+    The same errors as 'check_missing_rows'.
+    """
+    geocodes_local = _local_geocode_candidates(local_df)
+    key_type = "VARCHAR(255)"
+    if key_column == GEO_KEY_COLUMN:
+        key_type = "BIGINT"
+        geocodes_local[GEO_KEY_COLUMN] = (
+            local_df[GEO_KEY_COLUMN].to_numpy()
+            if GEO_KEY_COLUMN in local_df.columns
+            else geo_keys(local_df["BOROUGH"], local_df["ADDRESS"])
+        )
+    candidate_keys = geocodes_local[key_column].drop_duplicates()
+
+    try:
+        with engine.begin() as connection:
+            # One row is enough to check the table isn't empty and has the columns
+            geocodes_table_response = pd.read_sql_query(
+                f"SELECT * FROM {sql_table_name} LIMIT 1", connection
+            )
+            _validate_geocodes_response(geocodes_table_response, geocodes_local)
+            if key_column not in geocodes_table_response.columns:
+                raise KeyError("Columns are missing in SQL response")
+
+            _load_candidate_keys(
+                connection, candidate_keys, key_column, key_type, chunksize
+            )
+            missing_keys = pd.read_sql_query(
+                f"SELECT c.{key_column} FROM candidate_keys c WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {sql_table_name} g "
+                f"WHERE g.{key_column} = c.{key_column} AND NOT g.`GEOCODING ERR`)",
+                connection,
+            )[key_column]
+            connection.execute(text("DROP TABLE candidate_keys"))
+    except (KeyError, ValueError):
+        raise
+    except Exception as e:
+        # Error 2: If an error occurs while executing the SQL query
+        raise IOError(f"SQL query error: {e}")
+
+    # Keep every local row of a missing key, in local order
+    missing_rows = geocodes_local[
+        geocodes_local[key_column].isin(missing_keys)
+    ].reset_index(drop=True)
+
+    # If there are no missing rows, return False
+    if missing_rows.empty:
+        print("No missing rows found")
+        return False
+
+    return missing_rows
+
+
+def check_missing_rows_parquet(local_df, store, table_name):
+    """
+    Same as 'check_missing_rows_server_side', against a Parquet geocodes table.
+
+    DuckDB anti-joins the local 'GEO_KEY's against the table in-process, reading
+    only the key and 'GEOCODING ERR' columns (see 'parquet_store.ParquetStore').
+
+    Args:
+    local_df (pandas.DataFrame): The DataFrame to be compared with the geocodes table.
+    store (parquet_store.ParquetStore): The store holding the geocodes table.
+    table_name (str): The name of the geocodes table.
+
+    Returns:
+    pandas.DataFrame or bool: Returns a DataFrame containing missing rows if any are found.
+    If no missing rows are detected, returns False.
+
+    Raises:
+    The same errors as 'check_missing_rows'.
+    """
+    geocodes_local = _local_geocode_candidates(local_df)
+    geocodes_local[GEO_KEY_COLUMN] = (
+        local_df[GEO_KEY_COLUMN].to_numpy()
+        if GEO_KEY_COLUMN in local_df.columns
+        else geo_keys(local_df["BOROUGH"], local_df["ADDRESS"])
+    )
+
+    try:
+        # One row is enough to check the table isn't empty and has the columns
+        geocodes_table_response = store.query(
+            f"SELECT * FROM {store.scan(table_name)} LIMIT 1"
+        )
+    except Exception as e:
+        # Error 2: If an error occurs while executing the SQL query
+        raise IOError(f"SQL query error: {e}")
+    _validate_geocodes_response(geocodes_table_response, geocodes_local)
+
+    missing = store.query(
+        f"SELECT DISTINCT c.{GEO_KEY_COLUMN} FROM candidates c WHERE NOT EXISTS "
+        f"(SELECT 1 FROM {store.scan(table_name)} g "
+        f'WHERE g.{GEO_KEY_COLUMN} = c.{GEO_KEY_COLUMN} AND NOT g."GEOCODING ERR")',
+        candidates=geocodes_local[[GEO_KEY_COLUMN]],
+    )[GEO_KEY_COLUMN]
+
+    # Keep every local row of a missing key, in local order
+    missing_rows = geocodes_local[
+        geocodes_local[GEO_KEY_COLUMN].isin(missing)
+    ].reset_index(drop=True)
+
+    # If there are no missing rows, return False
+    if missing_rows.empty:
+        print("No missing rows found")
+        return False
+
+    return missing_rows
+
+
+def merge_geocodes_parquet(sales, store, table_name, mapping=category_mapping):
+    """
+    Adds the coordinates and grouped categories to the sales, in one DuckDB query.
+
+    Same result as the SQL backend's left merge in pandas,
+    'sales.merge(geocodes, on=GEO_KEY, how="left")', followed by
+    'group_categories': every sale is kept in order, sales without a geocode
+    get NaN coordinates, a sale matching several geocodes is repeated, and
+    the index is reset. Unmapped categories are NaN.
+
+    Args:
+    sales (pandas.DataFrame): Sales with a 'GEO_KEY' column, e.g. 'combined'.
+    store (parquet_store.ParquetStore): The store holding the geocodes table.
+    table_name (str): The name of the geocodes table.
+    mapping (dict): A dictionary mapping building classes to grouped categories.
+
+    Returns:
+    pandas.DataFrame: The sales with 'LATITUDE', 'LONGITUDE' and 'GROUPED CATEGORY'.
+    """
+    categories = pd.DataFrame(
+        {"category": list(mapping.keys()), "grouped": list(mapping.values())}
+    )
+    joined = store.query(
+        f"SELECT s.row_number, g.LATITUDE, g.LONGITUDE, m.grouped "
+        f"FROM keys s "
+        f"LEFT JOIN {store.scan(table_name)} g ON g.{GEO_KEY_COLUMN} = s.{GEO_KEY_COLUMN} "
+        f"LEFT JOIN categories m ON m.category = s.category "
+        f"ORDER BY s.row_number",
+        keys=pd.DataFrame(
+            {
+                "row_number": np.arange(len(sales)),
+                GEO_KEY_COLUMN: sales[GEO_KEY_COLUMN].to_numpy(),
+                "category": sales["BUILDING CLASS CATEGORY"].astype(object).to_numpy(),
+            }
+        ),
+        categories=categories,
+    )
+
+    # Only the join results come back, the sales columns keep their types
+    merged = sales.iloc[joined["row_number"].to_numpy()].reset_index(drop=True)
+    merged["LATITUDE"] = joined["LATITUDE"].to_numpy()
+    merged["LONGITUDE"] = joined["LONGITUDE"].to_numpy()
+    merged["GROUPED CATEGORY"] = pd.Categorical(joined["grouped"])
+    return merged
+
+
+def geocoding_address(row):
+    """
+    Builds the address string sent to the geocoding API for a row.
+
+    Args:
+        row (pandas.Series): A row containing 'ADDRESS' and 'BOROUGH'.
+
+    Returns:
+        str: e.g. '2744 BOUCK AVE, BRONX, New York City'
+    """
+    return ", ".join([row["ADDRESS"], row["BOROUGH"]]) + ", New York City"
+
+
+def apply_geocoding_response(row, res):
+    """
+    Updates a row from a geocoding API JSON response.
+
+    Args:
+        row (pandas.Series): A row containing address information and geocoding status.
+        res (dict): The decoded JSON response of the geocoding API.
+
+    Returns:
+        pandas.Series: The updated row with latitude and longitude information if geocoding was successful,
+        or with geocoding error flag and null latitude and longitude values if geocoding failed.
+
+    Raises:
+        ValueError: If the API key was rejected.
+    """
+    # Check for API key failure, this is what it looks like if it's expired...
+    # {'error_message': 'The provided API key is expired. ', 'results': [], 'status': 'REQUEST_DENIED'}
+    if str(res.get("error_message", {})).find("key") != -1:
+        raise ValueError("Invalid API Key for geocoding!")
+
+    if res["results"]:
+        location = res["results"][0]
+        if location.get("partial_match"):  # Check for partial match
+            row["GEOCODING ERR"] = True
+            row["LATITUDE"] = None
+            row["LONGITUDE"] = None
+        else:
+            row["LATITUDE"] = location["geometry"]["location"]["lat"]
+            row["LONGITUDE"] = location["geometry"]["location"]["lng"]
+    else:
+        # Update GEOCODING ERR to True if geolocation failed
+        row["GEOCODING ERR"] = True
+
+        # Assign 'None' to lat and long fields
+        row["LATITUDE"] = None
+        row["LONGITUDE"] = None
+    return row
+
+
 def geolocate(row, api_key):
     """
     Geolocates a row by running a geocoding API request based on the address information provided in the row.
 
+    See 'geocoder.geolocate_rows' to geolocate many rows concurrently.
+
     Args:
         row (pandas.Series): A row containing address information and geocoding status.
 
@@ -351,52 +921,28 @@ def geolocate(row, api_key):
         or with geocoding error flag and null latitude and longitude values if geocoding failed.
     """
     if not row["GEOCODING ERR"]:  # If 'GEOCODING ERR' is False, run the geocoding API
-        address = (
-            ", ".join(
-                [
-                    row["ADDRESS"],
-                    row["BOROUGH"],
-                ]
-            )
-            + ", New York City"
-        )
+        address = geocoding_address(row)
         response = requests.get(
             f"https://maps.googleapis.com/maps/api/geocode/json?address={address}&key={api_key}"
         )
         res = response.json()  # Assign json response to 'res'
-
-        # Check for API key failure, this is what it looks like if it's expired...
-        # {'error_message': 'The provided API key is expired. ', 'results': [], 'status': 'REQUEST_DENIED'}
-        if str(res.get("error_message", {})).find("key") is not -1:
-            raise ValueError("Invalid API Key for geocoding!")
-
-        if res["results"]:
-            location = res["results"][0]
-            if location.get("partial_match"):  # Check for partial match
-                row["GEOCODING ERR"] = True
-                row["LATITUDE"] = None
-                row["LONGITUDE"] = None
-            else:
-                row["LATITUDE"] = location["geometry"]["location"]["lat"]
-                row["LONGITUDE"] = location["geometry"]["location"]["lng"]
-        else:
-            # Update GEOCODING ERR to True if geolocation failed
-            row["GEOCODING ERR"] = True
-
-            # Assign 'None' to lat and long fields
-            row["LATITUDE"] = None
-            row["LONGITUDE"] = None
+        row = apply_geocoding_response(row, res)
     return row
 
 
-def is_local_sql_subset(engine, geocodes_local, geocodes_sql_table_name):
-    with engine.connect() as connection:
-        geocodes_table_response = pd.read_sql_query(
-            f"SELECT * FROM {geocodes_sql_table_name}", engine
-        )
+def is_local_sql_subset(
+    engine, geocodes_local, geocodes_sql_table_name, key_column="PRIMARY_KEY"
+):
+    """
+    Checks that every local key is in an SQL table, downloading the table's keys.
+    See 'verify_sql_subset' to verify with server-side aggregates instead.
+    """
+    geocodes_table_response = pd.read_sql_query(
+        f"SELECT {key_column} FROM {geocodes_sql_table_name}", engine
+    )
 
     rows = geocodes_local[
-        ~geocodes_local["PRIMARY_KEY"].isin(geocodes_table_response["PRIMARY_KEY"])
+        ~geocodes_local[key_column].isin(geocodes_table_response[key_column])
     ]
 
     if rows.empty:
@@ -405,6 +951,123 @@ def is_local_sql_subset(engine, geocodes_local, geocodes_sql_table_name):
         return False
 
 
+def _partition_aggregates(keys, partitions, checksum):
+    # Local counterpart of the GROUP BY in 'verify_sql_subset'
+    frame = pd.DataFrame({"partition": partitions, "key": keys})
+    if checksum:
+        # 'fmod' truncates like SQL's '%', negative keys give negative terms
+        frame["checksum"] = np.fmod(frame["key"].to_numpy(np.int64), CHECKSUM_MODULUS)
+    else:
+        frame["checksum"] = 0
+    return frame.groupby("partition").agg(
+        rows=("key", "size"), checksum=("checksum", "sum")
+    )
+
+
+def verify_sql_subset(
+    con,
+    local_df,
+    sql_table_name,
+    key_column=GEO_KEY_COLUMN,
+    partition_column="BOROUGH",
+    chunksize=ANTI_JOIN_CHUNKSIZE,
+):
+    """
+    Checks that every local row was written to an SQL table, with server-side aggregates.
+
+    The distinct local keys are loaded into a temporary table and joined to the
+    table's indexed key. Per partition (borough), the database returns the number
+    of matched rows and an order-independent checksum of their keys, which are
+    compared to the same aggregates of the local rows. Only a few rows come back
+    however large the table is. The keys of mismatching partitions are then
+    downloaded to find the missing ones. 'is_local_sql_subset' downloads the
+    whole table instead.
+
+    Args:
+    con: SQLAlchemy engine, or a connection to verify inside its transaction.
+    local_df (pandas.DataFrame): The rows that were written.
+    sql_table_name (str): Name of the SQL table.
+    key_column (str): Unique key of the table, 'GEO_KEY' or 'PRIMARY_KEY'. Checksums
+                      need an integer key, text keys compare the row counts only.
+    partition_column (str): Column to aggregate by.
+    chunksize (int): Keys per INSERT batch into the temporary table.
+
+    Returns:
+    Verification: 'ok', the mismatching partitions and the local keys missing from
+    the table (empty if 'ok').
+    """
+    if isinstance(con, Engine):
+        with con.begin() as connection:
+            return verify_sql_subset(
+                connection,
+                local_df,
+                sql_table_name,
+                key_column,
+                partition_column,
+                chunksize,
+            )
+
+    local = pd.DataFrame(
+        {
+            "partition": local_df[partition_column].astype(str).to_numpy(),
+            "key": local_df[key_column].to_numpy(),
+        }
+    ).drop_duplicates("key")
+    checksum = pd.api.types.is_integer_dtype(local["key"])
+    expected = _partition_aggregates(local["key"], local["partition"], checksum)
+
+    _load_candidate_keys(
+        con,
+        local["key"],
+        key_column,
+        "BIGINT" if checksum else "VARCHAR(255)",
+        chunksize,
+    )
+    checksum_sql = f"SUM(g.{key_column} % {CHECKSUM_MODULUS})" if checksum else "0"
+    # 'text' escapes the '%' for the MySQL driver
+    actual = pd.read_sql_query(
+        text(
+            f"SELECT g.{partition_column} AS `partition`, COUNT(*) AS `rows`, "
+            f"{checksum_sql} AS `checksum` "
+            f"FROM candidate_keys c JOIN {sql_table_name} g "
+            f"ON g.{key_column} = c.{key_column} GROUP BY g.{partition_column}"
+        ),
+        con,
+    )
+    # MySQL returns the SUM as a DECIMAL
+    actual = actual.astype({"partition": str, "rows": np.int64}).set_index("partition")
+    actual["checksum"] = [int(value or 0) for value in actual["checksum"]]
+
+    compared = expected.join(actual, how="outer", rsuffix="_sql").fillna(0)
+    mismatched = compared.index[
+        (compared["rows"] != compared["rows_sql"])
+        | (compared["checksum"] != compared["checksum_sql"])
+    ].tolist()
+
+    missing_keys = local["key"].iloc[0:0]
+    if mismatched:
+        # Download the written keys of the mismatching partitions only
+        partition_list = ", ".join(f":p{i}" for i in range(len(mismatched)))
+        written = pd.read_sql_query(
+            text(
+                f"SELECT g.{key_column} FROM candidate_keys c "
+                f"JOIN {sql_table_name} g ON g.{key_column} = c.{key_column} "
+                f"WHERE g.{partition_column} IN ({partition_list})"
+            ),
+            con,
+            params={f"p{i}": partition for i, partition in enumerate(mismatched)},
+        )[key_column]
+        suspects = local[local["partition"].isin(mismatched)]["key"]
+        missing_keys = suspects[~suspects.isin(written)].reset_index(drop=True)
+        print(
+            f"Verification of '{sql_table_name}' failed in {mismatched}: "
+            f"{len(missing_keys)} keys missing."
+        )
+    con.execute(text("DROP TABLE candidate_keys"))
+
+    return Verification(not mismatched, mismatched, missing_keys)
+
+
 def print_sql_table(engine, table_name):
     """
     This function retrieves and prints all the rows from a SQL table.
@@ -508,46 +1171,40 @@ def connect_to_database(
     :param username: MySQL username
     :param password: MySQL password
     :param hostname: MySQL host
-    :param max_retries: Maximum number of connection attempts
-    :param retry_interval: Interval (in seconds) between connection attempts
-    :return: SQLAlchemy engine instance if successful, otherwise None
+    :param max_retries: Maximum number of connection retries
+    :param retry_interval: Interval (in seconds) before the first retry, doubled
+                           after every failed attempt (see 'db.connect_with_retry')
+    :return: Pooled SQLAlchemy engine instance if successful, otherwise None
     """
-    retry_count = 0
-    while retry_count <= max_retries:
-        try:
-            engine = create_engine(f"mysql+pymysql://{username}:{password}@{hostname}")
-            print("Database connection established successfully.")
-            return engine
-        except Exception as e:
-            if "Connection refused" in str(e):
-                retry_count += 1
-                print(
-                    f"Connection attempt {retry_count} failed. Retrying in {retry_interval} seconds..."
-                )
-                time.sleep(retry_interval)
-            else:
-                raise  # OperationalError
-    print("Max retries reached. Unable to establish a database connection.")
-    return None
+    engine = db.get_engine(db.mysql_url(username, password, hostname))
+    try:
+        db.connect_with_retry(engine, max_retries=max_retries, backoff=retry_interval)
+    except OperationalError:
+        print("Max retries reached. Unable to establish a database connection.")
+        return None
+    print("Database connection established successfully.")
+    return engine
 
 
 def create_database(engine, database_name):
     """
     Create a new database, if it doesn't already exist.
 
-    :param engine: SQLAlchemy engine instance
+    On SQLite the database is the file the engine points at, so this is a no-op.
+
+    :param engine: SQLAlchemy engine instance, connected to the server
     :param database_name: Name of the database to create
-    :return: SQLAlchemy engine instance connected to the new database
+    :return: Pooled SQLAlchemy engine instance connected to the new database
     """
+    if engine.dialect.name == "sqlite":
+        return engine
     try:
-        with engine.connect() as connection:
+        with engine.begin() as connection:
             connection.execute(text(f"CREATE DATABASE {database_name};"))
-            print("Database created successfully.")
+        print("Database created successfully.")
     except ProgrammingError:
         pass  # Database already exists
-    return create_engine(
-        f"mysql+pymysql://{username}:{password}@{hostname}/{database_name}"
-    )
+    return db.get_engine(engine.url.set(database=database_name))
 
 
 def silence_warnings():
@@ -572,28 +1229,28 @@ def create_table_from_csv(engine, table_name, csv_file, if_exists="fail"):
                       'append': If table exists, insert data. Create if does not exist.
                       Default is 'fail'.
     """
-    with engine.connect() as connection:
-        df = pd.read_csv(csv_file)
-        try:
-            df.to_sql(table_name, con=engine, index=False, if_exists=if_exists)
-        except ValueError:
-            print(f"Table {table_name} already exists")
-        if if_exists == "fail":
-            print(
-                f"Table '{table_name}' created from csv '{csv_file}' successfully, or already exists."
-            )
-        elif if_exists == "replace":
-            print(
-                f"Table '{table_name}' created or replaced from csv '{csv_file}' successfully."
-            )
-        elif if_exists == "append":
-            print(
-                f"Table '{table_name}' created or appended with data from csv '{csv_file}' successfully."
-            )
-        else:
-            print(
-                f"Unknown 'if_exists' parameter value. Table '{table_name}' may or may not have been affected."
-            )
+    df = pd.read_csv(csv_file)
+    try:
+        with engine.begin() as connection:
+            df.to_sql(table_name, con=connection, index=False, if_exists=if_exists)
+    except ValueError:
+        print(f"Table {table_name} already exists")
+    if if_exists == "fail":
+        print(
+            f"Table '{table_name}' created from csv '{csv_file}' successfully, or already exists."
+        )
+    elif if_exists == "replace":
+        print(
+            f"Table '{table_name}' created or replaced from csv '{csv_file}' successfully."
+        )
+    elif if_exists == "append":
+        print(
+            f"Table '{table_name}' created or appended with data from csv '{csv_file}' successfully."
+        )
+    else:
+        print(
+            f"Unknown 'if_exists' parameter value. Table '{table_name}' may or may not have been affected."
+        )
 
 
 def add_primary_key(engine, table_name, pk_name):
@@ -604,14 +1261,14 @@ def add_primary_key(engine, table_name, pk_name):
     :param table_name: Name of the SQL table
     :param pk_name: Name of the primary key column
     """
-    with engine.connect() as connection:
-        try:
+    try:
+        with engine.begin() as connection:
             connection.execute(
                 text(f"ALTER TABLE {table_name} ADD COLUMN {pk_name} VARCHAR(255)")
             )
-            print(f"Column {pk_name} created in table {table_name}.")
-        except:
-            print(f"Column {pk_name} already exists in table {table_name}.")
+        print(f"Column {pk_name} created in table {table_name}.")
+    except:
+        print(f"Column {pk_name} already exists in table {table_name}.")
 
 
 def set_primary_key(engine, table_name, pk_name, concat_fields):
@@ -623,14 +1280,92 @@ def set_primary_key(engine, table_name, pk_name, concat_fields):
     :param pk_name: Name of the primary key column
     :param concat_fields: Fields to concatenate (in SQL format)
     """
-    with engine.connect() as connection:
-        try:
+    try:
+        with engine.begin() as connection:
             connection.execute(
                 text(f"UPDATE {table_name} SET {pk_name} = CONCAT({concat_fields})")
             )
-            print(f"{pk_name} column values set in table {table_name}.")
-        except:
-            print(f"{pk_name} column values set error in table {table_name}.")
+        print(f"{pk_name} column values set in table {table_name}.")
+    except:
+        print(f"{pk_name} column values set error in table {table_name}.")
+
+
+def key_geocodes(geocodes):
+    """
+    Adds the 'PRIMARY_KEY' and 'GEO_KEY' columns to geocodes, one row per key.
+
+    Rows whose keys collide (spelling variants of one address) keep a
+    successful geocode over a failure.
+
+    :param geocodes: pandas.DataFrame of geocodes, e.g. 'geocodes_export_backup.csv'
+    :return: The keyed DataFrame
+    """
+    geocodes = geocodes.copy()
+    geocodes["PRIMARY_KEY"] = (
+        geocodes["BOROUGH"].astype(str) + "_" + geocodes["ADDRESS"].astype(str)
+    )
+    geocodes[GEO_KEY_COLUMN] = geo_keys(geocodes["BOROUGH"], geocodes["ADDRESS"])
+    return geocodes.sort_values("GEOCODING ERR", kind="stable").drop_duplicates(
+        subset=GEO_KEY_COLUMN
+    )
+
+
+def add_geo_key(engine, table_name):
+    """
+    Keys a geocodes SQL table on the hashed 'GEO_KEY', if it isn't already.
+
+    'GEO_KEY' is computed in pandas (see 'geo_keys') and the table is rebuilt
+    once, next to the old one, with a unique key on it, then swapped in. This
+    replaces the full-table 'UPDATE ... SET PRIMARY_KEY = CONCAT(...)' of
+    'set_primary_key'. See 'key_geocodes' for the keys.
+
+    :param engine: SQLAlchemy engine instance
+    :param table_name: Name of the geocodes SQL table
+    """
+    columns = pd.read_sql_query(f"SELECT * FROM {table_name} LIMIT 1", engine).columns
+    if GEO_KEY_COLUMN in columns:
+        print(f"Column {GEO_KEY_COLUMN} already exists in table {table_name}.")
+        return
+
+    geocodes = key_geocodes(pd.read_sql_query(f"SELECT * FROM {table_name}", engine))
+
+    # Build the keyed copy next to the table, then swap it in. The unkeyed
+    # table is kept as a snapshot, see 'writer.rollback_tables'
+    writer.write_frame(
+        geocodes,
+        table_name,
+        engine,
+        dtype=geocoding_data_types_sqlalchemy,
+        key_columns=[GEO_KEY_COLUMN],
+        if_exists="swap",
+    )
+    print(f"Table {table_name} keyed on {GEO_KEY_COLUMN}.")
+
+
+def add_key_index(engine, table_name, key_name, unique=False):
+    """
+    Add an index on a key column of a SQL table, if it doesn't already exist.
+
+    :param engine: SQLAlchemy engine instance
+    :param table_name: Name of the SQL table
+    :param key_name: Name of the column to index
+    :param unique: Create a unique index, needed for upserts ('writer.write_frame')
+    """
+    kind, prefix = ("UNIQUE INDEX", "ux") if unique else ("INDEX", "ix")
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    f"CREATE {kind} {prefix}_{table_name}_{key_name} "
+                    f"ON {table_name} ({key_name})"
+                )
+            )
+        print(f"{kind.capitalize()} on {key_name} created in table {table_name}.")
+    except:
+        print(
+            f"{kind.capitalize()} on {key_name} already exists in table "
+            f"{table_name}, or could not be created."
+        )
 
 
 def create_mapping_table(engine, mapping, table_name="cat_map"):
@@ -647,6 +1382,6 @@ def create_mapping_table(engine, mapping, table_name="cat_map"):
     mapping_df = pd.DataFrame(
         mapping_list, columns=["ZILLOW CATEGORY", "BUILDING CLASS CATEGORY"]
     )
-    with engine.connect() as connection:
-        mapping_df.to_sql(table_name, con=engine, index=False, if_exists="replace")
-        print(f"Table '{table_name}' created successfully.")
+    with engine.begin() as connection:
+        mapping_df.to_sql(table_name, con=connection, index=False, if_exists="replace")
+    print(f"Table '{table_name}' created successfully.")
@@ -59,6 +59,7 @@ def test_connect_to_database(mock_create_engine, mock_sleep):
 # --------------------------------------------------------
 import helpers
 import pandas as pd
+import numpy as np
 import pytest
 
 
@@ -125,6 +126,145 @@ def test_combineHousingDataSets_missing_columns(df1_passing, df_missing_column):
     assert helpers.combineHousingDataSets([df1_passing, df_missing_column]) == False
 
 
+# Only the requested columns are kept
+def test_combineHousingDataSets_projection(df1_passing, df2_extra_column):
+    columns = helpers.REQUIRED_PREPROCESSING_COLUMNS
+    result = helpers.combineHousingDataSets(
+        [df1_passing, df2_extra_column], columns=columns
+    )
+    assert list(result.columns) == columns
+    assert len(result) == 3
+
+
+# Categoricals with different categories and numeric columns with
+# blank string cells must not be upcast to object
+def test_combineHousingDataSets_reconciles_dtypes(df1_passing, df2_extra_column):
+    df1_passing["NEIGHBORHOOD"] = df1_passing["NEIGHBORHOOD"].astype("category")
+    df2_extra_column["NEIGHBORHOOD"] = df2_extra_column["NEIGHBORHOOD"].astype(
+        "category"
+    )
+    df2_extra_column["SALE PRICE"] = [" -  "]
+
+    result = helpers.combineHousingDataSets([df1_passing, df2_extra_column])
+
+    assert result["NEIGHBORHOOD"].dtype == "category"
+    assert set(result["NEIGHBORHOOD"].cat.categories) == {"A", "B", "C"}
+    assert pd.api.types.is_numeric_dtype(result["SALE PRICE"])
+    assert result["SALE PRICE"].isna().sum() == 1
+
+
+# The lazy view yields the projected DataFrames one at a time
+def test_combineHousingDataSets_lazy(df1_passing, df2_extra_column):
+    result = helpers.combineHousingDataSets(
+        [df1_passing, df2_extra_column],
+        columns=helpers.REQUIRED_PREPROCESSING_COLUMNS,
+        lazy=True,
+    )
+    chunks = list(result)
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert "EXTRA COLUMN" not in chunks[1].columns
+
+
+# The lazy view casts each DataFrame when it is yielded, to the common types
+def test_combineHousingDataSets_lazy_casts_on_demand(
+    df1_passing, df2_extra_column, monkeypatch
+):
+    df1_passing["NEIGHBORHOOD"] = df1_passing["NEIGHBORHOOD"].astype("category")
+    casts = []
+    cast_dtypes = helpers._cast_dtypes
+    monkeypatch.setattr(
+        helpers,
+        "_cast_dtypes",
+        lambda *args: casts.append(True) or cast_dtypes(*args),
+    )
+
+    result = helpers.combineHousingDataSets([df1_passing, df2_extra_column], lazy=True)
+    assert casts == []
+    first = next(result)
+    assert len(casts) == 1
+    second = next(result)
+    assert first["NEIGHBORHOOD"].dtype == second["NEIGHBORHOOD"].dtype == "category"
+    assert set(second["NEIGHBORHOOD"].cat.categories) == {"A", "B", "C"}
+
+
+# --------------------------------------------------------
+# TEST: apply_sales_schema() & group_categories()
+# --------------------------------------------------------
+
+
+# Combined sales data as it comes out of the workbooks
+@pytest.fixture
+def combined_sales_df():
+    return pd.DataFrame(
+        {
+            "BOROUGH CODE": [1, 2, 2],
+            "BOROUGH": ["MANHATTAN", "BRONX", "BRONX"],
+            "NEIGHBORHOOD": ["CHELSEA", "BATHGATE", "BATHGATE"],
+            "BUILDING CLASS CATEGORY": [
+                "13 CONDOS - ELEVATOR APARTMENTS",
+                "01 ONE FAMILY DWELLINGS",
+                "22 STORE BUILDINGS",  # Not in 'category_mapping'
+            ],
+            "ADDRESS": ["254 WEST 27TH STREET", "2744 BOUCK AVE", "2746 BOUCK AVE"],
+            "ZIP CODE": [10001.0, None, 10467.0],
+            "LAND SQUARE FEET": [700.0, 1000.0, 2000.0],
+            "GROSS SQUARE FEET": ["2084", " ", "3000"],  # Blank cell
+            "SALE PRICE": [2165000, 500000, 600000],
+            "SALE DATE": ["2022-09-30", "2022-07-27", "2022-08-01"],
+        }
+    )
+
+
+# Test that columns are converted to their compact types
+def test_apply_sales_schema(combined_sales_df):
+    result = helpers.apply_sales_schema(combined_sales_df)
+
+    assert result["BOROUGH CODE"].dtype == "Int8"
+    assert result["NEIGHBORHOOD"].dtype == "category"
+    assert result["ADDRESS"].dtype == "category"
+    assert result["ZIP CODE"].dtype == "Int32"
+    assert result["ZIP CODE"].isna().sum() == 1
+    assert result["GROSS SQUARE FEET"].dtype == "float32"
+    assert result["GROSS SQUARE FEET"].isna().sum() == 1
+    assert result["SALE PRICE"].tolist() == [2165000, 500000, 600000]
+
+    # Prices above float32's 2**24 aren't rounded
+    price = combined_sales_df.assign(**{"SALE PRICE": [16_777_217, 123_456_789, 0]})
+    assert helpers.apply_sales_schema(price)["SALE PRICE"].tolist() == [
+        16_777_217,
+        123_456_789,
+        0,
+    ]
+
+    # Columns outside the schema are left alone
+    assert result["SALE DATE"].dtype == object
+
+    # The input DataFrame is not modified
+    assert combined_sales_df["BOROUGH CODE"].dtype == "int64"
+
+
+# Test that values which don't fit the schema type raise
+def test_apply_sales_schema_bad_values(combined_sales_df):
+    combined_sales_df["ZIP CODE"] = [10001.5, 10002.0, 10003.0]
+    with pytest.raises(ValueError, match="Column 'ZIP CODE' cannot be converted"):
+        helpers.apply_sales_schema(combined_sales_df)
+
+
+# Test that mapping categorical codes matches mapping the strings
+def test_group_categories(combined_sales_df):
+    expected = combined_sales_df["BUILDING CLASS CATEGORY"].map(
+        helpers.category_mapping
+    )
+
+    result = helpers.group_categories(
+        helpers.apply_sales_schema(combined_sales_df)["BUILDING CLASS CATEGORY"]
+    )
+
+    assert result.dtype == "category"
+    assert result.astype(object).tolist() == ["Condo", "Single-family home", np.nan]
+    assert result.astype(object).equals(expected)
+
+
 # --------------------------------------------------------
 # TEST: filterOutliers()
 # --------------------------------------------------------
@@ -242,6 +382,43 @@ def test_outlier_removal(sample_df_outliers):
     assert 10000 not in df_clean["GROSS SQUARE FEET"].values
 
 
+# Two boroughs with very different price levels
+@pytest.fixture
+def two_borough_df():
+    return pd.DataFrame(
+        {
+            "BOROUGH CODE": [1] * 10 + [5] * 10,
+            "SALE PRICE": [
+                *[1000, 1100, 1200, 1300, 1400, 1500, 1600, 1700, 1800, 1900],
+                *[100, 110, 120, 130, 140, 150, 160, 170, 180, 1000],  # Outlier
+            ],
+        }
+    )
+
+
+# The Staten Island outlier only stands out within its own borough
+def test_outlier_removal_grouped(two_borough_df):
+    thresholds = {"SALE PRICE": 0}
+
+    pooled = helpers.filterOutliers(two_borough_df, thresholds, 0.25, 0.75)
+    assert len(pooled) == 20
+
+    grouped = helpers.filterOutliers(
+        two_borough_df, thresholds, 0.25, 0.75, group_by="BOROUGH CODE"
+    )
+    assert len(grouped) == 19
+    assert grouped.index.max() == 18
+    assert grouped["SALE PRICE"].max() == 1900
+
+
+# Test that a ValueError is raised if a grouping column does not exist
+def test_outlier_removal_grouped_missing_column(two_borough_df):
+    with pytest.raises(ValueError, match="Column 'BOROUGH' not found in DataFrame."):
+        helpers.filterOutliers(
+            two_borough_df, {"SALE PRICE": 0}, 0.25, 0.75, group_by=["BOROUGH"]
+        )
+
+
 # --------------------------------------------------------
 # TEST: Find missing geocodes in SQL table
 # --------------------------------------------------------
@@ -263,7 +440,7 @@ from sqlalchemy.exc import (
     ProgrammingError,
 )  # ProgrammingError catches SQL write exceptions
 from sqlalchemy.sql import and_
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from unittest.mock import patch
 
 
@@ -380,6 +557,241 @@ def test_check_missing_rows_missing_columns_local_df(
             )
 
 
+# --------------------------------------------------------
+# TEST: Find missing geocodes with a server-side anti-join
+# --------------------------------------------------------
+import sqlite3
+
+
+# Local SQLite stand-in for the MySQL geocodes table
+@pytest.fixture
+def geocodes_engine(tmp_path, dummy_sql_geocodes_table_response):
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    dummy_sql_geocodes_table_response.to_sql("geocodes", engine, index=False)
+    helpers.add_key_index(engine, "geocodes", "PRIMARY_KEY")
+    return engine
+
+
+# Same result as the SELECT * path, duplicate local rows included
+def test_check_missing_rows_server_side(
+    geocodes_engine, dummy_local_geocodes_dataframe
+):
+    local_df = pd.concat([dummy_local_geocodes_dataframe] * 2, ignore_index=True)
+
+    result = helpers.check_missing_rows_server_side(
+        local_df, "geocodes", geocodes_engine
+    )
+    expected = helpers.check_missing_rows(local_df, "geocodes", geocodes_engine)
+
+    pd.testing.assert_frame_equal(result, expected)
+    assert result["ADDRESS"].tolist() == ["20 WEST 123 STREET"] * 2
+
+    # The temporary table is dropped, so the check can run again
+    assert (
+        helpers.check_missing_rows_server_side(
+            dummy_local_geocodes_dataframe.iloc[:2], "geocodes", geocodes_engine
+        )
+        is False
+    )
+
+
+# Same errors as 'check_missing_rows'
+def test_check_missing_rows_server_side_errors(
+    tmp_path,
+    geocodes_engine,
+    dummy_local_geocodes_dataframe,
+    dummy_sql_geocodes_table_response,
+):
+    with pytest.raises(KeyError, match="Columns are missing in local Dataframe"):
+        helpers.check_missing_rows_server_side(
+            dummy_local_geocodes_dataframe.drop("BOROUGH", axis=1),
+            "geocodes",
+            geocodes_engine,
+        )
+    with pytest.raises(ValueError, match="Local DataFrame is empty"):
+        helpers.check_missing_rows_server_side(
+            dummy_local_geocodes_dataframe.iloc[0:0], "geocodes", geocodes_engine
+        )
+    with pytest.raises(IOError, match="SQL query error"):
+        helpers.check_missing_rows_server_side(
+            dummy_local_geocodes_dataframe, "no_such_table", geocodes_engine
+        )
+
+    dummy_sql_geocodes_table_response.iloc[0:0].to_sql(
+        "empty", geocodes_engine, index=False
+    )
+    with pytest.raises(ValueError, match="SQL Database is empty"):
+        helpers.check_missing_rows_server_side(
+            dummy_local_geocodes_dataframe, "empty", geocodes_engine
+        )
+
+    dummy_sql_geocodes_table_response.drop("LATITUDE", axis=1).to_sql(
+        "no_latitude", geocodes_engine, index=False
+    )
+    with pytest.raises(KeyError, match="Columns are missing in SQL response"):
+        helpers.check_missing_rows_server_side(
+            dummy_local_geocodes_dataframe, "no_latitude", geocodes_engine
+        )
+
+
+# Benchmark against 1M stored geocodes, 20k local rows, 200 missing
+def test_check_missing_rows_server_side_benchmark(tmp_path):
+    stored, local, missing = 1_000_000, 20_000, 200
+    path = tmp_path / "geocodes.db"
+    numbers = np.arange(stored).astype(str)
+    with sqlite3.connect(path) as connection:
+        pd.DataFrame(
+            {
+                "BOROUGH CODE": 4,
+                "BOROUGH": "QUEENS",
+                "NEIGHBORHOOD": "ASTORIA",
+                "ADDRESS": numbers,
+                "LATITUDE": 40.7,
+                "LONGITUDE": -73.9,
+                "GEOCODING ERR": False,
+                "PRIMARY_KEY": np.char.add("QUEENS_", numbers),
+            }
+        ).to_sql("geocodes", connection, index=False)
+        connection.execute(
+            "CREATE INDEX ix_geocodes_PRIMARY_KEY ON geocodes (PRIMARY_KEY)"
+        )
+    engine = create_engine(f"sqlite:///{path}")
+
+    local_df = pd.DataFrame(
+        {
+            "BOROUGH CODE": 4,
+            "BOROUGH": "QUEENS",
+            "NEIGHBORHOOD": "ASTORIA",
+            "ADDRESS": np.arange(stored - local + missing, stored + missing).astype(
+                str
+            ),
+        }
+    )
+
+    timings = {}
+    for check in (helpers.check_missing_rows, helpers.check_missing_rows_server_side):
+        start = time.perf_counter()
+        result = check(local_df, "geocodes", engine)
+        timings[check.__name__] = time.perf_counter() - start
+        assert len(result) == missing
+
+    print(
+        f"\n{stored} stored geocodes: SELECT * {timings['check_missing_rows']:.2f}s, "
+        f"anti-join {timings['check_missing_rows_server_side']:.2f}s"
+    )
+    assert timings["check_missing_rows_server_side"] < timings["check_missing_rows"]
+
+
+# --------------------------------------------------------
+# TEST: Hashed GEO_KEY join key
+# --------------------------------------------------------
+
+
+# Spelling variants share a key, other boroughs and addresses don't
+def test_geo_keys():
+    keys = helpers.geo_keys(
+        pd.Series(["MANHATTAN", "MANHATTAN", "BRONX", "MANHATTAN", "MANHATTAN"]),
+        pd.Series(
+            [
+                "254 WEST 27TH STREET",
+                "254 W 27 ST, 1",
+                "254 WEST 27TH STREET",
+                "256 WEST 27TH STREET",
+                None,
+            ]
+        ),
+    )
+    assert keys.dtype == np.int64
+    assert keys[0] == keys[1]
+    assert len(set(keys[[0, 2, 3, 4]])) == 4
+
+    # Stable across calls (and processes), categoricals included
+    assert (
+        helpers.geo_keys(
+            pd.Categorical(["MANHATTAN"]), pd.Categorical(["254 W 27 ST"])
+        )[0]
+        == keys[0]
+    )
+
+
+# The geocodes table is rebuilt once with a unique GEO_KEY
+def test_add_geo_key(tmp_path, dummy_sql_geocodes_table_response):
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    legacy = pd.concat(
+        [
+            dummy_sql_geocodes_table_response.drop(columns="PRIMARY_KEY"),
+            pd.DataFrame(  # Failed variant of the first address
+                {
+                    "BOROUGH CODE": [1],
+                    "BOROUGH": ["MANHATTAN"],
+                    "NEIGHBORHOOD": ["CHELSEA"],
+                    "ADDRESS": ["254 W 27 ST"],
+                    "LATITUDE": [None],
+                    "LONGITUDE": [None],
+                    "GEOCODING ERR": [True],
+                }
+            ),
+        ],
+        ignore_index=True,
+    ).iloc[[2, 0, 1]]
+    legacy.to_sql("geocodes", engine, index=False)
+
+    helpers.add_geo_key(engine, "geocodes")
+    helpers.add_geo_key(engine, "geocodes")  # Nothing left to do
+
+    result = pd.read_sql_query("SELECT * FROM geocodes", engine)
+    assert len(result) == 2
+    assert not result["GEOCODING ERR"].any()  # The successful geocode is kept
+    assert set(result["PRIMARY_KEY"]) == set(
+        dummy_sql_geocodes_table_response["PRIMARY_KEY"]
+    )
+    indexes = inspect(engine).get_indexes("geocodes")
+    assert [(i["column_names"], bool(i["unique"])) for i in indexes] == [
+        (["GEO_KEY"], True)
+    ]
+
+    # The anti-join works on the hashed keys too
+    local_df = pd.DataFrame(
+        {
+            "BOROUGH CODE": [1, 1],
+            "BOROUGH": ["MANHATTAN", "MANHATTAN"],
+            "NEIGHBORHOOD": ["CHELSEA", "HARLEM-CENTRAL"],
+            "ADDRESS": ["254 W 27TH ST", "20 WEST 123 STREET"],
+        }
+    )
+    missing_rows = helpers.check_missing_rows_server_side(
+        local_df, "geocodes", engine, key_column="GEO_KEY"
+    )
+    assert missing_rows["ADDRESS"].tolist() == ["20 WEST 123 STREET"]
+    assert missing_rows["GEO_KEY"].tolist() == list(
+        helpers.geo_keys(["MANHATTAN"], ["20 WEST 123 STREET"])
+    )
+
+
+# Memory and time of the geocodes merge, text key vs GEO_KEY
+def test_geo_key_merge_benchmark():
+    sales = pd.read_csv("geocodes_export_backup_1.csv", usecols=["BOROUGH", "ADDRESS"])
+    sales["PRIMARY_KEY"] = sales["BOROUGH"] + "_" + sales["ADDRESS"]
+    sales["GEO_KEY"] = helpers.geo_keys(sales["BOROUGH"], sales["ADDRESS"])
+    results = {}
+    for key in ("PRIMARY_KEY", "GEO_KEY"):
+        right = sales[[key]].drop_duplicates().assign(LATITUDE=40.7, LONGITUDE=-73.9)
+        memory = sales[key].memory_usage(deep=True) + right[key].memory_usage(deep=True)
+        start = time.perf_counter()
+        for _ in range(10):
+            merged = sales[[key]].merge(right, on=key, how="left")
+        results[key] = (memory, (time.perf_counter() - start) / 10)
+        assert merged["LATITUDE"].notna().all()
+
+    print(
+        f"\nText key: {results['PRIMARY_KEY'][0] / 1e6:.1f} MB, "
+        f"{results['PRIMARY_KEY'][1] * 1000:.1f} ms; "
+        f"GEO_KEY: {results['GEO_KEY'][0] / 1e6:.1f} MB, "
+        f"{results['GEO_KEY'][1] * 1000:.1f} ms"
+    )
+    assert results["GEO_KEY"][0] < results["PRIMARY_KEY"][0] / 4
+
+
 # --------------------------------------------------------
 # TEST: Geocode row of address data
 # --------------------------------------------------------
@@ -617,3 +1029,88 @@ def test_is_local_sql_subset_success(sql_response_df):
 
     # Assertion criteria
     assert result == True
+
+
+# --------------------------------------------------------
+# TEST: Verify writes with server-side aggregates
+# --------------------------------------------------------
+
+
+@pytest.fixture
+def keyed_geocodes_engine(tmp_path, dummy_sql_geocodes_table_response):
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    dummy_sql_geocodes_table_response.to_sql("geocodes", engine, index=False)
+    helpers.add_geo_key(engine, "geocodes")
+    return engine
+
+
+# Written rows pass, on an engine or inside a connection's transaction
+def test_verify_sql_subset(keyed_geocodes_engine, dummy_sql_geocodes_table_response):
+    local = dummy_sql_geocodes_table_response.copy()
+    local["GEO_KEY"] = helpers.geo_keys(local["BOROUGH"], local["ADDRESS"])
+    local = pd.concat([local, local.iloc[:1]], ignore_index=True)  # Duplicate key
+
+    result = helpers.verify_sql_subset(keyed_geocodes_engine, local, "geocodes")
+    assert result.ok
+    assert result.mismatched_partitions == []
+    assert result.missing_keys.empty
+
+    with keyed_geocodes_engine.begin() as connection:
+        assert helpers.verify_sql_subset(connection, local, "geocodes").ok
+
+    # Text keys compare row counts only
+    assert helpers.verify_sql_subset(
+        keyed_geocodes_engine, local, "geocodes", key_column="PRIMARY_KEY"
+    ).ok
+
+
+# Missing rows are found in the mismatching partition only
+def test_verify_sql_subset_missing(
+    keyed_geocodes_engine, dummy_sql_geocodes_table_response
+):
+    local = pd.concat(
+        [
+            dummy_sql_geocodes_table_response,
+            pd.DataFrame({"BOROUGH": ["QUEENS"], "ADDRESS": ["321 PARK AVE"]}),
+        ],
+        ignore_index=True,
+    )
+    local["GEO_KEY"] = helpers.geo_keys(local["BOROUGH"], local["ADDRESS"])
+
+    result = helpers.verify_sql_subset(keyed_geocodes_engine, local, "geocodes")
+    assert not result.ok
+    assert result.mismatched_partitions == ["QUEENS"]
+    assert result.missing_keys.tolist() == local["GEO_KEY"].iloc[-1:].tolist()
+
+
+# Benchmark against 1M stored geocodes, verifying 20k written rows
+def test_verify_sql_subset_benchmark(tmp_path):
+    stored, written = 1_000_000, 20_000
+    path = tmp_path / "geocodes.db"
+    rng = np.random.default_rng(0)
+    keys = rng.integers(-(2**63), 2**63 - 1, size=stored, dtype=np.int64)
+    boroughs = rng.choice(["BRONX", "QUEENS", "BROOKLYN"], size=stored)
+    with sqlite3.connect(path) as connection:
+        pd.DataFrame({"BOROUGH": boroughs, "GEO_KEY": keys}).to_sql(
+            "geocodes", connection, index=False
+        )
+        connection.execute(
+            "CREATE UNIQUE INDEX ux_geocodes_GEO_KEY ON geocodes (GEO_KEY)"
+        )
+    engine = create_engine(f"sqlite:///{path}")
+    local = pd.DataFrame({"BOROUGH": boroughs[-written:], "GEO_KEY": keys[-written:]})
+
+    timings = {}
+    for name, check in (
+        ("download", helpers.is_local_sql_subset),
+        ("aggregates", lambda *args: helpers.verify_sql_subset(*args).ok),
+    ):
+        start = time.perf_counter()
+        assert check(engine, local, "geocodes", "GEO_KEY")
+        timings[name] = time.perf_counter() - start
+
+    print(
+        f"\n{stored} stored geocodes: download {timings['download']:.2f}s, "
+        f"aggregates {timings['aggregates']:.2f}s"
+    )
+    assert timings["aggregates"] < timings["download"]
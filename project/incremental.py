@@ -0,0 +1,238 @@
+# DATA SCIENCE
+import numpy as np
+import pandas as pd
+
+# SQL
+from sqlalchemy import inspect, text, bindparam, BigInteger, DateTime
+
+# PROJECT MODULES
+import writer
+
+# VARS -----------------------------------------
+
+# Column holding each row's content hash, in both the sales and digest tables
+DIGEST_COLUMN = "ROW_DIGEST"
+
+# Number of digests bound into a single DELETE ... IN (...) statement
+DELETE_BATCH_SIZE = 1000
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def row_digests(df):
+    """
+    Computes a 64-bit content hash for every row of a DataFrame.
+
+    Identical rows (e.g. two units of a building sold together for the same
+    price) are told apart by their occurrence number, so every row gets a
+    unique digest.
+
+    :param df: pandas.DataFrame to hash, the index is ignored
+    :return: numpy int64 array of row digests, in row order
+    """
+    hashed = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    occurrence = pd.Series(hashed).groupby(hashed).cumcount().to_numpy()
+    digests = pd.util.hash_pandas_object(
+        pd.DataFrame({"hash": hashed, "occurrence": occurrence}), index=False
+    ).to_numpy()
+
+    # MySQL BIGINT is signed
+    return digests.view(np.int64)
+
+
+def _table_columns(engine, table_name):
+    inspector = inspect(engine)
+    if not inspector.has_table(table_name):
+        return None
+    return [column["name"] for column in inspector.get_columns(table_name)]
+
+
+def _delete_digests(connection, table_name, digests):
+    stmt = text(
+        f"DELETE FROM {table_name} WHERE {DIGEST_COLUMN} IN :digests"
+    ).bindparams(bindparam("digests", expanding=True))
+    for start in range(0, len(digests), DELETE_BATCH_SIZE):
+        batch = [int(d) for d in digests[start : start + DELETE_BATCH_SIZE]]
+        connection.execute(stmt, {"digests": batch})
+
+
+def _write_digests(connection, table_name, digests, if_exists):
+    pd.DataFrame(
+        {DIGEST_COLUMN: digests, "LOADED_AT": pd.Timestamp.now().floor("s")}
+    ).to_sql(
+        table_name,
+        con=connection,
+        index=False,
+        if_exists=if_exists,
+        dtype={DIGEST_COLUMN: BigInteger, "LOADED_AT": DateTime},
+    )
+
+
+def full_load_sales(
+    df,
+    engine,
+    sales_table="sales",
+    digest_table=None,
+    dtype=None,
+    index_columns=(),
+    keep_snapshots=writer.KEEP_SNAPSHOTS,
+):
+    """
+    Replaces the sales table and its digest table with the full DataFrame.
+
+    Both are loaded and indexed as staging tables, then swapped in together
+    (see 'writer.swap_tables'), so readers never see a missing or partial table.
+
+    :param df: pandas.DataFrame of sales, e.g. 'combined'
+    :param engine: SQLAlchemy engine instance
+    :param sales_table: Name of the sales table
+    :param digest_table: Name of the digest table, defaults to '<sales_table>_digest'
+    :param dtype: SQL column types, e.g. 'helpers.sales_data_types_sqlalchemy'
+    :param index_columns: Other columns to index, e.g. the 'GEO_KEY' join key
+    :param keep_snapshots: Previous versions of both tables to keep for a rollback
+    :return: The DataFrame as written, with its 'ROW_DIGEST' column
+    """
+    digest_table = digest_table or f"{sales_table}_digest"
+    digests = row_digests(df)
+    written = df.assign(**{DIGEST_COLUMN: digests})
+
+    with writer.staging_tables(
+        engine, sales_table, digest_table, keep_snapshots=keep_snapshots
+    ) as staged, engine.begin() as connection:
+        # Index names are per database on SQLite, so they follow the staging table
+        staged_sales, staged_digests = staged[sales_table], staged[digest_table]
+        writer.write_frame(
+            written,
+            staged_sales,
+            connection,
+            dtype={**(dtype or {}), DIGEST_COLUMN: BigInteger},
+            if_exists="replace",
+        )
+        connection.execute(
+            text(
+                f"CREATE INDEX ix_{staged_sales}_digest "
+                f"ON {staged_sales} ({DIGEST_COLUMN})"
+            )
+        )
+        for column in index_columns:
+            connection.execute(
+                text(
+                    f"CREATE INDEX ix_{staged_sales}_{column} "
+                    f"ON {staged_sales} ({column})"
+                )
+            )
+        _write_digests(connection, staged_digests, digests, "replace")
+        connection.execute(
+            text(
+                f"CREATE UNIQUE INDEX ix_{staged_digests}_digest "
+                f"ON {staged_digests} ({DIGEST_COLUMN})"
+            )
+        )
+
+    print(f"Full load: {len(written)} rows written to '{sales_table}'.")
+    return written
+
+
+def sync_sales(
+    df,
+    engine,
+    sales_table="sales",
+    digest_table=None,
+    chunksize=writer.CHUNKSIZE,
+    dtype=None,
+    index_columns=(),
+):
+    """
+    Brings the sales table in line with the DataFrame, writing only what changed.
+
+    Every row is identified by its content hash ('row_digests'). The digests
+    already loaded are kept in a digest table, so only that single BIGINT
+    column is read back. Rows whose digest is new are inserted, rows whose
+    digest is gone (sales that left the rolling window, or rows that changed)
+    are deleted, and everything else is left alone. A changed row shows up as
+    one delete plus one insert.
+
+    The first run, or a run where the sales columns changed, falls back to
+    'full_load_sales'.
+
+    Args:
+    df (pandas.DataFrame): The current sales, e.g. 'combined'.
+    engine: The SQLAlchemy engine instance facilitating the database connection.
+    sales_table (str): Name of the sales table.
+    digest_table (str): Name of the digest table, defaults to '<sales_table>_digest'.
+    chunksize (int): Rows per INSERT batch.
+    dtype (dict): SQL column types for a full load, e.g. 'helpers.sales_data_types_sqlalchemy'.
+    index_columns (list): Other columns a full load indexes, e.g. the 'GEO_KEY' join key.
+
+    Returns:
+    pandas.DataFrame: The added (new or changed) rows, with their 'ROW_DIGEST'
+    column. Geocoding still checks every sale, so that a sale whose geocoding
+    failed after its digest was stored is retried.
+    """
+    digest_table = digest_table or f"{sales_table}_digest"
+
+    # Fall back to a full load if there is nothing to diff against
+    expected_columns = list(df.columns) + [DIGEST_COLUMN]
+    if (
+        _table_columns(engine, sales_table) != expected_columns
+        or _table_columns(engine, digest_table) is None
+    ):
+        return full_load_sales(
+            df, engine, sales_table, digest_table, dtype, index_columns
+        )
+
+    digests = row_digests(df)
+    stored = pd.read_sql_query(f"SELECT {DIGEST_COLUMN} FROM {digest_table}", engine)[
+        DIGEST_COLUMN
+    ].to_numpy(dtype=np.int64)
+
+    is_new = ~np.isin(digests, stored)
+    removed = stored[~np.isin(stored, digests)]
+    added = df[is_new].assign(**{DIGEST_COLUMN: digests[is_new]})
+
+    with engine.begin() as connection:
+        _delete_digests(connection, sales_table, removed)
+        _delete_digests(connection, digest_table, removed)
+        if not added.empty:
+            writer.write_frame(added, sales_table, connection, chunksize=chunksize)
+            _write_digests(connection, digest_table, digests[is_new], "append")
+
+    print(
+        f"Incremental load: {len(added)} rows added, {len(removed)} rows removed, "
+        f"{len(df) - len(added)} unchanged."
+    )
+    return added
+
+
+def sync_sales_parquet(df, store, sales_table="sales"):
+    """
+    Same as 'sync_sales', for a sales table in a 'parquet_store.ParquetStore'.
+
+    Only the stored 'ROW_DIGEST' column is read to find the added rows, then
+    the whole table is rewritten, which is a single sequential file write.
+
+    :param df: pandas.DataFrame of the current sales, e.g. 'combined'
+    :param store: parquet_store.ParquetStore holding the sales table
+    :param sales_table: Name of the sales table
+    :return: The added (new or changed) rows, with their 'ROW_DIGEST' column
+    """
+    digests = row_digests(df)
+    written = df.assign(**{DIGEST_COLUMN: digests})
+
+    stored = np.array([], dtype=np.int64)
+    if store.has_table(sales_table) and store.columns(sales_table) == list(
+        written.columns
+    ):
+        stored = store.read(sales_table, columns=[DIGEST_COLUMN])[
+            DIGEST_COLUMN
+        ].to_numpy(dtype=np.int64)
+
+    is_new = ~np.isin(digests, stored)
+    removed = np.count_nonzero(~np.isin(stored, digests))
+    store.write(written, sales_table)
+
+    print(
+        f"Incremental load: {is_new.sum()} rows added, {removed} rows removed, "
+        f"{len(df) - is_new.sum()} unchanged."
+    )
+    return written[is_new]
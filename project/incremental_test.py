@@ -0,0 +1,110 @@
+# --------------------------------------------------------
+# TEST: Row-level incremental sales load
+# --------------------------------------------------------
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+import incremental
+import writer
+
+
+# Local SQLite stand-in for the MySQL database
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'sales.db'}")
+
+
+@pytest.fixture
+def sales_df():
+    return pd.DataFrame(
+        {
+            "BOROUGH CODE": [1, 1, 2, 2],
+            "BOROUGH": ["MANHATTAN", "MANHATTAN", "BRONX", "BRONX"],
+            "ADDRESS": [
+                "254 WEST 27TH STREET",
+                "254 WEST 27TH STREET",  # Same sale twice
+                "2744 BOUCK AVE",
+                "2746 BOUCK AVE",
+            ],
+            "SALE PRICE": [2165000.0, 2165000.0, 500000.0, 600000.0],
+        }
+    )
+
+
+def read_sales(engine):
+    return pd.read_sql_query("SELECT * FROM sales", engine)
+
+
+# Identical rows must still get distinct digests
+def test_row_digests(sales_df):
+    digests = incremental.row_digests(sales_df)
+    assert digests.dtype == np.int64
+    assert len(set(digests)) == 4
+
+    # Digests only depend on the row contents, not the row order
+    assert set(incremental.row_digests(sales_df.iloc[::-1])) == set(digests)
+
+
+# The first run loads everything
+def test_sync_sales_first_run(engine, sales_df):
+    added = incremental.sync_sales(sales_df, engine)
+
+    assert len(added) == 4
+    assert len(read_sales(engine)) == 4
+    digests = pd.read_sql_query("SELECT * FROM sales_digest", engine)
+    assert set(digests["ROW_DIGEST"]) == set(incremental.row_digests(sales_df))
+
+
+# Later runs only write the new and changed rows, and
+# delete the rows that left the window
+def test_sync_sales_delta(engine, sales_df):
+    incremental.sync_sales(sales_df, engine)
+
+    updated = sales_df.copy()
+    updated.loc[3, "SALE PRICE"] = 650000.0  # Changed
+    updated = updated.drop(index=2)  # Left the window
+    updated.loc[4] = [3, "BROOKLYN", "20 JAY STREET", 900000.0]  # New
+
+    added = incremental.sync_sales(updated, engine)
+
+    assert sorted(added["ADDRESS"]) == ["20 JAY STREET", "2746 BOUCK AVE"]
+
+    result = read_sales(engine).drop(columns="ROW_DIGEST")
+    expected = updated.reset_index(drop=True)
+    pd.testing.assert_frame_equal(
+        result.sort_values(list(result.columns)).reset_index(drop=True),
+        expected.sort_values(list(expected.columns)).reset_index(drop=True),
+    )
+    assert len(pd.read_sql_query("SELECT * FROM sales_digest", engine)) == 4
+
+    # Nothing changed, nothing written
+    assert incremental.sync_sales(updated, engine).empty
+
+
+# A change in the sales columns forces a full reload
+def test_sync_sales_schema_change(engine, sales_df):
+    incremental.sync_sales(sales_df, engine)
+
+    added = incremental.sync_sales(sales_df.assign(ZIP=10001), engine)
+
+    assert len(added) == 4
+    assert "ZIP" in read_sales(engine).columns
+
+
+# A full reload swaps in both tables, and a rollback restores both
+def test_full_load_sales_rollback(engine, sales_df):
+    incremental.sync_sales(sales_df, engine)
+    incremental.full_load_sales(sales_df.iloc[:2], engine, index_columns=["BOROUGH"])
+
+    assert len(read_sales(engine)) == 2
+    assert len(writer.snapshots(engine, "sales")) == 1
+    assert len(writer.snapshots(engine, "sales_digest")) == 1
+
+    writer.rollback_tables(engine, ["sales", "sales_digest"])
+    assert len(read_sales(engine)) == 4
+    assert len(pd.read_sql_query("SELECT * FROM sales_digest", engine)) == 4
+
+    # The digest table still matches, so the next run is incremental again
+    assert incremental.sync_sales(sales_df, engine).empty
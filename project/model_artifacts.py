@@ -0,0 +1,88 @@
+"""
+Versioned model artifacts in the shared model volume.
+
+Every export goes to its own folder, and is published by atomically
+rewriting a pointer file, so the Flask service never reads a half-written
+model:
+
+    model/
+        CURRENT                     # e.g. '20240101T120000.123456'
+        versions/
+            20240101T120000.123456/
+                model.joblib
+                preprocessor.joblib
+                forest/             # see `flat_forest.py`
+
+Old versions are pruned after KEEP_VERSIONS newer ones. Workers still
+memory-mapping a pruned version keep reading it until they reload, the
+files are only freed once unmapped.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import shutil
+from datetime import datetime
+
+# MODEL PACKAGING
+import joblib
+
+# PROJECT MODULES
+import flat_forest
+
+# VARS -----------------------------------------
+
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+KEEP_VERSIONS = 2
+
+MODEL_FILE = "model.joblib"
+ENCODER_FILE = "preprocessor.joblib"
+FOREST_DIR = "forest"
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def current_version(model_dir):
+    """
+    Returns the published version of a model folder, or None if there is none.
+    """
+    try:
+        with open(os.path.join(model_dir, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def version_dir(model_dir, version):
+    return os.path.join(model_dir, VERSIONS_DIR, version)
+
+
+def publish(model_dir, model, preprocessor, keep_versions=KEEP_VERSIONS):
+    """
+    Saves a model, its preprocessor and its flat forest as a new version,
+    then points CURRENT at it.
+
+    :param model_dir: Model folder, e.g. the shared docker volume
+    :param model: Fitted RandomForestRegressor
+    :param preprocessor: Fitted ColumnTransformer
+    :param keep_versions: Older versions kept for workers that haven't reloaded
+    :return: The new version
+    """
+    version = datetime.now().strftime("%Y%m%dT%H%M%S.%f")
+    folder = version_dir(model_dir, version)
+    os.makedirs(folder)
+    joblib.dump(model, os.path.join(folder, MODEL_FILE))
+    joblib.dump(preprocessor, os.path.join(folder, ENCODER_FILE))
+    flat_forest.export_forest(model).save(os.path.join(folder, FOREST_DIR))
+
+    # Rename over the pointer, readers see the old or the new version
+    pointer = os.path.join(model_dir, CURRENT_FILE)
+    with open(pointer + ".part", "w") as f:
+        f.write(version)
+    os.replace(pointer + ".part", pointer)
+    print(f"Published model version '{version}' to '{model_dir}'.")
+
+    versions = sorted(os.listdir(os.path.join(model_dir, VERSIONS_DIR)))
+    for old in versions[: max(0, versions.index(version) - keep_versions)]:
+        shutil.rmtree(version_dir(model_dir, old), ignore_errors=True)
+    return version
@@ -0,0 +1,36 @@
+# --------------------------------------------------------
+# TEST: Versioned model artifacts
+# --------------------------------------------------------
+import os
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.preprocessing import StandardScaler
+
+import flat_forest
+import model_artifacts
+
+
+# Each publish is a new version, CURRENT points at the last one,
+# and only 'keep_versions' older versions are kept
+def test_publish(tmp_path):
+    model_dir = str(tmp_path / "model")
+    X = np.random.default_rng(0).normal(size=(50, 3))
+    model = RandomForestRegressor(n_estimators=2).fit(X, X[:, 0])
+    preprocessor = StandardScaler().fit(X)
+
+    assert model_artifacts.current_version(model_dir) is None
+    versions = [
+        model_artifacts.publish(model_dir, model, preprocessor, keep_versions=1)
+        for _ in range(3)
+    ]
+
+    assert model_artifacts.current_version(model_dir) == versions[-1]
+    assert sorted(os.listdir(os.path.join(model_dir, "versions"))) == sorted(
+        versions[1:]
+    )
+    assert sorted(os.listdir(model_dir)) == ["CURRENT", "versions"]
+
+    folder = model_artifacts.version_dir(model_dir, versions[-1])
+    forest = flat_forest.FlatForest.load(os.path.join(folder, "forest"))
+    np.testing.assert_allclose(forest.predict(X), model.predict(X), atol=1e-6)
@@ -0,0 +1,167 @@
+"""
+Embedded columnar backend for the ETL.
+
+Tables live as Parquet files in one folder, and joins run in-process as
+vectorized SQL with DuckDB, so the hot path of a refresh makes no network
+round trips. A MySQL database becomes an optional export target
+('ParquetStore.export_to_sql').
+
+DuckDB is optional: 'pip install duckdb' to use this backend.
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import time
+
+# DATA SCIENCE
+import pandas as pd
+
+# PROJECT MODULES
+import writer
+
+try:
+    import duckdb
+except ImportError:  # Only needed for the Parquet backend
+    duckdb = None
+
+# VARS -----------------------------------------
+
+PARQUET_STORE_DIR = "data_lake"
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def quote(name):
+    """
+    Quotes a column name for DuckDB, e.g. '"GEOCODING ERR"'.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+class ParquetStore:
+    """
+    Folder of Parquet tables, queried with DuckDB.
+
+    Every write goes to a temporary file that is renamed over the table, so
+    readers always see a complete table, like 'writer.swap_tables'.
+    """
+
+    def __init__(self, root=PARQUET_STORE_DIR):
+        if duckdb is None:
+            raise ImportError("The Parquet backend needs DuckDB: pip install duckdb")
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, table_name):
+        return os.path.join(self.root, f"{table_name}.parquet")
+
+    def has_table(self, table_name):
+        return os.path.exists(self.path(table_name))
+
+    def scan(self, table_name):
+        """
+        Returns the SQL expression reading a table, for use in 'query'.
+        """
+        path = self.path(table_name).replace("'", "''")
+        return f"read_parquet('{path}')"
+
+    def columns(self, table_name):
+        """
+        Returns a table's column names, from the Parquet metadata only.
+        """
+        return self.query(f"DESCRIBE SELECT * FROM {self.scan(table_name)}")[
+            "column_name"
+        ].tolist()
+
+    def query(self, sql, **frames):
+        """
+        Runs a SQL query, with DataFrames available as views under their keyword name.
+
+            store.query(f"SELECT * FROM new_rows n JOIN {store.scan('geocodes')} g "
+                        "USING (GEO_KEY)", new_rows=df)
+
+        :return: pandas.DataFrame of the result
+        """
+        with duckdb.connect() as connection:
+            for name, frame in frames.items():
+                connection.register(name, frame)
+            return connection.execute(sql).fetchdf()
+
+    def read(self, table_name, columns=None):
+        """
+        Reads a table, or only some of its columns.
+        """
+        return pd.read_parquet(self.path(table_name), columns=columns)
+
+    def _copy(self, connection, sql, table_name):
+        # Write next to the table, then rename over it
+        path = self.path(table_name)
+        part = (path + ".part").replace("'", "''")
+        connection.execute(f"COPY ({sql}) TO '{part}' (FORMAT PARQUET)")
+        os.replace(path + ".part", path)
+
+    def write(self, df, table_name):
+        """
+        Replaces a table with a DataFrame.
+        """
+        start = time.perf_counter()
+        with duckdb.connect() as connection:
+            connection.register("frame", df)
+            self._copy(connection, "SELECT * FROM frame", table_name)
+        print(
+            f"Wrote {len(df)} rows to '{self.path(table_name)}' "
+            f"in {time.perf_counter() - start:.2f}s."
+        )
+        return len(df)
+
+    def upsert(self, df, table_name, key_columns):
+        """
+        Adds rows to a table, replacing the stored rows with the same key.
+
+        Like 'writer.write_frame' with 'key_columns'. The last row of a key wins.
+
+        :param df: pandas.DataFrame of the rows to write
+        :param table_name: Name of the table, created if it doesn't exist
+        :param key_columns: Unique key columns, e.g. ['GEO_KEY']
+        :return: The number of rows written
+        """
+        df = df.drop_duplicates(subset=key_columns, keep="last")
+        if not self.has_table(table_name):
+            return self.write(df, table_name)
+
+        start = time.perf_counter()
+        match = " AND ".join(
+            f"n.{quote(column)} = o.{quote(column)}" for column in key_columns
+        )
+        with duckdb.connect() as connection:
+            connection.register("new_rows", df)
+            self._copy(
+                connection,
+                f"SELECT * FROM {self.scan(table_name)} o WHERE NOT EXISTS "
+                f"(SELECT 1 FROM new_rows n WHERE {match}) "
+                f"UNION ALL BY NAME SELECT * FROM new_rows",
+                table_name,
+            )
+        print(
+            f"Upserted {len(df)} rows into '{self.path(table_name)}' "
+            f"in {time.perf_counter() - start:.2f}s."
+        )
+        return len(df)
+
+    def export_to_sql(self, engine, table_name, sql_table_name=None, **kwargs):
+        """
+        Copies a table to a SQL database, swapped in with 'writer.write_frame'.
+
+        :param engine: SQLAlchemy engine instance
+        :param table_name: Name of the Parquet table
+        :param sql_table_name: Name of the SQL table, defaults to 'table_name'
+        :param kwargs: Other 'writer.write_frame' arguments, e.g. 'dtype', 'key_columns'
+        :return: The number of rows written
+        """
+        return writer.write_frame(
+            self.read(table_name),
+            sql_table_name or table_name,
+            engine,
+            if_exists="swap",
+            **kwargs,
+        )
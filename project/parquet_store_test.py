@@ -0,0 +1,221 @@
+# --------------------------------------------------------
+# TEST: Parquet + DuckDB backend
+# --------------------------------------------------------
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+pytest.importorskip("duckdb")
+
+import helpers
+import incremental
+import parquet_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    return parquet_store.ParquetStore(str(tmp_path / "lake"))
+
+
+@pytest.fixture
+def geocodes():
+    return helpers.key_geocodes(
+        pd.DataFrame(
+            {
+                "BOROUGH CODE": [1, 1],
+                "BOROUGH": ["MANHATTAN", "MANHATTAN"],
+                "NEIGHBORHOOD": ["CHELSEA", "EAST VILLAGE"],
+                "ADDRESS": ["254 WEST 27TH STREET", "46 STUYVESANT STREET, 1"],
+                "LATITUDE": [40.74, 40.73],
+                "LONGITUDE": [-73.99, -73.98],
+                "GEOCODING ERR": [False, False],
+            }
+        )
+    )
+
+
+@pytest.fixture
+def sales():
+    return pd.DataFrame(
+        {
+            "BOROUGH": pd.Categorical(["MANHATTAN", "MANHATTAN", "MANHATTAN"]),
+            "ADDRESS": pd.Categorical(
+                ["46 STUYVESANT STREET, 1", "20 WEST 123 STREET", "254 W 27 ST"]
+            ),
+            "BUILDING CLASS CATEGORY": pd.Categorical(
+                [
+                    "13 CONDOS - ELEVATOR APARTMENTS",
+                    "01 ONE FAMILY DWELLINGS",
+                    "21 OFFICE BUILDINGS",  # Not mapped
+                ]
+            ),
+            "BOROUGH CODE": [1, 1, 1],
+            "NEIGHBORHOOD": ["EAST VILLAGE", "HARLEM-CENTRAL", "CHELSEA"],
+            "SALE PRICE": [1.0e6, 2.0e6, 3.0e6],
+        }
+    ).assign(GEO_KEY=lambda df: helpers.geo_keys(df["BOROUGH"], df["ADDRESS"]))
+
+
+# Upserts replace the stored rows of a key, the last new row wins
+def test_upsert(store, geocodes):
+    store.upsert(geocodes, "geocodes", ["GEO_KEY"])
+    changed = geocodes.iloc[:1].assign(LATITUDE=1.0)
+    store.upsert(
+        pd.concat([changed.assign(LATITUDE=0.0), changed]), "geocodes", ["GEO_KEY"]
+    )
+
+    result = store.read("geocodes").set_index("ADDRESS")
+    assert len(result) == 2
+    assert result.loc["254 WEST 27TH STREET", "LATITUDE"] == 1.0
+    assert result.loc["46 STUYVESANT STREET, 1", "LATITUDE"] == 40.73
+    assert store.columns("geocodes") == list(geocodes.columns)
+
+
+# Same missing rows as the SQL anti-join
+def test_check_missing_rows_parquet(store, geocodes, sales, tmp_path):
+    store.write(geocodes, "geocodes")
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    geocodes.to_sql("geocodes", engine, index=False)
+
+    result = helpers.check_missing_rows_parquet(sales, store, "geocodes")
+    expected = helpers.check_missing_rows_server_side(
+        sales, "geocodes", engine, key_column="GEO_KEY"
+    )
+    pd.testing.assert_frame_equal(result, expected)
+    assert result["ADDRESS"].tolist() == ["20 WEST 123 STREET"]
+
+    assert (
+        helpers.check_missing_rows_parquet(sales.iloc[[0, 2]], store, "geocodes")
+        is False
+    )
+    with pytest.raises(IOError, match="SQL query error"):
+        helpers.check_missing_rows_parquet(sales, store, "missing")
+
+
+# Same result as the pandas merge and 'group_categories'
+def test_merge_geocodes_parquet(store, geocodes, sales):
+    store.write(geocodes, "geocodes")
+
+    result = helpers.merge_geocodes_parquet(sales, store, "geocodes")
+
+    expected = sales.merge(
+        geocodes[["GEO_KEY", "LATITUDE", "LONGITUDE"]], on="GEO_KEY", how="left"
+    )
+    expected["GROUPED CATEGORY"] = helpers.group_categories(
+        expected["BUILDING CLASS CATEGORY"]
+    )
+    pd.testing.assert_frame_equal(
+        result.astype({"GROUPED CATEGORY": object}),
+        expected.astype({"GROUPED CATEGORY": object}),
+    )
+
+
+# Same left merge semantics as pandas for sales without a geocode, a key
+# stored twice and an index that isn't a range
+def test_merge_geocodes_parquet_left_merge(store, geocodes, sales):
+    store.write(pd.concat([geocodes, geocodes.iloc[:1]]), "geocodes")
+    sales = sales.set_axis([10, 5, 7])
+
+    result = helpers.merge_geocodes_parquet(sales, store, "geocodes")
+
+    expected = sales.merge(
+        store.read("geocodes")[["GEO_KEY", "LATITUDE", "LONGITUDE"]],
+        on="GEO_KEY",
+        how="left",
+    )
+    expected["GROUPED CATEGORY"] = helpers.group_categories(
+        expected["BUILDING CLASS CATEGORY"]
+    )
+    pd.testing.assert_frame_equal(
+        result.astype({"GROUPED CATEGORY": object}),
+        expected.astype({"GROUPED CATEGORY": object}),
+    )
+    assert result["ADDRESS"].tolist() == [
+        "46 STUYVESANT STREET, 1",
+        "20 WEST 123 STREET",
+        "254 W 27 ST",
+        "254 W 27 ST",
+    ]
+    assert result["LATITUDE"].isna().tolist() == [False, True, False, False]
+
+
+# Only new or changed sales come back, the table holds every sale
+def test_sync_sales_parquet(store, sales):
+    assert len(incremental.sync_sales_parquet(sales, store)) == 3
+
+    changed = sales.assign(**{"SALE PRICE": [1.0e6, 2.0e6, 4.0e6]})
+    added = incremental.sync_sales_parquet(changed, store)
+
+    assert added["SALE PRICE"].tolist() == [4.0e6]
+    assert store.read("sales")["SALE PRICE"].tolist() == [1.0e6, 2.0e6, 4.0e6]
+
+
+# Benchmark of a refresh's joins, 1M stored geocodes and 1M sales:
+# anti-join of 20k new sales, then the merge of every sale
+def test_parquet_backend_benchmark(store, tmp_path):
+    stored, new = 1_000_000, 20_000
+    rng = np.random.default_rng(0)
+    keys = rng.integers(-(2**62), 2**62, size=stored, dtype=np.int64)
+    geocodes = pd.DataFrame(
+        {
+            "BOROUGH CODE": 4,
+            "BOROUGH": "QUEENS",
+            "NEIGHBORHOOD": "ASTORIA",
+            "ADDRESS": "1 MAIN ST",
+            "LATITUDE": rng.random(stored),
+            "LONGITUDE": rng.random(stored),
+            "GEOCODING ERR": False,
+            "PRIMARY_KEY": "QUEENS_1 MAIN ST",
+            "GEO_KEY": keys,
+        }
+    )
+    sales = pd.DataFrame(
+        {
+            "BOROUGH CODE": 4,
+            "BOROUGH": "QUEENS",
+            "NEIGHBORHOOD": "ASTORIA",
+            "ADDRESS": "1 MAIN ST",
+            "BUILDING CLASS CATEGORY": pd.Categorical(
+                rng.choice(list(helpers.category_mapping), size=stored)
+            ),
+            "GEO_KEY": np.concatenate(
+                [keys[: stored - new], rng.integers(2**62, 2**63 - 1, size=new)]
+            ),
+        }
+    )
+
+    store.write(geocodes, "geocodes")
+    engine = create_engine(f"sqlite:///{tmp_path / 'geocodes.db'}")
+    geocodes.to_sql("geocodes", engine, index=False, chunksize=100_000)
+    helpers.add_key_index(engine, "geocodes", "GEO_KEY", unique=True)
+    new_sales = sales.iloc[-new:]
+
+    start = time.perf_counter()
+    missing = helpers.check_missing_rows_server_side(
+        new_sales, "geocodes", engine, key_column="GEO_KEY"
+    )
+    merged_sql = sales.merge(
+        pd.read_sql_query("SELECT GEO_KEY, LATITUDE, LONGITUDE FROM geocodes", engine),
+        on="GEO_KEY",
+        how="left",
+    )
+    merged_sql["GROUPED CATEGORY"] = helpers.group_categories(
+        merged_sql["BUILDING CLASS CATEGORY"]
+    )
+    sql_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    missing_parquet = helpers.check_missing_rows_parquet(new_sales, store, "geocodes")
+    merged = helpers.merge_geocodes_parquet(sales, store, "geocodes")
+    parquet_seconds = time.perf_counter() - start
+
+    print(
+        f"\n{stored} geocodes, {stored} sales: SQL + pandas {sql_seconds:.2f}s, "
+        f"Parquet + DuckDB {parquet_seconds:.2f}s"
+    )
+    assert len(missing) == len(missing_parquet) == new
+    np.testing.assert_array_equal(merged["LATITUDE"], merged_sql["LATITUDE"])
+    assert parquet_seconds < sql_seconds
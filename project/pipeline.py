@@ -0,0 +1,608 @@
+"""
+Headless ETL and training pipeline.
+
+Runs the same steps as `notebook.ipynb` as named stages:
+
+    fetch -> combine -> filter -> geocode -> merge -> encode -> train -> export
+
+Every stage checkpoints its output to disk and reports its wall time and
+row count, so a failed run can be resumed from the last good stage, and a
+single stage can be re-run from the checkpoints of the stages it reads.
+
+Usage:
+    python3 pipeline.py                 # Run every stage
+    python3 pipeline.py --resume        # Resume after the last good stage
+    python3 pipeline.py --from merge    # Run 'merge' and everything after it
+    python3 pipeline.py --stage train   # Run 'train' only
+    python3 pipeline.py --database-url sqlite:///local.db   # Without MySQL
+    python3 pipeline.py --backend parquet  # Parquet + DuckDB, MySQL export optional
+"""
+
+# OPERATING SYSTEM STUFF
+import os
+import json
+import time
+import argparse
+
+# DATA SCIENCE
+import numpy as np
+import pandas as pd
+
+# MACHINE LEARNING
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+# MODEL PACKAGING
+import joblib
+
+# CONFIGURATION FILES
+import config
+
+# PROJECT MODULES
+import helpers
+import db
+import address_index
+import fetch
+import geocoder
+import geocode_cache
+import incremental
+import model_artifacts
+import parquet_store
+import writer
+
+# VARS -----------------------------------------
+
+CHECKPOINT_DIR = "checkpoints"
+GEOCODE_CACHE_PATH = geocode_cache.GEOCODE_CACHE_PATH
+MODEL_DIR = "model"
+
+# Table names
+geocodes_sql_table_name = "geocodes"
+sales_sql_table_name = "sales"
+
+# Define the mapping for borough codes to borough names
+borough_mapping = {
+    1: "MANHATTAN",
+    2: "BRONX",
+    3: "BROOKLYN",
+    4: "QUEENS",
+    5: "STATEN ISLAND",
+}
+
+# Define thresholds for "close to zero"
+thresholds = {
+    "SALE PRICE": 100000,
+    "GROSS SQUARE FEET": 100,
+    "LAND SQUARE FEET": 100,
+}
+
+# Select the features we are interested in
+selected_features = [
+    "BOROUGH CODE",
+    "GROSS SQUARE FEET",
+    "LAND SQUARE FEET",
+    "GROUPED CATEGORY",
+    "LATITUDE",
+    "LONGITUDE",
+    "SALE PRICE",
+]
+
+# Define the columns to be scaled and one-hot encoded
+cols_to_encode = ["BOROUGH CODE", "GROUPED CATEGORY"]
+cols_to_scale = [
+    "GROSS SQUARE FEET",
+    "LAND SQUARE FEET",
+    "LATITUDE",
+    "LONGITUDE",
+    "SALE PRICE",
+]
+
+# Position of the target ('SALE PRICE') in the encoded features
+TARGET_INDEX = cols_to_scale.index("SALE PRICE")
+
+model_params = {"n_estimators": 200, "max_depth": 10, "random_state": 42}
+
+# STAGES ---------------------------------------
+
+
+def get_engine(ctx):
+    """
+    Returns the database engine, connecting and setting up the tables on first use.
+    """
+    if ctx.get("engine") is None:
+        if ctx.get("database_url"):
+            # Any SQLAlchemy URL, e.g. a local SQLite file instead of MySQL
+            engine = db.connect_with_retry(db.get_engine(ctx["database_url"]))
+        else:
+            engine = helpers.connect_to_database(
+                config.DB_USERNAME, config.DB_PASSWORD, config.DB_HOSTNAME
+            )
+            if engine is None:
+                raise ConnectionError("Unable to establish a database connection.")
+
+            # See file `helpers.py` for function documentation
+            engine = helpers.create_database(engine, config.DB_NAME)
+        helpers.silence_warnings()
+        helpers.create_table_from_csv(
+            engine, geocodes_sql_table_name, "geocodes_export_backup.csv"
+        )
+        helpers.add_geo_key(engine, geocodes_sql_table_name)
+        ctx["engine"] = engine
+    return ctx["engine"]
+
+
+def fetch_stage(ctx):
+    # Download (if changed) and parse (if changed) the NYC workbooks
+    return fetch.fetch_housing_data(helpers.dataURLs)
+
+
+def combine_stage(ctx, data):
+    combined = helpers.combineHousingDataSets(data)
+    if combined is False:
+        raise KeyError("Required columns are missing in the NYC workbooks")
+
+    # Rename the 'BOROUGH' column to 'BOROUGH CODE' and add the borough names after it
+    combined = combined.rename(columns={"BOROUGH": "BOROUGH CODE"})
+    combined.insert(
+        loc=1, column="BOROUGH", value=combined["BOROUGH CODE"].map(borough_mapping)
+    )
+
+    # Convert to compact types (categoricals, downcast numerics)
+    return helpers.apply_sales_schema(combined)
+
+
+def filter_stage(ctx, combined):
+    # Remove rows that contain the string 'N/A' anywhere in the address column...
+    combined = combined[~combined["ADDRESS"].str.contains("N/A")]
+
+    # Filter outliers, with IQR bounds computed per borough
+    combined = helpers.filterOutliers(
+        combined, thresholds, 0.15, 0.99, group_by="BOROUGH CODE"
+    )
+
+    # Hashed int64 join key of the sales and geocodes tables
+    return combined.assign(
+        **{
+            helpers.GEO_KEY_COLUMN: helpers.geo_keys(
+                combined["BOROUGH"], combined["ADDRESS"]
+            )
+        }
+    )
+
+
+def get_store(ctx):
+    """
+    Returns the Parquet store of the 'parquet' backend, seeding the geocodes on first use.
+    """
+    if ctx.get("store") is None:
+        store = parquet_store.ParquetStore(
+            ctx.get("store_dir", parquet_store.PARQUET_STORE_DIR)
+        )
+        if not store.has_table(geocodes_sql_table_name):
+            store.write(
+                helpers.key_geocodes(pd.read_csv("geocodes_export_backup.csv")),
+                geocodes_sql_table_name,
+            )
+        ctx["store"] = store
+    return ctx["store"]
+
+
+def _geocode(ctx, missing_rows, index):
+    # Spelling variants of addresses we already geocoded don't need the API
+    resolved, missing_rows = index.resolve(missing_rows)
+    if ctx.get("geocode_limit"):
+        missing_rows = missing_rows.head(ctx["geocode_limit"])
+
+    # Cached geocodes (and recent failures) don't need the API either
+    cache = geocode_cache.GeocodeCache(ctx.get("geocode_cache", GEOCODE_CACHE_PATH))
+    try:
+        missing_rows = cache.geolocate_rows(
+            missing_rows,
+            lambda rows: geocoder.geolocate_rows(rows, config.GOOGLE_API_KEY),
+        )
+    except ValueError as err:
+        print(err)
+        print("We'll work with old data for now...")
+        missing_rows = missing_rows.iloc[0:0]
+    return pd.concat([resolved, missing_rows], ignore_index=True)
+
+
+def _geocode_sql(ctx, combined):
+    engine = get_engine(ctx)
+
+    # Sync the sales table, writing only the new or changed sales
+    incremental.sync_sales(
+        combined,
+        engine,
+        sales_sql_table_name,
+        dtype=helpers.sales_data_types_sqlalchemy,
+        index_columns=[helpers.GEO_KEY_COLUMN],
+    )
+
+    # Every sale is checked, not only the added ones: a sale whose geocoding
+    # failed, crashed or was cut off by 'geocode_limit' is picked up again
+    missing_rows = helpers.check_missing_rows_server_side(
+        combined, geocodes_sql_table_name, engine, key_column=helpers.GEO_KEY_COLUMN
+    )
+    if missing_rows is False:
+        return combined.iloc[0:0]
+
+    # Only the geocodes sharing a borough & house number with a missing row
+    index = address_index.AddressIndex.from_sql(
+        engine, geocodes_sql_table_name, missing_rows=missing_rows
+    )
+    missing_rows = _geocode(ctx, missing_rows, index)
+    if missing_rows.empty:
+        return missing_rows
+
+    # Add the missing rows back to the SQL table with the geocodes
+    writer.write_frame(
+        missing_rows,
+        geocodes_sql_table_name,
+        engine,
+        dtype=helpers.geocoding_data_types_sqlalchemy,
+        key_columns=[helpers.GEO_KEY_COLUMN],
+    )
+    # Per-borough row counts and key checksums, computed by the database
+    verification = helpers.verify_sql_subset(
+        engine, missing_rows, geocodes_sql_table_name
+    )
+    if not verification.ok:
+        raise ValueError(
+            "Error appending local geocode data to SQL table. "
+            f"{len(verification.missing_keys)} keys missing in "
+            f"{verification.mismatched_partitions}."
+        )
+    return missing_rows
+
+
+def _geocode_parquet(ctx, combined):
+    store = get_store(ctx)
+
+    # Same steps as '_geocode_sql', in-process against the Parquet tables
+    incremental.sync_sales_parquet(combined, store, sales_sql_table_name)
+    missing_rows = combined.iloc[0:0]
+    if not combined.empty:
+        missing = helpers.check_missing_rows_parquet(
+            combined, store, geocodes_sql_table_name
+        )
+        if missing is not False:
+            index = address_index.AddressIndex(
+                store.read(
+                    geocodes_sql_table_name,
+                    columns=[
+                        "BOROUGH",
+                        "ADDRESS",
+                        "LATITUDE",
+                        "LONGITUDE",
+                        "GEOCODING ERR",
+                    ],
+                )
+            )
+            missing_rows = _geocode(ctx, missing, index)
+            if not missing_rows.empty:
+                store.upsert(
+                    missing_rows, geocodes_sql_table_name, [helpers.GEO_KEY_COLUMN]
+                )
+
+    # The SQL database is only an export target
+    if ctx.get("export_sql"):
+        engine = get_engine(ctx)
+        store.export_to_sql(
+            engine, sales_sql_table_name, dtype=helpers.sales_data_types_sqlalchemy
+        )
+        store.export_to_sql(
+            engine,
+            geocodes_sql_table_name,
+            dtype=helpers.geocoding_data_types_sqlalchemy,
+            key_columns=[helpers.GEO_KEY_COLUMN],
+        )
+    return missing_rows
+
+
+def geocode_stage(ctx, combined):
+    if ctx.get("backend") == "parquet":
+        return _geocode_parquet(ctx, combined)
+    return _geocode_sql(ctx, combined)
+
+
+def merge_stage(ctx, combined):
+    if ctx.get("backend") == "parquet":
+        # Join the geocodes and map the categories in one in-process query
+        combined = helpers.merge_geocodes_parquet(
+            combined, get_store(ctx), geocodes_sql_table_name
+        )
+    else:
+        # Pull geocodes back down from SQL table
+        geocodes_table_response = pd.read_sql_query(
+            f"SELECT {helpers.GEO_KEY_COLUMN}, LATITUDE, LONGITUDE "
+            f"FROM {geocodes_sql_table_name}",
+            get_engine(ctx),
+        )
+
+        # Merge geocodes on the int64 join key
+        combined = combined.merge(
+            geocodes_table_response, on=helpers.GEO_KEY_COLUMN, how="left"
+        )
+
+        # Map to the grouped categories
+        combined["GROUPED CATEGORY"] = helpers.group_categories(
+            combined["BUILDING CLASS CATEGORY"]
+        )
+
+    # Drop the categories that couldn't be mapped
+    if combined["GROUPED CATEGORY"].isna().any():
+        combined = combined.dropna(subset=["GROUPED CATEGORY"])
+        print("Warning: some categories were not be mapped, those rows were dropped.")
+    return combined
+
+
+def encode_stage(ctx, combined):
+    # Drop rows with missing latitude or longitude
+    df = combined[selected_features].dropna(subset=["LATITUDE", "LONGITUDE"])
+
+    # Plain types for the encoder, so it matches the service's request values
+    df = df.astype({"BOROUGH CODE": "int64", "GROUPED CATEGORY": object})
+
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ("scale", StandardScaler(), cols_to_scale),
+            ("ohe", OneHotEncoder(), cols_to_encode),
+        ],
+        sparse_threshold=0,
+    )
+    df_processed = preprocessor.fit_transform(df)
+
+    # Drop rows with NaN values
+    df_processed = df_processed[~np.isnan(df_processed).any(axis=1)]
+    return preprocessor, df_processed
+
+
+def train_stage(ctx, encoded):
+    preprocessor, df_processed = encoded
+
+    # Split the data into features and target
+    X = np.delete(df_processed, TARGET_INDEX, axis=1)
+    y = df_processed[:, TARGET_INDEX]
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=0.2, random_state=42
+    )
+
+    model = RandomForestRegressor(**model_params)
+    model.fit(X_train, y_train)
+
+    mae_train = mean_absolute_error(y_train, model.predict(X_train))
+    mae_test = mean_absolute_error(y_test, model.predict(X_test))
+    print(f"MAE (scaled): train {mae_train:.4f}, test {mae_test:.4f}")
+    return model
+
+
+def export_stage(ctx, encoded, model):
+    preprocessor, _ = encoded
+
+    # Save to the project folder
+    joblib.dump(model, "model.joblib")
+    joblib.dump(preprocessor, "preprocessor.joblib")
+
+    # Publish a new version to the shared docker volume, the Flask service
+    # picks it up without a restart (see `model_artifacts.py`)
+    model_artifacts.publish(ctx.get("model_dir", MODEL_DIR), model, preprocessor)
+
+
+# Stage name, function, and the stages whose outputs it reads
+STAGES = [
+    ("fetch", fetch_stage, []),
+    ("combine", combine_stage, ["fetch"]),
+    ("filter", filter_stage, ["combine"]),
+    ("geocode", geocode_stage, ["filter"]),
+    ("merge", merge_stage, ["filter"]),
+    ("encode", encode_stage, ["merge"]),
+    ("train", train_stage, ["encode"]),
+    ("export", export_stage, ["encode", "train"]),
+]
+
+# RUNNER ---------------------------------------
+
+
+def _checkpoint_paths(checkpoint_dir, name):
+    # DataFrames are saved as Parquet, everything else with joblib
+    base = os.path.join(checkpoint_dir, name)
+    return base + ".parquet", base + ".joblib"
+
+
+def save_checkpoint(checkpoint_dir, name, output):
+    """
+    Saves a stage's output, as Parquet for DataFrames and joblib otherwise.
+    """
+    parquet, pickle = _checkpoint_paths(checkpoint_dir, name)
+    path, stale = (
+        (parquet, pickle) if isinstance(output, pd.DataFrame) else (pickle, parquet)
+    )
+
+    if isinstance(output, pd.DataFrame):
+        output.to_parquet(path + ".part", index=False)
+    else:
+        joblib.dump(output, path + ".part")
+    os.replace(path + ".part", path)
+
+    # Only one checkpoint per stage
+    if os.path.exists(stale):
+        os.remove(stale)
+
+
+def load_checkpoint(checkpoint_dir, name):
+    """
+    Loads a stage's output saved with 'save_checkpoint'.
+
+    Raises:
+    FileNotFoundError: If the stage has no checkpoint.
+    """
+    parquet, pickle = _checkpoint_paths(checkpoint_dir, name)
+    if os.path.exists(parquet):
+        return pd.read_parquet(parquet)
+    if os.path.exists(pickle):
+        return joblib.load(pickle)
+    raise FileNotFoundError(f"No checkpoint for stage '{name}', run it first.")
+
+
+def count_rows(output):
+    """
+    Returns the number of rows in a stage's output, or None if it has no rows.
+    """
+    if isinstance(output, (pd.DataFrame, np.ndarray)):
+        return len(output)
+    if isinstance(output, (list, tuple)):
+        counts = [count_rows(item) for item in output]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _read_manifest(checkpoint_dir):
+    try:
+        with open(os.path.join(checkpoint_dir, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"completed": [], "stages": {}}
+
+
+def _write_manifest(checkpoint_dir, manifest):
+    with open(os.path.join(checkpoint_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def run_pipeline(
+    start=None,
+    only=None,
+    resume=False,
+    checkpoint_dir=CHECKPOINT_DIR,
+    stages=STAGES,
+    ctx=None,
+):
+    """
+    Runs the pipeline stages in order, checkpointing every stage's output.
+
+    Args:
+    start (str): Name of the first stage to run. Defaults to the first stage.
+    only (str): Name of the single stage to run.
+    resume (bool): Start after the last stage that completed in the previous run.
+    checkpoint_dir (str): Folder the checkpoints and 'manifest.json' are saved in.
+    stages (list): (name, function, input stage names) tuples, defaults to 'STAGES'.
+    ctx (dict): Shared settings and resources (e.g. 'engine', 'geocode_limit').
+
+    Returns:
+    dict: Per-stage report, {name: {"seconds": float, "rows": int or None}}.
+
+    Raises:
+    ValueError: If a stage name is unknown.
+    FileNotFoundError: If a stage's input has no checkpoint.
+    """
+    ctx = {} if ctx is None else ctx
+    names = [name for name, _, _ in stages]
+    for name in (start, only):
+        if name is not None and name not in names:
+            raise ValueError(f"Unknown stage '{name}', expected one of {names}.")
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = _read_manifest(checkpoint_dir)
+
+    # Work out which stages to run
+    if only is not None:
+        to_run = [only]
+    else:
+        if resume:
+            done = [name for name in names if name in manifest["completed"]]
+            first = next((name for name in names if name not in done), None)
+            if first is None:
+                print("Every stage already completed, nothing to resume.")
+                return {}
+            start = first
+        to_run = names[names.index(start or names[0]) :]
+
+    # Stages that are re-run invalidate their own 'completed' mark
+    manifest["completed"] = [
+        name for name in manifest["completed"] if name not in to_run
+    ]
+
+    outputs, report = {}, {}
+    for name, function, inputs in stages:
+        if name not in to_run:
+            continue
+
+        args = [
+            outputs[i] if i in outputs else load_checkpoint(checkpoint_dir, i)
+            for i in inputs
+        ]
+
+        began = time.perf_counter()
+        output = function(ctx, *args)
+        seconds = time.perf_counter() - began
+
+        outputs[name] = output
+        save_checkpoint(checkpoint_dir, name, output)
+
+        rows = count_rows(output)
+        report[name] = {"seconds": round(seconds, 3), "rows": rows}
+        manifest["completed"].append(name)
+        manifest["stages"][name] = report[name]
+        _write_manifest(checkpoint_dir, manifest)
+
+        rows_text = f", {rows:,} rows" if rows is not None else ""
+        print(f"[{name}] {seconds:.2f}s{rows_text}")
+
+        # SQL time of the stage, from the engine's query instrumentation
+        query_stats = getattr(ctx.get("engine"), "query_stats", None)
+        if query_stats is not None and query_stats.queries:
+            print(f"[{name}] SQL: {query_stats.summary()}")
+            query_stats.reset()
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--from", dest="start", help="Stage to start from")
+    group.add_argument("--stage", dest="only", help="Run this single stage only")
+    group.add_argument(
+        "--resume", action="store_true", help="Resume after the last good stage"
+    )
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+    parser.add_argument(
+        "--geocode-limit",
+        type=int,
+        default=0,
+        help="Max new addresses to geocode per run, 0 for no limit",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="SQLAlchemy URL of the database, defaults to the MySQL server in 'config'",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["mysql", "parquet"],
+        default="mysql",
+        help="Where the sales and geocodes tables live",
+    )
+    parser.add_argument(
+        "--export-sql",
+        action="store_true",
+        help="With the parquet backend, also copy the tables to the database",
+    )
+    args = parser.parse_args()
+
+    run_pipeline(
+        start=args.start,
+        only=args.only,
+        resume=args.resume,
+        checkpoint_dir=args.checkpoint_dir,
+        ctx={
+            "geocode_limit": args.geocode_limit,
+            "database_url": args.database_url,
+            "backend": args.backend,
+            "export_sql": args.export_sql,
+        },
+    )
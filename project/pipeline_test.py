@@ -0,0 +1,320 @@
+# --------------------------------------------------------
+# TEST: Pipeline runner
+# --------------------------------------------------------
+import os
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import db
+import flat_forest
+import geocode_cache
+import helpers
+import model_artifacts
+import parquet_store
+import pipeline
+import writer
+
+
+# Three small stages, the last one fails until 'fail' is switched off
+@pytest.fixture
+def toy_stages():
+    calls = []
+    state = {"fail": False}
+
+    def load(ctx):
+        calls.append("load")
+        return pd.DataFrame({"x": [1, 2, 3, 4]})
+
+    def double(ctx, df):
+        calls.append("double")
+        return df.assign(x=df["x"] * 2)
+
+    def total(ctx, df, doubled):
+        calls.append("total")
+        if state["fail"]:
+            raise RuntimeError("Stage failed")
+        return {"total": int(df["x"].sum() + doubled["x"].sum())}
+
+    stages = [
+        ("load", load, []),
+        ("double", double, ["load"]),
+        ("total", total, ["load", "double"]),
+    ]
+    return stages, calls, state
+
+
+# Every stage runs, is checkpointed and reported
+def test_run_pipeline(toy_stages, tmp_path):
+    stages, calls, _ = toy_stages
+
+    report = pipeline.run_pipeline(checkpoint_dir=str(tmp_path), stages=stages)
+
+    assert calls == ["load", "double", "total"]
+    assert report["double"]["rows"] == 4
+    assert report["total"]["rows"] is None
+    doubled = pipeline.load_checkpoint(str(tmp_path), "double")
+    assert doubled["x"].tolist() == [2, 4, 6, 8]
+    assert pipeline.load_checkpoint(str(tmp_path), "total") == {"total": 30}
+
+    with open(tmp_path / "manifest.json") as f:
+        assert json.load(f)["completed"] == ["load", "double", "total"]
+
+
+# After a failure, resuming only re-runs the failed stage
+def test_run_pipeline_resume(toy_stages, tmp_path):
+    stages, calls, state = toy_stages
+
+    state["fail"] = True
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline(checkpoint_dir=str(tmp_path), stages=stages)
+
+    state["fail"] = False
+    calls.clear()
+    pipeline.run_pipeline(checkpoint_dir=str(tmp_path), stages=stages, resume=True)
+
+    assert calls == ["total"]
+    assert pipeline.load_checkpoint(str(tmp_path), "total") == {"total": 30}
+
+
+# A single stage runs from the checkpoints of its inputs
+def test_run_pipeline_single_stage(toy_stages, tmp_path):
+    stages, calls, _ = toy_stages
+
+    with pytest.raises(FileNotFoundError, match="No checkpoint for stage 'load'"):
+        pipeline.run_pipeline(
+            checkpoint_dir=str(tmp_path), stages=stages, only="double"
+        )
+
+    pipeline.run_pipeline(checkpoint_dir=str(tmp_path), stages=stages, only="load")
+    calls.clear()
+    pipeline.run_pipeline(checkpoint_dir=str(tmp_path), stages=stages, only="double")
+
+    assert calls == ["double"]
+
+
+# Unknown stage names are rejected
+def test_run_pipeline_unknown_stage(toy_stages, tmp_path):
+    stages, _, _ = toy_stages
+    with pytest.raises(ValueError, match="Unknown stage 'fetch'"):
+        pipeline.run_pipeline(
+            checkpoint_dir=str(tmp_path), stages=stages, start="fetch"
+        )
+
+
+# --------------------------------------------------------
+# TEST: encode, train & export stages
+# --------------------------------------------------------
+
+
+@pytest.fixture
+def merged_df():
+    rng = np.random.default_rng(0)
+    rows = 200
+    return pd.DataFrame(
+        {
+            "BOROUGH CODE": pd.array(rng.integers(1, 6, rows), dtype="Int8"),
+            "GROSS SQUARE FEET": rng.uniform(500, 5000, rows).astype("float32"),
+            "LAND SQUARE FEET": rng.uniform(500, 5000, rows).astype("float32"),
+            "GROUPED CATEGORY": pd.Categorical(
+                rng.choice(["Condo", "Co-op", "Duplex"], rows)
+            ),
+            "LATITUDE": rng.uniform(40.5, 40.9, rows),
+            "LONGITUDE": rng.uniform(-74.2, -73.7, rows),
+            "SALE PRICE": rng.uniform(1e5, 5e6, rows).astype("float32"),
+        }
+    )
+
+
+def test_encode_train_export(merged_df, tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "model_params", {"n_estimators": 5})
+    monkeypatch.chdir(tmp_path)
+
+    encoded = pipeline.encode_stage({}, merged_df)
+    preprocessor, df_processed = encoded
+
+    # 5 scaled columns, 5 boroughs, 3 categories
+    assert df_processed.shape == (200, 13)
+
+    model = pipeline.train_stage({}, encoded)
+    assert model.n_features_in_ == 12
+
+    pipeline.export_stage({"model_dir": "model"}, encoded, model)
+    folder = model_artifacts.version_dir(
+        "model", model_artifacts.current_version("model")
+    )
+    assert os.path.exists(os.path.join(folder, "model.joblib"))
+    assert os.path.exists(os.path.join(folder, "preprocessor.joblib"))
+    forest = flat_forest.FlatForest.load(os.path.join(folder, "forest"))
+    X = np.delete(df_processed, pipeline.TARGET_INDEX, axis=1)
+    np.testing.assert_allclose(forest.predict(X), model.predict(X), atol=1e-5)
+
+
+# --------------------------------------------------------
+# TEST: geocode & merge stages on the Parquet backend
+# --------------------------------------------------------
+
+
+def test_geocode_merge_parquet(tmp_path):
+    pytest.importorskip("duckdb")
+    ctx = {
+        "backend": "parquet",
+        "store_dir": str(tmp_path / "lake"),
+        "geocode_cache": str(tmp_path / "geocodes.sqlite"),
+    }
+    store = parquet_store.ParquetStore(ctx["store_dir"])
+    store.write(
+        helpers.key_geocodes(
+            pd.DataFrame(
+                {
+                    "BOROUGH CODE": [1],
+                    "BOROUGH": ["MANHATTAN"],
+                    "NEIGHBORHOOD": ["EAST VILLAGE"],
+                    "ADDRESS": ["46 STUYVESANT STREET"],
+                    "LATITUDE": [40.74],
+                    "LONGITUDE": [-73.99],
+                    "GEOCODING ERR": [False],
+                }
+            )
+        ),
+        "geocodes",
+    )
+    combined = pd.DataFrame(
+        {
+            "BOROUGH CODE": [1, 1],
+            "BOROUGH": ["MANHATTAN", "MANHATTAN"],
+            "NEIGHBORHOOD": ["EAST VILLAGE", "EAST VILLAGE"],
+            "ADDRESS": ["46 STUYVESANT STREET", "46 STUYVESENT ST, 4"],
+            "BUILDING CLASS CATEGORY": ["13 CONDOS - ELEVATOR APARTMENTS"] * 2,
+        }
+    ).assign(GEO_KEY=lambda df: helpers.geo_keys(df["BOROUGH"], df["ADDRESS"]))
+
+    # The misspelled address is resolved from the index, without the API
+    geocoded = pipeline.geocode_stage(ctx, combined)
+    assert geocoded["ADDRESS"].tolist() == ["46 STUYVESENT ST, 4"]
+    assert len(store.read("geocodes")) == 2
+
+    merged = pipeline.merge_stage(ctx, combined)
+    assert merged["LATITUDE"].tolist() == [40.74, 40.74]
+    assert merged["GROUPED CATEGORY"].tolist() == ["Condo", "Condo"]
+
+
+# Sales whose geocoding failed are retried on the next run, even though
+# their digests were stored and the sales didn't change
+def test_geocode_retries_failed_sales(tmp_path, monkeypatch):
+    pytest.importorskip("duckdb")
+    ctx = {
+        "backend": "parquet",
+        "store_dir": str(tmp_path / "lake"),
+        "geocode_cache": str(tmp_path / "geocodes.sqlite"),
+    }
+    store = parquet_store.ParquetStore(ctx["store_dir"])
+    store.write(
+        helpers.key_geocodes(
+            pd.DataFrame(
+                {
+                    "BOROUGH CODE": [1],
+                    "BOROUGH": ["MANHATTAN"],
+                    "NEIGHBORHOOD": ["EAST VILLAGE"],
+                    "ADDRESS": ["46 STUYVESANT STREET"],
+                    "LATITUDE": [40.74],
+                    "LONGITUDE": [-73.99],
+                    "GEOCODING ERR": [False],
+                }
+            )
+        ),
+        "geocodes",
+    )
+    combined = pd.DataFrame(
+        {
+            "BOROUGH CODE": [2],
+            "BOROUGH": ["BRONX"],
+            "NEIGHBORHOOD": ["MOTT HAVEN"],
+            "ADDRESS": ["1 MAIN STREET"],
+            "BUILDING CLASS CATEGORY": ["01 ONE FAMILY DWELLINGS"],
+        }
+    ).assign(GEO_KEY=lambda df: helpers.geo_keys(df["BOROUGH"], df["ADDRESS"]))
+
+    def reject(rows, api_key):
+        raise ValueError("Invalid API Key for geocoding!")
+
+    monkeypatch.setattr(pipeline.geocoder, "geolocate_rows", reject)
+    assert pipeline.geocode_stage(ctx, combined).empty
+    assert len(store.read("geocodes")) == 1
+
+    def geolocate(rows, api_key):
+        return rows.assign(LATITUDE=40.81, LONGITUDE=-73.92, **{"GEOCODING ERR": False})
+
+    monkeypatch.setattr(pipeline.geocoder, "geolocate_rows", geolocate)
+    geocoded = pipeline.geocode_stage(ctx, combined)
+    assert geocoded["ADDRESS"].tolist() == ["1 MAIN STREET"]
+    assert len(store.read("geocodes")) == 2
+
+
+# A failed geocode is stored, but is looked up again once its negative cache
+# entry expires, not kept failed forever
+def test_geocode_retries_expired_failures(tmp_path, monkeypatch):
+    engine = db.get_engine(f"sqlite:///{tmp_path / 'etl.db'}")
+    ctx = {"engine": engine, "geocode_cache": str(tmp_path / "geocodes.sqlite")}
+    writer.write_frame(
+        helpers.key_geocodes(
+            pd.DataFrame(
+                {
+                    "BOROUGH CODE": [1],
+                    "BOROUGH": ["MANHATTAN"],
+                    "NEIGHBORHOOD": ["EAST VILLAGE"],
+                    "ADDRESS": ["46 STUYVESANT STREET"],
+                    "LATITUDE": [40.74],
+                    "LONGITUDE": [-73.99],
+                    "GEOCODING ERR": [False],
+                }
+            )
+        ),
+        "geocodes",
+        engine,
+        dtype=helpers.geocoding_data_types_sqlalchemy,
+        key_columns=["GEO_KEY"],
+    )
+    combined = pd.DataFrame(
+        {
+            "BOROUGH CODE": [2],
+            "BOROUGH": ["BRONX"],
+            "NEIGHBORHOOD": ["MOTT HAVEN"],
+            "ADDRESS": ["1 MAIN STREET"],
+            "BUILDING CLASS CATEGORY": ["01 ONE FAMILY DWELLINGS"],
+        }
+    ).assign(GEO_KEY=lambda df: helpers.geo_keys(df["BOROUGH"], df["ADDRESS"]))
+    answers = []
+
+    def geolocate(rows, api_key):
+        answers.append(len(rows))
+        if len(answers) == 1:
+            return rows.assign(**{"GEOCODING ERR": True})
+        return rows.assign(LATITUDE=40.81, LONGITUDE=-73.92, **{"GEOCODING ERR": False})
+
+    def stored():
+        return pd.read_sql_query(
+            "SELECT LATITUDE, `GEOCODING ERR` FROM geocodes WHERE ADDRESS = '1 MAIN STREET'",
+            engine,
+        )
+
+    monkeypatch.setattr(pipeline.geocoder, "geolocate_rows", geolocate)
+    pipeline.geocode_stage(ctx, combined)
+    assert stored()["GEOCODING ERR"].tolist() == [1]
+
+    # The failure is answered by the cache while its entry is fresh
+    pipeline.geocode_stage(ctx, combined)
+    assert answers == [1]
+
+    # Then the address goes back to the API, and its row is updated
+    now = time.time()
+    monkeypatch.setattr(
+        geocode_cache.time, "time", lambda: now + geocode_cache.NEGATIVE_TTL + 1
+    )
+    pipeline.geocode_stage(ctx, combined)
+    assert answers == [1, 1]
+    assert stored().values.tolist() == [[40.81, 0]]
+    assert pipeline.geocode_stage(ctx, combined).empty
@@ -0,0 +1,282 @@
+"""
+Bulk DataFrame writer for the sales and geocodes tables.
+
+Rows are streamed in chunks, each sent as one executemany batch of a single
+compiled INSERT (which the MySQL driver rewrites into a multi-row INSERT),
+with explicit SQL column types. With key columns, rows that already
+exist are updated in place (MySQL 'INSERT ... ON DUPLICATE KEY UPDATE',
+SQLite 'INSERT ... ON CONFLICT DO UPDATE'), so appends never duplicate keys.
+
+Full refreshes load into a staging table, which is then swapped in for the
+live table with a single rename ('swap_tables'). Readers never see the table
+missing or half-loaded, and the previous versions are kept as snapshots
+that 'rollback_tables' can swap back in.
+"""
+
+# OPERATING SYSTEM STUFF
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# DATA SCIENCE
+import pandas as pd
+
+# SQL
+from sqlalchemy import MetaData, Table, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import mysql, sqlite
+
+# VARS -----------------------------------------
+
+# Rows per INSERT statement
+CHUNKSIZE = 10000
+
+# Previous versions of a table kept by 'swap_tables'
+KEEP_SNAPSHOTS = 2
+
+# Table name suffixes, followed by a timestamp, e.g. 'sales__snap_20240101_120000_000000'
+STAGING_SUFFIX = "__stage_"
+SNAPSHOT_SUFFIX = "__snap_"
+
+# FUNCTION DECLARATIONS ------------------------
+
+
+def _records(chunk):
+    """
+    Converts a DataFrame chunk to row dicts, with NaN/NA/NaT as None and
+    numpy scalars as Python scalars.
+    """
+    columns = {}
+    for col in chunk.columns:
+        series = chunk[col]
+        columns[col] = series.astype(object).where(series.notna(), None).tolist()
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def _insert_statement(table, dialect_name, key_columns):
+    if dialect_name == "mysql":
+        stmt = mysql.insert(table)
+        if key_columns:
+            stmt = stmt.on_duplicate_key_update(
+                {c.name: stmt.inserted[c.name] for c in table.columns}
+            )
+    elif dialect_name == "sqlite":
+        stmt = sqlite.insert(table)
+        if key_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=key_columns,
+                set_={
+                    c.name: stmt.excluded[c.name]
+                    for c in table.columns
+                    if c.name not in key_columns
+                },
+            )
+    else:
+        if key_columns:
+            raise ValueError(f"Upserts are not supported on '{dialect_name}'")
+        stmt = table.insert()
+    return stmt
+
+
+def _create_table(connection, df, table_name, dtype, key_columns, if_exists):
+    # Let pandas map the columns missing from 'dtype', then add the unique key
+    df.head(0).to_sql(
+        table_name, con=connection, index=False, if_exists=if_exists, dtype=dtype
+    )
+    if key_columns:
+        columns = ", ".join(f"`{col}`" for col in key_columns)
+        connection.execute(
+            text(
+                f"CREATE UNIQUE INDEX ux_{table_name}_{'_'.join(key_columns)} "
+                f"ON {table_name} ({columns})"
+            )
+        )
+
+
+def _stamp():
+    # Sorts in time order, unique down to the microsecond
+    return datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+
+
+@contextmanager
+def _transaction(con):
+    if isinstance(con, Engine):
+        with con.begin() as connection:
+            yield connection
+    else:
+        yield con
+
+
+def _rename_tables(connection, renames):
+    if connection.dialect.name == "mysql":
+        # One statement, so the renames are atomic
+        connection.execute(
+            text("RENAME TABLE " + ", ".join(f"{old} TO {new}" for old, new in renames))
+        )
+    else:
+        for old, new in renames:
+            connection.execute(text(f"ALTER TABLE {old} RENAME TO {new}"))
+
+
+def snapshots(con, table_name):
+    """
+    Returns the names of a table's snapshots, oldest first.
+    """
+    prefix = f"{table_name}{SNAPSHOT_SUFFIX}"
+    return sorted(
+        name for name in inspect(con).get_table_names() if name.startswith(prefix)
+    )
+
+
+def swap_tables(con, staged, keep_snapshots=KEEP_SNAPSHOTS):
+    """
+    Swaps loaded staging tables in for their live tables.
+
+    On MySQL every swap is a single 'RENAME TABLE', which only locks the
+    tables for the rename itself. The live tables become snapshots, of which
+    the newest 'keep_snapshots' are kept per table.
+
+    Args:
+    con: SQLAlchemy engine or connection.
+    staged (dict): {live table name: staging table name}. Tables swapped
+                   together (e.g. sales and its digests) share the swap.
+    keep_snapshots (int): Previous versions to keep per table, 0 to drop them.
+    """
+    with _transaction(con) as connection:
+        start = time.perf_counter()
+        snapshot_suffix = f"{SNAPSHOT_SUFFIX}{_stamp()}"
+        renames = []
+        for table_name, staging_table in staged.items():
+            if inspect(connection).has_table(table_name):
+                renames.append((table_name, f"{table_name}{snapshot_suffix}"))
+            renames.append((staging_table, table_name))
+        _rename_tables(connection, renames)
+        elapsed = time.perf_counter() - start
+
+        for table_name in staged:
+            old = snapshots(connection, table_name)
+            for snapshot in old[: max(len(old) - keep_snapshots, 0)]:
+                connection.execute(text(f"DROP TABLE {snapshot}"))
+
+    print(
+        f"Swapped in {list(staged)} in {elapsed * 1000:.1f}ms, "
+        f"keeping {keep_snapshots} snapshots."
+    )
+
+
+def rollback_tables(con, table_names):
+    """
+    Swaps the newest snapshot of each table back in, dropping the current version.
+
+    Raises:
+    ValueError: If a table has no snapshot.
+    """
+    with _transaction(con) as connection:
+        latest = {}
+        for table_name in table_names:
+            old = snapshots(connection, table_name)
+            if not old:
+                raise ValueError(
+                    f"Table '{table_name}' has no snapshot to roll back to"
+                )
+            latest[table_name] = old[-1]
+
+        suffix = f"__rolled_back_{_stamp()}"
+        renames = []
+        for table_name, snapshot in latest.items():
+            renames += [(table_name, f"{table_name}{suffix}"), (snapshot, table_name)]
+        _rename_tables(connection, renames)
+        for table_name in latest:
+            connection.execute(text(f"DROP TABLE {table_name}{suffix}"))
+
+    print(f"Rolled back {list(latest)} to {list(latest.values())}.")
+
+
+@contextmanager
+def staging_tables(con, *table_names, keep_snapshots=KEEP_SNAPSHOTS):
+    """
+    Yields {live table name: staging table name} to load into. The staging
+    tables are swapped in when the block succeeds and dropped when it fails.
+
+        with writer.staging_tables(engine, "sales") as staged:
+            writer.write_frame(df, staged["sales"], engine, if_exists="replace")
+    """
+    staged = {name: f"{name}{STAGING_SUFFIX}{_stamp()}" for name in table_names}
+    try:
+        yield staged
+    except BaseException:
+        with _transaction(con) as connection:
+            for staging_table in staged.values():
+                connection.execute(text(f"DROP TABLE IF EXISTS {staging_table}"))
+        raise
+    swap_tables(con, staged, keep_snapshots)
+
+
+def write_frame(
+    df,
+    table_name,
+    con,
+    dtype=None,
+    key_columns=None,
+    if_exists="append",
+    chunksize=CHUNKSIZE,
+    keep_snapshots=KEEP_SNAPSHOTS,
+):
+    """
+    Writes a DataFrame to a SQL table in bulk.
+
+    Args:
+    df (pandas.DataFrame): The rows to write.
+    table_name (str): Name of the SQL table.
+    con: SQLAlchemy engine, or a connection to write inside its transaction.
+    dtype (dict): SQLAlchemy column types, e.g. 'helpers.geocoding_data_types_sqlalchemy'.
+                  Used when the table is created, other columns get pandas' default.
+    key_columns (list): Unique key columns. Rows whose key already exists are updated
+                        instead of inserted. A new table gets a unique index on them.
+    if_exists (str): 'append' to add to the table, 'replace' to recreate it first,
+                     'swap' to load a new table and swap it in (see 'swap_tables').
+    chunksize (int): Rows per INSERT statement.
+    keep_snapshots (int): Previous versions kept by 'swap'.
+
+    Returns:
+    int: The number of rows written.
+
+    Raises:
+    ValueError: If 'key_columns' are given on a database other than MySQL or SQLite.
+    """
+    if isinstance(con, Engine):
+        with con.begin() as connection:
+            return write_frame(
+                df,
+                table_name,
+                connection,
+                dtype,
+                key_columns,
+                if_exists,
+                chunksize,
+                keep_snapshots=keep_snapshots,
+            )
+
+    if if_exists == "swap":
+        with staging_tables(con, table_name, keep_snapshots=keep_snapshots) as staged:
+            write_frame(
+                df, staged[table_name], con, dtype, key_columns, "replace", chunksize
+            )
+        return len(df)
+
+    start = time.perf_counter()
+    key_columns = list(key_columns or [])
+    if if_exists == "replace" or not inspect(con).has_table(table_name):
+        _create_table(con, df, table_name, dtype, key_columns, "replace")
+
+    table = Table(table_name, MetaData(), autoload_with=con)
+    stmt = _insert_statement(table, con.dialect.name, key_columns)
+    for offset in range(0, len(df), chunksize):
+        con.execute(stmt, _records(df.iloc[offset : offset + chunksize]))
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"Wrote {len(df)} rows to '{table_name}' in {elapsed:.2f}s "
+        f"({len(df) / max(elapsed, 1e-9):.0f} rows/s)."
+    )
+    return len(df)
@@ -0,0 +1,188 @@
+# --------------------------------------------------------
+# TEST: Bulk upsert writer
+# --------------------------------------------------------
+import time
+import threading
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect, String, Float
+
+import writer
+
+
+# Local SQLite stand-in for the MySQL database
+@pytest.fixture
+def engine(tmp_path):
+    return create_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+
+
+@pytest.fixture
+def geocodes_df():
+    return pd.DataFrame(
+        {
+            "BOROUGH": ["BRONX", "BRONX", "BRONX"],
+            "ADDRESS": ["2744 BOUCK AVE", "2746 BOUCK AVE", "2744 BOUCK AVE"],
+            "PRIMARY_KEY": [
+                "BRONX_2744 BOUCK AVE",
+                "BRONX_2746 BOUCK AVE",
+                "BRONX_2744 BOUCK AVE",  # Same key twice
+            ],
+            "LATITUDE": [40.1, None, 40.3],
+            "LONGITUDE": [-73.1, None, -73.3],
+            "GEOCODING ERR": [False, True, False],
+        }
+    )
+
+
+def read_table(engine, table_name):
+    return pd.read_sql_query(f"SELECT * FROM {table_name} ORDER BY PRIMARY_KEY", engine)
+
+
+# New tables get the explicit column types and a unique key
+def test_write_frame_schema(engine, geocodes_df):
+    writer.write_frame(
+        geocodes_df.iloc[:2],
+        "geocodes",
+        engine,
+        dtype={"ADDRESS": String(255), "LATITUDE": Float},
+        key_columns=["PRIMARY_KEY"],
+    )
+
+    columns = {c["name"]: c["type"] for c in inspect(engine).get_columns("geocodes")}
+    assert isinstance(columns["ADDRESS"], String) and columns["ADDRESS"].length == 255
+    indexes = inspect(engine).get_indexes("geocodes")
+    assert [(i["column_names"], bool(i["unique"])) for i in indexes] == [
+        (["PRIMARY_KEY"], True)
+    ]
+
+    # NaN is written as NULL
+    result = read_table(engine, "geocodes")
+    assert result["LATITUDE"].isna().tolist() == [False, True]
+
+
+# Existing and repeated keys are updated in place, never duplicated
+def test_write_frame_upsert(engine, geocodes_df):
+    writer.write_frame(
+        geocodes_df.iloc[:2], "geocodes", engine, key_columns=["PRIMARY_KEY"]
+    )
+    written = writer.write_frame(
+        geocodes_df, "geocodes", engine, key_columns=["PRIMARY_KEY"], chunksize=2
+    )
+
+    assert written == 3
+    result = read_table(engine, "geocodes")
+    assert result["PRIMARY_KEY"].tolist() == [
+        "BRONX_2744 BOUCK AVE",
+        "BRONX_2746 BOUCK AVE",
+    ]
+    assert result["LATITUDE"].tolist()[0] == 40.3  # Last write wins
+
+
+# Writes inside a caller's transaction roll back with it
+def test_write_frame_connection(engine, geocodes_df):
+    writer.write_frame(geocodes_df.iloc[0:0], "geocodes", engine)
+    with pytest.raises(RuntimeError):
+        with engine.begin() as connection:
+            writer.write_frame(geocodes_df, "geocodes", connection)
+            raise RuntimeError
+    assert read_table(engine, "geocodes").empty
+
+
+# Throughput writing the full sales table
+def test_write_frame_throughput(engine):
+    sales = pd.read_csv("geocodes_export_backup_1.csv", parse_dates=["SALE DATE"])
+
+    start = time.perf_counter()
+    writer.write_frame(sales, "sales", engine, if_exists="replace")
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{len(sales)} sales rows: {len(sales) / elapsed:.0f} rows/s")
+    assert pd.read_sql_query("SELECT COUNT(*) AS n FROM sales", engine)["n"][0] == len(
+        sales
+    )
+
+
+# --------------------------------------------------------
+# TEST: Staged table swap
+# --------------------------------------------------------
+
+
+# Refreshes swap in a new table and keep the newest snapshots
+def test_write_frame_swap(engine, geocodes_df):
+    for rows in (1, 2, 3, 0):
+        writer.write_frame(
+            geocodes_df.iloc[:rows],
+            "geocodes",
+            engine,
+            key_columns=["PRIMARY_KEY"],
+            if_exists="swap",
+            keep_snapshots=2,
+        )
+
+    assert read_table(engine, "geocodes").empty
+    snapshots = writer.snapshots(engine, "geocodes")
+    assert [len(read_table(engine, name)) for name in snapshots] == [2, 2]
+    assert not [n for n in inspect(engine).get_table_names() if "__stage_" in n]
+
+    # Rolling back swaps the newest snapshot back in, instantly
+    writer.rollback_tables(engine, ["geocodes"])
+    assert len(read_table(engine, "geocodes")) == 2
+    assert writer.snapshots(engine, "geocodes") == snapshots[:1]
+    with pytest.raises(ValueError, match="no snapshot"):
+        writer.rollback_tables(engine, ["missing"])
+
+
+# 'keep_snapshots' also applies when writing through an engine
+def test_write_frame_swap_no_snapshots(engine, geocodes_df):
+    for rows in (1, 2):
+        writer.write_frame(
+            geocodes_df.iloc[:rows],
+            "geocodes",
+            engine,
+            if_exists="swap",
+            keep_snapshots=0,
+        )
+    assert len(read_table(engine, "geocodes")) == 2
+    assert writer.snapshots(engine, "geocodes") == []
+
+
+# A failed load leaves the live table alone and drops its staging table
+def test_staging_tables_failure(engine, geocodes_df):
+    writer.write_frame(geocodes_df, "geocodes", engine)
+    with pytest.raises(RuntimeError):
+        with writer.staging_tables(engine, "geocodes") as staged:
+            writer.write_frame(geocodes_df.iloc[:1], staged["geocodes"], engine)
+            raise RuntimeError
+
+    assert inspect(engine).get_table_names() == ["geocodes"]
+    assert len(read_table(engine, "geocodes")) == 3
+
+
+# Readers never see the table missing or partial during a refresh
+def test_swap_readers(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'writer.db'}")
+    sales = pd.read_csv("geocodes_export_backup_1.csv", parse_dates=["SALE DATE"])
+    writer.write_frame(sales, "sales", engine, if_exists="swap")
+
+    counts, errors, done = [], [], threading.Event()
+
+    def read():
+        while not done.is_set():
+            try:
+                counts.append(
+                    pd.read_sql_query("SELECT COUNT(*) AS n FROM sales", engine)["n"][0]
+                )
+            except Exception as e:
+                errors.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        writer.write_frame(sales, "sales", engine, if_exists="swap")
+    finally:
+        done.set()
+        reader.join()
+
+    assert not errors
+    assert counts and set(counts) == {len(sales)}